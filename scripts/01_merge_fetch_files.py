@@ -1,27 +1,27 @@
 import os
+import sys
 import shutil
 from qgis.core import QgsRasterLayer, QgsProject
-from qgis import processing
 from PyQt5.QtWidgets import QFileDialog
 
+try:
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+except NameError:
+    pass  # Console di QGIS: la cartella "scripts" deve essere già nel sys.path
+
+from fetch.cells import cells_touching
+from fetch.mosaic import find_tiles, refresh_mosaics
+from fetch.qgis_io import cells_from_layer
+
+# False: solo i mosaici virtuali dsm/rgb/mask_unito.vrt, letti a finestre dagli script successivi.
+# True: scrive anche i GeoTIFF a blocchi compressi con piramidi (dsm/rgb/mask_unito.tif)
+MATERIALIZE = False
+
 # Funzione per selezionare la cartella
 def select_folder():
     folder = QFileDialog.getExistingDirectory(None, "Seleziona cartella con file DSM, RGB e MASK")
     return folder
 
-# Funzione per unire i raster con tipo di output specificato
-def merge_rasters(input_files, output_file, output_type):
-    processing.run("gdal:merge", {
-        'INPUT': input_files,
-        'PCT': False,
-        'SEPARATE': False,
-        'NODATA_INPUT': None,
-        'NODATA_OUTPUT': None,
-        'OPTIONS': '',
-        'EXTRA': f'-ot {output_type}',
-        'OUTPUT': output_file
-    })
-
 # Funzione per spostare i file in una sottocartella
 def move_files(input_files, destination_folder):
     if not os.path.exists(destination_folder):
@@ -45,32 +45,22 @@ else:
     # Crea la sottocartella "file_separati"
     separated_folder = os.path.join(folder_path, "file_separati")
 
-    # Unisci i file DSM in formato Float32 e sposta i file separati
-    dsm_files = [os.path.join(folder_path, f) for f in os.listdir(folder_path) if f.startswith("dsm") and f.endswith(".tif")]
-    if dsm_files:
-        dsm_output = os.path.join(folder_path, "dsm_unito.tif")
-        merge_rasters(dsm_files, dsm_output, "Float32")
-        print(f"File DSM unito salvato in: {dsm_output}")
-        move_files(dsm_files, separated_folder)
-    else:
-        print("Nessun file DSM trovato con il prefisso 'dsm'.")
+    # Sposta i tile separati: i mosaici virtuali rimandano alla loro nuova posizione
+    for product in ("dsm", "rgb", "mask"):
+        product_files = find_tiles(folder_path, product)
+        if product_files:
+            move_files(product_files, separated_folder)
 
-    # Unisci i file RGB in formato Byte (8 bit senza segno) e sposta i file separati
-    rgb_files = [os.path.join(folder_path, f) for f in os.listdir(folder_path) if f.startswith("rgb") and f.endswith(".tif")]
-    if rgb_files:
-        rgb_output = os.path.join(folder_path, "rgb_unito.tif")
-        merge_rasters(rgb_files, rgb_output, "Byte")
-        print(f"File RGB unito salvato in: {rgb_output}")
-        move_files(rgb_files, separated_folder)
-    else:
-        print("Nessun file RGB trovato con il prefisso 'rgb'.")
+    # Mosaici di DSM (Float32), RGB e MASK (Byte); i GeoTIFF vengono scritti in parallelo.
+    # Se i mosaici esistono già vengono riscritti solo i blocchi coperti da tile nuovi o cambiati
+    tiles_folder = separated_folder if os.path.isdir(separated_folder) else folder_path
+    mosaics, changed = refresh_mosaics(tiles_folder, folder_path, MATERIALIZE)
+    print(f"Aree cambiate rispetto ai mosaici precedenti: {len(changed)}")
 
-    # Unisci i file MASK in formato Byte (8 bit senza segno) e sposta i file separati
-    mask_files = [os.path.join(folder_path, f) for f in os.listdir(folder_path) if f.startswith("mask") and f.endswith(".tif")]
-    if mask_files:
-        mask_output = os.path.join(folder_path, "mask_unito.tif")
-        merge_rasters(mask_files, mask_output, "Byte")
-        print(f"File MASK unito salvato in: {mask_output}")
-        move_files(mask_files, separated_folder)
-    else:
-        print("Nessun file MASK trovato con il prefisso 'mask'.")
\ No newline at end of file
+    # Celle della griglia toccate dalle aree cambiate (solo informativo: gli script per cella
+    # confrontano le impronte dei pixel di ogni cella e ricalcolano da soli solo quelle cambiate)
+    grid_layers = QgsProject.instance().mapLayersByName("grid")
+    if grid_layers and changed:
+        grid_cells = cells_from_layer(grid_layers[0])
+        touched = cells_touching(grid_cells, changed)
+        print(f"Celle della griglia da ricalcolare: {int(touched.sum())}")
@@ -22,7 +22,7 @@ def load_and_rename_layers():
         else:
             # Apri la finestra di dialogo per selezionare il file
             file_path, _ = QFileDialog.getOpenFileName(iface.mainWindow(), f"Seleziona il file per {layer_name}",
-                                                       "", "Raster Files (*.tif *.tiff *.img);;All Files (*)")
+                                                       "", "Raster Files (*.tif *.tiff *.img *.vrt);;All Files (*)")
             
             if file_path:
                 # Carica il layer
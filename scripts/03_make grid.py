@@ -1,8 +1,23 @@
 from qgis.core import (QgsProject, QgsVectorLayer, QgsFeature, QgsGeometry, 
-                       QgsFeatureSink, QgsProcessing, QgsProcessingFeatureSourceDefinition)
+                       QgsFeatureSink, QgsProcessing, QgsProcessingFeatureSourceDefinition, QgsVectorFileWriter)
 from qgis.PyQt.QtWidgets import QInputDialog, QMessageBox
 from qgis.processing import run
 import os
+import sys
+
+try:
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+except NameError:
+    pass  # Console di QGIS: la cartella "scripts" deve essere già nel sys.path
+
+from fetch.cells import RasterGrid
+from fetch.vector import write_grid
+
+# Implicit grid: cells are defined by origin, size and number of rows and columns
+# (saved next to the grid as grid.gpkg.grid.json), so later scripts compute the
+# cell of each pixel by integer division instead of reading the polygons.
+# False = polygons from native:creategrid, as before.
+IMPLICIT_GRID = True
 
 def show_message(message, title="QGIS grid Generator"):
     """Display a message box with the given message and title."""
@@ -37,6 +52,17 @@ def create_grid(extent, cell_size):
     result = run("native:creategrid", params)
     return result['OUTPUT']
 
+def write_implicit_grid(extent, cell_size, output_path):
+    """
+    Write the grid polygons in a single OGR transaction, together with the
+    implicit grid definition used by the other scripts.
+    """
+    grid = RasterGrid.from_extent((extent.xMinimum(), extent.yMinimum(), extent.xMaximum(), extent.yMaximum()),
+                                  cell_size)
+    write_grid(output_path, grid, {}, QgsProject.instance().crs().toWkt())
+    grid.save(RasterGrid.beside(output_path))
+    return grid
+
 def check_grid_exists(output_path):
     """Check if the grid layer already exists."""
     return os.path.exists(output_path)
@@ -72,20 +98,24 @@ def main():
 
     # show_message(f"Creating grid with cell size: {cell_size}")
 
-    # Create the grid
-    grid_layer = create_grid(extent, cell_size)
+    if IMPLICIT_GRID:
+        grid = write_implicit_grid(extent, cell_size, output_path)
+        show_message(f"grid saved successfully as: {output_path} ({grid.nrows} x {grid.ncols} cells)")
+    else:
+        # Create the grid
+        grid_layer = create_grid(extent, cell_size)
 
-    # Save the grid as GeoPackage
-    save_options = QgsVectorFileWriter.SaveVectorOptions()
-    save_options.driverName = "GPKG"
-    save_options.fileEncoding = "UTF-8"
+        # Save the grid as GeoPackage
+        save_options = QgsVectorFileWriter.SaveVectorOptions()
+        save_options.driverName = "GPKG"
+        save_options.fileEncoding = "UTF-8"
 
-    error = QgsVectorFileWriter.writeAsVectorFormat(grid_layer, output_path, save_options)
+        error = QgsVectorFileWriter.writeAsVectorFormat(grid_layer, output_path, save_options)
 
-    if error[0] == QgsVectorFileWriter.NoError:
-        show_message(f"grid saved successfully as: {output_path}")
-    else:
-        show_message(f"Error saving grid: {error}")
+        if error[0] == QgsVectorFileWriter.NoError:
+            show_message(f"grid saved successfully as: {output_path}")
+        else:
+            show_message(f"Error saving grid: {error}")
 
     # Add the new layer to the project
     new_layer = QgsVectorLayer(output_path, "grid", "ogr")
@@ -1,5 +1,25 @@
 import os
-from qgis.core import QgsProject, QgsVectorLayer, QgsProcessingFeedback, QgsFeatureRequest, QgsProcessing
+import sys
+from qgis.core import (QgsProject, QgsVectorLayer, QgsProcessingFeedback, QgsFeatureRequest, QgsProcessing,
+                       QgsLayerTreeLayer)
+
+try:
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+except NameError:
+    pass  # Console di QGIS: la cartella "scripts" deve essere già nel sys.path
+
+from fetch.polygonize import polygonize_mask
+
+# Vettorializzazione nel processo dei soli pixel degli edifici, a strisce di righe:
+# il poligono dello sfondo (value = 0) non viene mai scritto né cancellato.
+# False = gdal:polygonize e rimozione dei poligoni a 0, come prima.
+STREAMED = True
+
+# Unisce i frammenti degli edifici divisi dai bordi delle strisce
+MERGE_SEAMS = True
+
+# Tolleranza di semplificazione dei poligoni in unità del terreno (None = contorni a gradini dei pixel)
+SIMPLIFY = None
 
 # Funzione per vettorializzare un raster e salvare il risultato in un file GeoPackage
 def vettorializza_raster(raster_layer):
@@ -28,6 +48,13 @@ def vettorializza_raster(raster_layer):
     
     return vector_layer
 
+# Funzione per vettorializzare i soli pixel degli edifici, scrivendo i poligoni a strisce
+def vettorializza_edifici(raster_layer):
+    # Stesso GeoPackage di vettorializza_raster, senza i poligoni con "value" pari a 0
+    geopackage_path = f"{os.path.splitext(raster_layer.source())[0]}_buildings.gpkg"
+    polygonize_mask(raster_layer, geopackage_path, merge_seams=MERGE_SEAMS, simplify=SIMPLIFY)
+    return QgsVectorLayer(geopackage_path, 'buildings', 'ogr')
+
 # Funzione per rimuovere i poligoni con "value" pari a 0
 def rimuovi_poligoni_zero(vector_layer):
     # Inizia la modifica del layer
@@ -61,11 +88,15 @@ raster_layers = [layer for layer in project.mapLayers().values() if layer.name()
 
 # Itera su ogni layer raster trovato
 for raster_layer in raster_layers:
-    # Vettorializza il raster
-    vector_layer = vettorializza_raster(raster_layer)
-    
-    # Rimuovi i poligoni con "value" pari a 0
-    rimuovi_poligoni_zero(vector_layer)
+    if STREAMED:
+        # Vettorializza solo i pixel degli edifici
+        vector_layer = vettorializza_edifici(raster_layer)
+    else:
+        # Vettorializza il raster
+        vector_layer = vettorializza_raster(raster_layer)
+        
+        # Rimuovi i poligoni con "value" pari a 0
+        rimuovi_poligoni_zero(vector_layer)
     
     # Trova il gruppo del raster originale
     root = project.layerTreeRoot()
@@ -1,7 +1,14 @@
 import os
-from qgis.core import QgsProject, QgsRasterLayer, QgsVectorLayer, QgsMessageLog, Qgis
+import sys
+from qgis.core import QgsProject, QgsRasterLayer, QgsMessageLog, Qgis
 from qgis.utils import iface
-from qgis import processing
+
+try:
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+except NameError:
+    pass  # Console di QGIS: la cartella "scripts" deve essere già nel sys.path
+
+from fetch.landcover import build_landcover_raster
 
 def get_layer(layer_name):
     return QgsProject.instance().mapLayersByName(layer_name)[0] if QgsProject.instance().mapLayersByName(layer_name) else None
@@ -12,74 +19,21 @@ def log_message(message, level=Qgis.Info):
 
 # 1. Layer verification
 class_layer = get_layer("class")
-buildings_layer = get_layer("buildings")
+mask_layer = get_layer("mask")
 
-if not class_layer or not buildings_layer:
-    log_message("Error: 'class' or 'buildings' layer not found in the project.", Qgis.Critical)
+if not class_layer or not mask_layer:
+    log_message("Error: 'class' or 'mask' layer not found in the project.", Qgis.Critical)
     raise Exception("Missing layers")
 
-if not isinstance(class_layer, QgsRasterLayer) or not isinstance(buildings_layer, QgsVectorLayer):
+if not isinstance(class_layer, QgsRasterLayer) or not isinstance(mask_layer, QgsRasterLayer):
     log_message("Error: Incorrect layer type.", Qgis.Critical)
     raise Exception("Invalid layer type")
 
-# 2. Raster remapping
-log_message("Starting raster remapping...")
-remapped_raster = processing.run("qgis:reclassifybytable", {
-    'INPUT_RASTER': class_layer,
-    'RASTER_BAND': 1,
-    'TABLE': [0, 5, 1, 5, 9, 0],
-    'NO_DATA': -9999,
-    'RANGE_BOUNDARIES': 0,
-    'NODATA_FOR_MISSING': False,
-    'DATA_TYPE': 5,
-    'OUTPUT': 'TEMPORARY_OUTPUT'
-})['OUTPUT']
-
-# Add remapped layer to the project
-remapped_layer = QgsRasterLayer(remapped_raster, "Remapped Raster")
-QgsProject.instance().addMapLayer(remapped_layer)
-log_message("Remapped raster added to the project.")
-
-# 3. Rasterization of vector layer
-log_message("Starting vector layer rasterization...")
-rasterized_buildings = processing.run("gdal:rasterize", {
-    'INPUT': buildings_layer,
-    'FIELD': '',
-    'BURN': 2,
-    'UNITS': 1,
-    'WIDTH': class_layer.rasterUnitsPerPixelX(),
-    'HEIGHT': class_layer.rasterUnitsPerPixelY(),
-    'EXTENT': class_layer.extent(),
-    'NODATA': 0,
-    'OUTPUT': 'TEMPORARY_OUTPUT'
-})['OUTPUT']
-
-# 4. Raster combination
-log_message("Combining rasters...")
-final_raster = processing.run("gdal:merge", {
-    'INPUT': [remapped_raster, rasterized_buildings],
-    'PCT': False,
-    'SEPARATE': False,
-    'NODATA_INPUT': None,
-    'NODATA_OUTPUT': None,
-    'OPTIONS': '',
-    'PSEUDO_COLOR_TABLE': '',
-    'OUTPUT': 'TEMPORARY_OUTPUT'
-})['OUTPUT']
-
-# 5. Saving and adding the resulting raster
-log_message("Saving the final raster...")
+# 2. Remapping (0-5 -> 1, 5-9 -> 0) and buildings from the mask (-> 2), in one
+#    block-wise pass with no temporary rasters
+log_message("Building the land cover raster...")
 output_path = os.path.join(os.path.dirname(class_layer.source()), "raster_modified.tif")
-processing.run("gdal:translate", {
-    'INPUT': final_raster,
-    'TARGET_CRS': None,
-    'NODATA': None,
-    'COPY_SUBDATASETS': False,
-    'OPTIONS': '',
-    'EXTRA': '',
-    'DATA_TYPE': 0,
-    'OUTPUT': output_path
-})
+build_landcover_raster(class_layer, mask_layer, output_path)
 
 # Add final raster to the project
 final_layer = QgsRasterLayer(output_path, "pervius_impervius_buildings")
@@ -91,7 +45,7 @@ else:
 
 log_message("Process completed successfully!")
 
-# 6. Remove all temporary layers
+# 3. Remove all temporary layers
 log_message("Removing temporary layers...")
 project = QgsProject.instance()
 temporary_layers = [layer for layer in project.mapLayers().values() if layer.isTemporary()]
@@ -99,7 +53,7 @@ for layer in temporary_layers:
     project.removeMapLayer(layer.id())
 log_message(f"Removed {len(temporary_layers)} temporary layers.")
 
-# 7. Manage layers with duplicate names
+# 4. Manage layers with duplicate names
 log_message("Managing layers with duplicate names...")
 layer_names = {}
 layers_to_remove = []
@@ -1,5 +1,21 @@
-from qgis.core import QgsPointXY, edit, QgsMessageLog
-from PyQt5.QtCore import QVariant
+import os
+import sys
+import numpy as np
+from qgis.core import QgsMessageLog
+
+try:
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+except NameError:
+    pass  # Console di QGIS: la cartella "scripts" deve essere già nel sys.path
+
+from fetch import raster as fetch_raster
+from fetch.cells import CellLabels, cell_fids, select_cells
+from fetch.incremental import stale_cells
+from fetch.landcover import landcover_percentages
+from fetch.qgis_io import cell_store, cells_from_layer, fingerprint_store
+
+# Processi per il calcolo per cella (1 = sequenziale; il parallelo richiede fork, quindi non Windows)
+WORKERS = 1
 
 def log_message(message):
     print(message)
@@ -12,73 +28,37 @@ vector_layer = QgsProject.instance().mapLayersByName("grid")[0]
 log_message(f"Raster layer: {raster_layer.name()}")
 log_message(f"Vector layer: {vector_layer.name()}")
 
-# Verifica che i campi necessari esistano
-required_fields = ['perc_impervious', 'perc_pervious', 'perc_buildings']
-existing_fields = [field.name() for field in vector_layer.fields()]
-
-for field in required_fields:
-    if field not in existing_fields:
-        log_message(f"Campo mancante: {field}. Aggiunta in corso...")
-        vector_layer.dataProvider().addAttributes([QgsField(field, QVariant.Double)])
-        vector_layer.updateFields()
-
-# Funzione per calcolare le percentuali per una singola feature
-def calculate_percentages(feature, raster_layer):
-    geometry = feature.geometry()
-    if not geometry:
-        log_message(f"Geometria non valida per la feature {feature.id()}")
-        return None
-
-    extent = geometry.boundingBox()
-    raster_data_provider = raster_layer.dataProvider()
-    xres = raster_layer.rasterUnitsPerPixelX()
-    yres = raster_layer.rasterUnitsPerPixelY()
-    
-    cols = int((extent.xMaximum() - extent.xMinimum()) / xres)
-    rows = int((extent.yMaximum() - extent.yMinimum()) / yres)
-    
-    block = raster_data_provider.block(1, extent, cols, rows)
-    
-    counts = {0: 0, 1: 0, 2: 0}
-    total_pixels = 0
-    
-    for row in range(rows):
-        for col in range(cols):
-            value = block.value(row, col)
-            if value in counts:
-                point = QgsPointXY(extent.xMinimum() + (col + 0.5) * xres,
-                                   extent.yMaximum() - (row + 0.5) * yres)
-                if geometry.contains(point):
-                    counts[value] += 1
-                    total_pixels += 1
-    
-    if total_pixels > 0:
-        return {
-            'perc_impervious': (counts[0] / total_pixels) * 100,
-            'perc_pervious': (counts[1] / total_pixels) * 100,
-            'perc_buildings': (counts[2] / total_pixels) * 100
-        }
-    else:
-        log_message(f"Nessun pixel trovato per la feature {feature.id()}")
-        return None
-
-# Calcola le percentuali per tutte le feature
+# Calcola le percentuali per tutte le feature in un solo passaggio sul raster
 feature_count = vector_layer.featureCount()
 log_message(f"Numero totale di feature: {feature_count}")
 
-with edit(vector_layer):
-    for current, feature in enumerate(vector_layer.getFeatures(), 1):
-        if current % 100 == 0:
-            log_message(f"Elaborazione feature {current}/{feature_count}")
-        
-        percentages = calculate_percentages(feature, raster_layer)
-        if percentages:
-            vector_layer.changeAttributeValues(feature.id(), {
-                vector_layer.fields().indexOf(field): value
-                for field, value in percentages.items()
-            })
-        else:
-            log_message(f"Impossibile calcolare le percentuali per la feature {feature.id()}")
+# Ricalcola solo le celle i cui pixel sono cambiati dall'ultima esecuzione (impronte accanto a grid.gpkg)
+cells = cells_from_layer(vector_layer)
+cell_data = cell_store(vector_layer, cells)
+store = fingerprint_store(vector_layer)
+fingerprints, stale = stale_cells(store, 'landcover', cells, [raster_layer])
+if 'perc_impervious' not in cell_data:
+    stale[:] = True
+changed_cells = select_cells(cells, stale)
+log_message(f"Celle da ricalcolare: {len(changed_cells)} su {len(cells)}")
+
+if changed_cells:
+    raster_info = fetch_raster.raster_info(raster_layer)
+    cell_labels = CellLabels(changed_cells, raster_info)
+    if not cell_labels.is_regular:
+        log_message("Griglia non regolare: le celle vengono rasterizzate con il test punto-in-poligono")
+
+    percentages = landcover_percentages(raster_layer, cell_labels, workers=WORKERS)
+
+    missing = np.isnan(percentages['perc_impervious'])
+    for fid in cell_labels.fids[missing]:
+        log_message(f"Nessun pixel trovato per la feature {fid}")
+
+    # Le percentuali vanno nell'archivio per cella (grid.gpkg.cells): la griglia
+    # viene aggiornata solo all'esportazione (script 14)
+    cell_data.write(cell_labels.fids, percentages)
+    if store is not None:
+        store.save('landcover', cell_fids(cells), fingerprints)
 
 log_message("Calcolo delle percentuali completato")
 
@@ -87,17 +67,13 @@ log_message("Verifica dei risultati:")
 required_fields = ['perc_impervious', 'perc_pervious', 'perc_buildings']
 
 for field in required_fields:
-    field_index = vector_layer.fields().indexOf(field)
-    values = []
-    for feature in vector_layer.getFeatures():
-        value = feature[field]
-        if value is not None and value != NULL:
-            values.append(value)
+    values = cell_data.read(field)
+    values = values[~np.isnan(values)]
     
-    if values:
-        min_value = min(values)
-        max_value = max(values)
-        mean_value = sum(values) / len(values)
+    if len(values):
+        min_value = values.min()
+        max_value = values.max()
+        mean_value = values.mean()
         log_message(f"{field} - Min: {min_value:.2f}, Max: {max_value:.2f}, Media: {mean_value:.2f}")
     else:
         log_message(f"{field} - Nessun valore valido trovato")
@@ -1,10 +1,15 @@
 import os
-from qgis.core import (QgsProject, QgsRasterLayer, QgsProcessingFeedback,
-                       QgsProcessingException)
-from qgis.analysis import QgsNativeAlgorithms
-import processing
+import sys
+from qgis.core import QgsProject, QgsRasterLayer
 import tempfile
 
+try:
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+except NameError:
+    pass  # Console di QGIS: la cartella "scripts" deve essere già nel sys.path
+
+from fetch.dtm import dsm_to_dtm
+
 def check_layer_exists(layer_name):
     """
     Verifica se un layer con il nome specificato esiste nel progetto.
@@ -17,21 +22,6 @@ def check_layer_exists(layer_name):
         raise ValueError(f"Layer '{layer_name}' non trovato nel progetto.")
     return layers[0]
 
-def run_processing_algorithm(algorithm, params, feedback):
-    """
-    Esegue un algoritmo di processing e gestisce le eccezioni.
-    
-    :param algorithm: Nome dell'algoritmo
-    :param params: Parametri dell'algoritmo
-    :param feedback: Oggetto QgsProcessingFeedback
-    :return: Risultato dell'algoritmo
-    """
-    try:
-        result = processing.run(algorithm, params, feedback=feedback)
-        return result
-    except QgsProcessingException as e:
-        raise RuntimeError(f"Errore nell'esecuzione dell'algoritmo {algorithm}: {str(e)}")
-
 def add_layer_to_project(layer_path, layer_name):
     """
     Aggiunge un layer raster al progetto QGIS.
@@ -50,8 +40,6 @@ def dsm_to_dtm_process():
     """
     Funzione principale per convertire DSM in DTM.
     """
-    feedback = QgsProcessingFeedback()
-    
     # 1. Identificazione dei layer DSM e mask
     try:
         dsm_layer = check_layer_exists("dsm")
@@ -59,46 +47,10 @@ def dsm_to_dtm_process():
     except ValueError as e:
         raise RuntimeError(str(e))
     
-    # 2. Calcolo della pendenza
-    slope_output = tempfile.NamedTemporaryFile(suffix='.tif', delete=False).name
-    slope_params = {
-        'INPUT': dsm_layer,
-        'Z_FACTOR': 1,
-        'OUTPUT': slope_output
-    }
-    run_processing_algorithm("native:slope", slope_params, feedback)
-    # Layer "Pendenza" non viene aggiunto al progetto
-    
-    # 3. Filtraggio basato sulla pendenza usando r.mapcalc
-    filtered_output = tempfile.NamedTemporaryFile(suffix='.tif', delete=False).name
-    expression = 'if(A <= 5.71, B, null())'
-    mapcalc_params = {
-        'a': slope_output,
-        'b': dsm_layer.source(),
-        'expression': expression,
-        'output': filtered_output,
-        'GRASS_REGION_PARAMETER': None,
-        'GRASS_REGION_CELLSIZE_PARAMETER': 0,
-        'GRASS_RASTER_FORMAT_OPT': '',
-        'GRASS_RASTER_FORMAT_META': ''
-    }
-    run_processing_algorithm("grass7:r.mapcalc.simple", mapcalc_params, feedback)
-    # Layer "DSM_filtrato" non viene aggiunto al progetto
-    
-    # 4. Applicazione della maschera
+    # 2. Pendenza, filtro (<= 5.71 gradi) e maschera degli edifici in un solo
+    #    passaggio a blocchi, senza raster intermedi
     masked_output = tempfile.NamedTemporaryFile(suffix='.tif', delete=False).name
-    mask_expression = 'A * (B != 1)'
-    mask_params = {
-        'a': filtered_output,
-        'b': mask_layer.source(),
-        'expression': mask_expression,
-        'output': masked_output,
-        'GRASS_REGION_PARAMETER': None,
-        'GRASS_REGION_CELLSIZE_PARAMETER': 0,
-        'GRASS_RASTER_FORMAT_OPT': '',
-        'GRASS_RASTER_FORMAT_META': ''
-    }
-    run_processing_algorithm("grass7:r.mapcalc.simple", mask_params, feedback)
+    dsm_to_dtm(dsm_layer, mask_layer, masked_output)
     add_layer_to_project(masked_output, "dtm")
     
     print("Processo completato. Il layer risultante 'DSM_mascherato' è stato aggiunto al progetto.")
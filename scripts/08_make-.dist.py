@@ -1,7 +1,29 @@
 from qgis.core import *
-import processing
-import math
-import statistics
+import os
+import sys
+import tempfile
+
+try:
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+except NameError:
+    pass  # Console di QGIS: la cartella "scripts" deve essere già nel sys.path
+
+from fetch import raster as fetch_raster
+from fetch.cache import StageCache
+from fetch.cells import CellLabels, cell_fids, select_cells
+from fetch.distance import distance_raster
+from fetch.incremental import stale_cells
+from fetch.qgis_io import cell_store, cells_from_layer, fingerprint_store
+from fetch.zonal import median_by_cell
+
+# Processi per il calcolo per cella (1 = sequenziale; il parallelo richiede fork, quindi non Windows)
+WORKERS = 1
+
+# Distanze in metri ('pixel' come il default di gdal:proximity) e distanza
+# massima oltre la quale si scrive nodata (None = nessun limite; se indicata
+# il raster è elaborato a strisce con WORKERS processi)
+DISTANCE_UNITS = 'geo'
+MAX_DISTANCE = None
 
 def get_layers():
     # Ottiene tutti i layer caricati nel progetto QGIS
@@ -26,21 +48,27 @@ def get_layers():
     return mask_layer, grid_layer
 
 def calculate_distance_raster(binary_raster_layer):
-    # Calcola il raster delle distanze utilizzando il processo "Prossimità (distanza raster)"
-    output_path = '/tmp/distance_raster.tif'  # Definisci il percorso di output per il raster delle distanze
-
-    # Esegui il processo di prossimità
-    params = {
-        'INPUT': binary_raster_layer,
-        'BAND': 1,  # Banda da utilizzare, di solito la prima
-        'VALUES': '1',  # Calcola la distanza dai pixel con valore 1 (edifici)
-        'OUTPUT': output_path
-    }
-
-    result = processing.run("gdal:proximity", params)
+    # Il raster delle distanze dipende solo dalla maschera (per un VRT anche dai tile a cui rimanda):
+    # se è invariata si riusa quello in cache
+    cache = StageCache()
+    params = {'VALUES': '1', 'units': DISTANCE_UNITS, 'max_distance': MAX_DISTANCE}
+    key = cache.key('proximity', 2, fetch_raster.raster_inputs('mask', binary_raster_layer), params)
+    entry = cache.get(key)
+
+    if entry is None:
+        # Trasformata della distanza euclidea esatta dai pixel con valore 1 (edifici),
+        # scritta in una cartella temporanea propria di questa esecuzione
+        output_dir = tempfile.mkdtemp()
+        output_path = os.path.join(output_dir, 'distance_raster.tif')
+        distance_raster(binary_raster_layer, output_path, values=(1,), units=DISTANCE_UNITS,
+                        max_distance=MAX_DISTANCE, workers=WORKERS)
+        entry = cache.put(key, files={'distance': output_path})
+        os.rmdir(output_dir)
+    else:
+        print("Maschera invariata: riuso del raster delle distanze in cache.")
 
     # Carica il raster delle distanze risultante
-    distance_raster_layer = QgsRasterLayer(result['OUTPUT'], "Distance Raster")
+    distance_raster_layer = QgsRasterLayer(entry['files']['distance'], "Distance Raster")
     
     if not distance_raster_layer.isValid():
         print("Errore durante la creazione del raster delle distanze.")
@@ -60,65 +88,30 @@ def calculate_median_distance(raster_layer, vector_layer):
         print("Errore: uno o entrambi i layer non sono validi.")
         return
 
-    # Aggiunge un campo per la mediana se non esiste già
-    provider = vector_layer.dataProvider()
     field_name = 'median_dist'
 
-    if vector_layer.fields().indexOf(field_name) == -1:
-        provider.addAttributes([QgsField(field_name, QVariant.Double)])
-        vector_layer.updateFields()
-
-    idx = vector_layer.fields().indexOf(field_name)
-
-    # Inizia la modifica del layer vettoriale
-    vector_layer.startEditing()
-
-    features = vector_layer.getFeatures()
-    total_features = vector_layer.featureCount()
-
-    for current, feature in enumerate(features, 1):
-        geom = feature.geometry()
-        values = []
-
-        # Ottieni l'estensione del poligono
-        extent = geom.boundingBox()
-        intersection = extent.intersect(raster_layer.extent())
-
-        if intersection.isEmpty():
-            median_value = None
-        else:
-            # Definisci la risoluzione del raster
-            pixel_size_x = raster_layer.rasterUnitsPerPixelX()
-            pixel_size_y = raster_layer.rasterUnitsPerPixelY()
-            cols = int(intersection.width() / pixel_size_x)
-            rows = int(intersection.height() / pixel_size_y)
-
-            # Evita dimensioni negative o zero
-            if cols <= 0 or rows <= 0:
-                median_value = None
-            else:
-                # Crea un blocco raster dell'area di interesse
-                block = raster_layer.dataProvider().block(1, intersection, cols, rows)
-                for i in range(cols):
-                    for j in range(rows):
-                        val = block.value(i, j)
-                        if val != 0 and not math.isnan(val):
-                            values.append(val)
-                if values:
-                    median_value = statistics.median(values)
-                else:
-                    median_value = None
-
-        # Aggiorna l'attributo della feature
-        vector_layer.changeAttributeValue(feature.id(), idx, median_value)
-
-        # Aggiorna la barra di avanzamento
-        percent = int((current / total_features) * 100)
-        print(f"\rProgresso: {percent}%", end="", flush=True)
-
-    # Salva le modifiche
-    vector_layer.commitChanges()
-    print("\nCalcolo completato. La colonna 'median_dist' è stata aggiunta o aggiornata nel layer vettoriale.")
+    # Solo le celle le cui distanze sono cambiate dall'ultima esecuzione (impronte accanto a grid.gpkg)
+    cells = cells_from_layer(vector_layer)
+    cell_data = cell_store(vector_layer, cells)
+    store = fingerprint_store(vector_layer)
+    params = {'exclude_zero': True}
+    fingerprints, stale = stale_cells(store, field_name, cells, [raster_layer], params=params)
+    if field_name not in cell_data:
+        stale[:] = True
+    changed_cells = select_cells(cells, stale)
+    print(f"Celle da ricalcolare: {len(changed_cells)} su {len(cells)}")
+    if not changed_cells:
+        return
+
+    # Mediana per cella con un ordinamento per (cella, valore), letta a blocchi:
+    # esclude i pixel a 0 e NaN; le celle senza pixel validi restano NULL
+    cell_labels = CellLabels(changed_cells, fetch_raster.raster_info(raster_layer))
+    medians = median_by_cell(raster_layer, cell_labels, exclude_zero=True, workers=WORKERS)
+
+    cell_data.write(cell_labels.fids, {field_name: medians})
+    if store is not None:
+        store.save(field_name, cell_fids(cells), fingerprints)
+    print("Calcolo completato. La colonna 'median_dist' è stata aggiornata nell'archivio per cella (grid.gpkg.cells).")
 
 # Ottieni i layer automaticamente
 binary_raster_layer, vector_layer = get_layers()
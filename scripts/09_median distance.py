@@ -1,8 +1,34 @@
 from qgis.core import *
 from qgis.PyQt.QtCore import QVariant
-import processing
-import math
-import statistics
+import os
+import sys
+import tempfile
+
+try:
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+except NameError:
+    pass  # Console di QGIS: la cartella "scripts" deve essere già nel sys.path
+
+from fetch import raster as fetch_raster
+from fetch.cache import StageCache
+from fetch.cells import CellLabels, cell_fids, select_cells
+from fetch.distance import distance_raster
+from fetch.incremental import stale_cells
+from fetch.qgis_io import cell_store, cells_from_layer, fingerprint_store
+from fetch.zonal import median_by_cell
+
+# Processi per il calcolo per cella (1 = sequenziale; il parallelo richiede fork, quindi non Windows)
+WORKERS = 1
+
+# Mediane approssimate con errore di rango al più MEDIAN_ERROR (frazione dei pixel
+# della cella, ad es. 0.01) e memoria fissa per cella; None = mediane esatte
+MEDIAN_ERROR = None
+
+# Distanze in metri ('pixel' come il default di gdal:proximity) e distanza
+# massima oltre la quale si scrive nodata (None = nessun limite; se indicata
+# il raster è elaborato a strisce con WORKERS processi)
+DISTANCE_UNITS = 'geo'
+MAX_DISTANCE = None
 
 # Funzione per ottenere i layer automaticamente
 def get_layers():
@@ -19,17 +45,25 @@ def get_layers():
 
 def calculate_distance_raster(binary_raster_layer):
     print("Calcolo del raster delle distanze...")
-    output_path = '/tmp/distance_raster.tif'
-    
-    params = {
-        'INPUT': binary_raster_layer,
-        'BAND': 1,
-        'VALUES': '1',
-        'OUTPUT': output_path
-    }
-
-    result = processing.run("gdal:proximity", params)
-    distance_raster_layer = QgsRasterLayer(result['OUTPUT'], "Distance Raster")
+    # Il raster delle distanze dipende solo dalla maschera (per un VRT anche dai tile a cui rimanda):
+    # se è invariata si riusa quello in cache
+    cache = StageCache()
+    params = {'VALUES': '1', 'units': DISTANCE_UNITS, 'max_distance': MAX_DISTANCE}
+    key = cache.key('proximity', 2, fetch_raster.raster_inputs('mask', binary_raster_layer), params)
+    entry = cache.get(key)
+
+    if entry is None:
+        # Trasformata della distanza esatta, in una cartella propria di questa esecuzione
+        output_dir = tempfile.mkdtemp()
+        output_path = os.path.join(output_dir, 'distance_raster.tif')
+        distance_raster(binary_raster_layer, output_path, values=(1,), units=DISTANCE_UNITS,
+                        max_distance=MAX_DISTANCE, workers=WORKERS)
+        entry = cache.put(key, files={'distance': output_path})
+        os.rmdir(output_dir)
+    else:
+        print("Maschera invariata: riuso del raster delle distanze in cache.")
+
+    distance_raster_layer = QgsRasterLayer(entry['files']['distance'], "Distance Raster")
     
     if not distance_raster_layer.isValid():
         raise ValueError("Errore durante la creazione del raster delle distanze.")
@@ -41,56 +75,34 @@ def calculate_distance_raster(binary_raster_layer):
 def calculate_median_distance(raster_layer, vector_layer):
     print("Inizio calcolo della distanza mediana per ogni feature del layer grid...")
     
-    provider = vector_layer.dataProvider()
     field_name = 'median_dist'
 
-    if vector_layer.fields().indexOf(field_name) == -1:
-        provider.addAttributes([QgsField(field_name, QVariant.Double)])
-        vector_layer.updateFields()
-        print(f"Campo '{field_name}' aggiunto al layer grid.")
-
-    idx = vector_layer.fields().indexOf(field_name)
-    vector_layer.startEditing()
-
-    features = vector_layer.getFeatures()
-    total_features = vector_layer.featureCount()
-
-    for current, feature in enumerate(features, 1):
-        geom = feature.geometry()
-        values = []
-        extent = geom.boundingBox()
-        intersection = extent.intersect(raster_layer.extent())
-
-        if intersection.isEmpty():
-            median_value = 0.001  # Valore piccolo invece di None
-        else:
-            pixel_size_x = raster_layer.rasterUnitsPerPixelX()
-            pixel_size_y = raster_layer.rasterUnitsPerPixelY()
-            cols = int(intersection.width() / pixel_size_x)
-            rows = int(intersection.height() / pixel_size_y)
-
-            if cols <= 0 or rows <= 0:
-                median_value = 0.001  # Valore piccolo invece di None
-            else:
-                block = raster_layer.dataProvider().block(1, intersection, cols, rows)
-                for i in range(cols):
-                    for j in range(rows):
-                        val = block.value(i, j)
-                        if val != 0 and not math.isnan(val):
-                            values.append(val)
-                if values:
-                    median_value = statistics.median(values)
-                else:
-                    median_value = 0.001  # Valore piccolo invece di None
-
-        vector_layer.changeAttributeValue(feature.id(), idx, median_value)
-
-        if current % 100 == 0 or current == total_features:
-            percent = int((current / total_features) * 100)
-            print(f"Progresso: {percent}%")
-
-    vector_layer.commitChanges()
-    print("Calcolo completato. La colonna 'median_dist' è stata aggiunta o aggiornata nel layer grid.")
+    # Solo le celle le cui distanze sono cambiate dall'ultima esecuzione (impronte accanto a grid.gpkg)
+    cells = cells_from_layer(vector_layer)
+    cell_data = cell_store(vector_layer, cells)
+    store = fingerprint_store(vector_layer)
+    params = {'exclude_zero': True, 'empty_value': 0.001}
+    if MEDIAN_ERROR is not None:
+        params['median_error'] = MEDIAN_ERROR
+    fingerprints, stale = stale_cells(store, field_name, cells, [raster_layer], params=params)
+    if field_name not in cell_data:
+        stale[:] = True
+    changed_cells = select_cells(cells, stale)
+    print(f"Celle da ricalcolare: {len(changed_cells)} su {len(cells)}")
+    if not changed_cells:
+        return
+
+    # Mediana per cella con un ordinamento per (cella, valore), letta a blocchi:
+    # esclude i pixel a 0 e NaN; le celle senza pixel validi ricevono 0.001
+    cell_labels = CellLabels(changed_cells, fetch_raster.raster_info(raster_layer))
+    medians = median_by_cell(raster_layer, cell_labels, exclude_zero=True,
+                             empty_value=0.001,  # Valore piccolo invece di None
+                             workers=WORKERS, median_error=MEDIAN_ERROR)
+
+    cell_data.write(cell_labels.fids, {field_name: medians})
+    if store is not None:
+        store.save(field_name, cell_fids(cells), fingerprints)
+    print("Calcolo completato. La colonna 'median_dist' è stata aggiornata nell'archivio per cella (grid.gpkg.cells).")
 
 def main():
     print("Inizio dell'elaborazione...")
@@ -1,5 +1,22 @@
-from qgis.core import QgsProject, QgsProcessingFeedback, QgsMessageLog, Qgis, QgsVectorLayer
-import processing
+import os
+import sys
+import numpy as np
+from qgis.core import QgsProject, QgsMessageLog, Qgis
+
+try:
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+except NameError:
+    pass  # Console di QGIS: la cartella "scripts" deve essere già nel sys.path
+
+from fetch.qgis_io import cell_store, cells_from_layer
+from fetch.zonal import ZonalEngine
+
+# Processi per il calcolo per cella (1 = sequenziale; il parallelo richiede fork, quindi non Windows)
+WORKERS = 1
+
+# Mediane approssimate con errore di rango al più MEDIAN_ERROR (frazione dei pixel
+# della cella, ad es. 0.01) e memoria fissa per cella; None = mediane esatte
+MEDIAN_ERROR = None
 
 def esegui_analisi_zonale():
     QgsMessageLog.logMessage("Inizio dell'esecuzione dello script", "Script Analisi Zonale", level=Qgis.Info)
@@ -21,54 +38,24 @@ def esegui_analisi_zonale():
 
     QgsMessageLog.logMessage("Tutti i layer necessari sono stati trovati", "Script Analisi Zonale", level=Qgis.Info)
 
-    # Moltiplica il layer DSM con il layer MASK usando l'algoritmo di processing "gdal:rastercalculator"
-    QgsMessageLog.logMessage("Inizio moltiplicazione dei layer DSM e MASK", "Script Analisi Zonale", level=Qgis.Info)
-    
-    params = {
-        'INPUT_A': dsm_layer,
-        'BAND_A': 1,
-        'INPUT_B': mask_layer,
-        'BAND_B': 1,
-        'FORMULA': 'A*B',
-        'NO_DATA': None,
-        'RTYPE': 5,  # Float32
-        'OUTPUT': 'TEMPORARY_OUTPUT'
-    }
-    
-    result = processing.run("gdal:rastercalculator", params)
-    temp_layer = result['OUTPUT']
-
-    QgsMessageLog.logMessage("Moltiplicazione dei layer completata", "Script Analisi Zonale", level=Qgis.Info)
-
-    # Calcola la statistica zonale usando l'algoritmo di processing "qgis:zonalstatistics"
+    # Mediana zonale di DSM * MASK in un solo passaggio: il prodotto è calcolato
+    # blocco per blocco, senza raster temporaneo
     QgsMessageLog.logMessage("Inizio calcolo della statistica zonale", "Script Analisi Zonale", level=Qgis.Info)
-    
-    params = {
-        'INPUT_RASTER': temp_layer,
-        'RASTER_BAND': 1,
-        'INPUT_VECTOR': grid_layer,
-        'COLUMN_PREFIX': 'med_',
-        'STATISTICS': [2],  # 2 corrisponde alla mediana
-    }
-    
-    processing.run("qgis:zonalstatistics", params)
+
+    cells = cells_from_layer(grid_layer)
+    engine = ZonalEngine(cells, workers=WORKERS, median_error=MEDIAN_ERROR)
+    engine.add('dsm', dsm_layer)
+    engine.add('mask', mask_layer)
+    engine.add_derived('med', lambda dsm, mask: dsm.astype(np.float32) * mask, ['dsm', 'mask'], ['median'])
+    risultati = engine.run()
 
     QgsMessageLog.logMessage("Calcolo della statistica zonale completato", "Script Analisi Zonale", level=Qgis.Info)
 
-    # Gestione dei valori nulli direttamente sul layer grid
+    # Gestione dei valori nulli: le celle senza pixel validi ricevono 0
     QgsMessageLog.logMessage("Sostituzione dei valori nulli con 0", "Script Analisi Zonale", level=Qgis.Info)
-    
-    # Assicuriamoci che il layer sia in modalità di modifica
-    grid_layer.startEditing()
-
-    # Iterazione sulle features per sostituire i valori nulli con 0
-    for feature in grid_layer.getFeatures():
-        if feature['med_median'] is None:
-            feature['med_median'] = 0
-            grid_layer.updateFeature(feature)
-
-    # Salva le modifiche e esci dalla modalità di modifica
-    grid_layer.commitChanges()
+    mediane = np.nan_to_num(risultati['med']['median'], nan=0.0)
+    # Il risultato va nell'archivio per cella; la griglia viene aggiornata all'esportazione (script 14)
+    cell_store(grid_layer, cells).write(engine.fids, {'med_median': mediane})
 
     QgsMessageLog.logMessage("Sostituzione dei valori nulli completata", "Script Analisi Zonale", level=Qgis.Info)
     QgsMessageLog.logMessage("Script completato con successo", "Script Analisi Zonale", level=Qgis.Success)
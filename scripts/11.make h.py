@@ -1,18 +1,30 @@
-from qgis.core import (QgsProject, QgsVectorLayer, QgsRasterLayer, QgsField,
-                       QgsProcessingFeedback, QgsMessageLog, Qgis, QgsFeatureRequest)
-from qgis.PyQt.QtCore import QVariant
+from qgis.core import (QgsProject, QgsVectorLayer, QgsRasterLayer,
+                       QgsProcessingFeedback, QgsMessageLog, Qgis)
 from qgis.utils import iface
-import processing
+import os
+import sys
 import traceback
 
-class CustomFeedback(QgsProcessingFeedback):
-    def __init__(self):
-        super().__init__()
-        self.error_message = ""
+import numpy as np
 
-    def reportError(self, error, fatalError=False):
-        self.error_message += error + "\n"
-        QgsMessageLog.logMessage(f"Error in processing: {error}", "Object Heights", level=Qgis.Critical)
+try:
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+except NameError:
+    pass  # Console di QGIS: la cartella "scripts" deve essere già nel sys.path
+
+from fetch import raster as fetch_raster
+from fetch.cells import cell_fids, select_cells
+from fetch.incremental import stale_cells
+from fetch.qgis_io import cell_store, cells_from_layer, fingerprint_store
+from fetch.roughness import add_roughness_inputs, roughness_columns
+from fetch.zonal import ZonalEngine
+
+# Processi per il calcolo per cella (1 = sequenziale; il parallelo richiede fork, quindi non Windows)
+WORKERS = 1
+
+# Mediane approssimate con errore di rango al più MEDIAN_ERROR (frazione dei pixel
+# della cella, ad es. 0.01) e memoria fissa per cella; None = mediane esatte
+MEDIAN_ERROR = None
 
 def get_layer(layer_name):
     """Ottiene un layer dal progetto corrente."""
@@ -28,93 +40,46 @@ def validate_layers(grid_layer, dtm_layer, dsm_layer):
     if not isinstance(dtm_layer, QgsRasterLayer) or not isinstance(dsm_layer, QgsRasterLayer):
         raise TypeError("I layer 'dtm' e 'dsm' devono essere layer raster.")
 
-def calculate_zonal_stats(grid_layer, raster_layer, output_column):
-    """Calcola le statistiche zonali e aggiorna il layer grid."""
-    feedback = CustomFeedback()
-    new_field = f'{output_column}median'
-    
-    # Verifica se il campo esiste già
-    if new_field not in grid_layer.fields().names():
-        grid_layer.dataProvider().addAttributes([QgsField(new_field, QVariant.Double)])
-        grid_layer.updateFields()
-    
-    field_index = grid_layer.fields().indexFromName(new_field)
-    
-    params = {
-        'INPUT': grid_layer,
-        'INPUT_RASTER': raster_layer,
-        'RASTER_BAND': 1,
-        'COLUMN_PREFIX': '_temp_',
-        'STATISTICS': [3],  # 3 corrisponde alla mediana
-        'OUTPUT': 'memory:'
-    }
+def calculate_zonal_stats(cells, raster_layers, mask_layer=None):
+    """
+    Calcola le mediane zonali di più raster in un solo passaggio.
+
+    Con la maschera degli edifici calcola nella stessa lettura anche la
+    lunghezza di rugosità (z0, zd) e la classe di Davenport (terrain_roughness).
+
+    :return: Coppia (ID delle feature, dizionario campo -> valori)
+    """
+    engine = ZonalEngine(cells, workers=WORKERS, median_error=MEDIAN_ERROR)
+    for prefix, raster_layer in raster_layers.items():
+        engine.add(prefix, raster_layer, ['median'])
+    if mask_layer is not None:
+        engine.add('mask', mask_layer)
+        add_roughness_inputs(engine, dsm='dsm_', dtm='dtm_', mask='mask')
     
     try:
-        result = processing.run("native:zonalstatisticsfb", params, feedback=feedback)
+        results = engine.run()
     except Exception as e:
         QgsMessageLog.logMessage(f"Errore nel calcolo delle statistiche zonali: {str(e)}", "Object Heights", level=Qgis.Critical)
-        if feedback.error_message:
-            raise RuntimeError(f"Errore nel processing: {feedback.error_message}")
         raise
-
-    result_layer = result['OUTPUT']
-    temp_field = '_temp_median'
-    
-    # Creiamo un dizionario per memorizzare i valori calcolati
-    calculated_values = {f.id(): f[temp_field] for f in result_layer.getFeatures()}
-    
-    # Aggiorniamo i valori nel campo esistente
-    with edit(grid_layer):
-        for feature in grid_layer.getFeatures():
-            if feature.id() in calculated_values:
-                grid_layer.changeAttributeValue(feature.id(), field_index, calculated_values[feature.id()])
-            else:
-                QgsMessageLog.logMessage(f"Feature ID {feature.id()} non trovata nei risultati", "Object Heights", level=Qgis.Warning)
-
-    QgsMessageLog.logMessage(f"Campo {new_field} aggiornato con successo", "Object Heights", level=Qgis.Info)
-
-def calculate_roughness_height(grid_layer):
-    """Calcola l'altezza degli elementi di rugosità."""
-    height_field = 'Height_rou'
     
-    # Verifica se il campo esiste già
-    if height_field not in grid_layer.fields().names():
-        grid_layer.dataProvider().addAttributes([QgsField(height_field, QVariant.Double)])
-        grid_layer.updateFields()
+    columns = {f'{prefix}median': results[prefix]['median'] for prefix in raster_layers}
+    if mask_layer is not None:
+        pixel_width = fetch_raster.raster_info(raster_layers['dsm_']).pixel_width
+        columns.update(roughness_columns(results, pixel_width))
+    return engine.fids, columns
+
+def calculate_roughness_height(fids, columns):
+    """Calcola l'altezza degli elementi di rugosità (DSM - DTM) e la aggiunge alle colonne."""
+    height = np.asarray(columns['dsm_median'], dtype=np.float64) - np.asarray(columns['dtm_median'], dtype=np.float64)
+    columns['Height_rou'] = height
     
-    height_idx = grid_layer.fields().indexFromName(height_field)
-    dtm_idx = grid_layer.fields().indexFromName('dtm_median')
-    dsm_idx = grid_layer.fields().indexFromName('dsm_median')
-    
-    count_total = count_success = count_error = count_missing = 0
-    
-    with edit(grid_layer):
-        for feature in grid_layer.getFeatures():
-            count_total += 1
-            dtm_value = feature[dtm_idx]
-            dsm_value = feature[dsm_idx]
-            
-            # Debug: stampa i valori per le prime 10 features
-            if count_total <= 10:
-                QgsMessageLog.logMessage(f"Feature {count_total}: DTM = {dtm_value}, DSM = {dsm_value}", "Object Heights", level=Qgis.Info)
-            
-            if dtm_value is not None and dsm_value is not None and isinstance(dtm_value, (int, float)) and isinstance(dsm_value, (int, float)):
-                try:
-                    height = float(dsm_value) - float(dtm_value)
-                    grid_layer.changeAttributeValue(feature.id(), height_idx, height)
-                    count_success += 1
-                    if count_total % 1000 == 0:
-                        QgsMessageLog.logMessage(f"Processed {count_total} features. Last height: {height}", "Object Heights", level=Qgis.Info)
-                except (ValueError, TypeError) as e:
-                    count_error += 1
-                    QgsMessageLog.logMessage(f"Errore nella conversione dei valori per feature ID {feature.id()}: {str(e)}", "Object Heights", level=Qgis.Warning)
-            else:
-                count_missing += 1
-                QgsMessageLog.logMessage(f"Valori mancanti o non numerici per feature ID {feature.id()}: DTM = {dtm_value}, DSM = {dsm_value}", "Object Heights", level=Qgis.Warning)
+    count_total = len(fids)
+    count_missing = int(np.count_nonzero(np.isnan(height)))
+    for fid in fids[np.isnan(height)][:10]:
+        QgsMessageLog.logMessage(f"Mediane DTM o DSM mancanti per feature ID {fid}", "Object Heights", level=Qgis.Warning)
     
     QgsMessageLog.logMessage(f"Totale features processate: {count_total}", "Object Heights", level=Qgis.Info)
-    QgsMessageLog.logMessage(f"Calcoli riusciti: {count_success}", "Object Heights", level=Qgis.Info)
-    QgsMessageLog.logMessage(f"Errori di conversione: {count_error}", "Object Heights", level=Qgis.Info)
+    QgsMessageLog.logMessage(f"Calcoli riusciti: {count_total - count_missing}", "Object Heights", level=Qgis.Info)
     QgsMessageLog.logMessage(f"Valori mancanti o non numerici: {count_missing}", "Object Heights", level=Qgis.Info)
 
 def calculate_object_heights():
@@ -128,15 +93,43 @@ def calculate_object_heights():
         # Validazione dei layer
         validate_layers(grid_layer, dtm_layer, dsm_layer)
 
-        # 2. Calcolo delle statistiche zonali
-        QgsMessageLog.logMessage("Inizio calcolo statistiche zonali per DTM", "Object Heights", level=Qgis.Info)
-        calculate_zonal_stats(grid_layer, dtm_layer, 'dtm_')
-        QgsMessageLog.logMessage("Inizio calcolo statistiche zonali per DSM", "Object Heights", level=Qgis.Info)
-        calculate_zonal_stats(grid_layer, dsm_layer, 'dsm_')
-
-        # 3. Calcolo dell'altezza degli elementi di rugosità
-        QgsMessageLog.logMessage("Inizio calcolo altezza elementi di rugosità", "Object Heights", level=Qgis.Info)
-        calculate_roughness_height(grid_layer)
+        # La maschera degli edifici è facoltativa: senza, la classe di Davenport non viene calcolata
+        mask_layers = QgsProject.instance().mapLayersByName("mask")
+        mask_layer = mask_layers[0] if mask_layers else None
+        if mask_layer is None:
+            QgsMessageLog.logMessage("Layer 'mask' non trovato: rugosità di Davenport non calcolata", "Object Heights", level=Qgis.Warning)
+
+        # Solo le celle con DTM o DSM cambiati dall'ultima esecuzione (impronte accanto a grid.gpkg)
+        cells = cells_from_layer(grid_layer)
+        cell_data = cell_store(grid_layer, cells)
+        store = fingerprint_store(grid_layer)
+        input_layers = [dtm_layer, dsm_layer] + ([mask_layer] if mask_layer is not None else [])
+        params = {'median_error': MEDIAN_ERROR} if MEDIAN_ERROR is not None else None
+        # Con la maschera anche le celle vicine a una cella cambiata: il salto di altezza
+        # della rugosità usa il primo pixel della cella a destra
+        fingerprints, stale = stale_cells(store, 'object_heights', cells, input_layers, params=params,
+                                          neighbours=mask_layer is not None)
+        if 'Height_rou' not in cell_data or (mask_layer is not None and 'terrain_roughness' not in cell_data):
+            stale[:] = True
+        changed_cells = select_cells(cells, stale)
+        QgsMessageLog.logMessage(f"Celle da ricalcolare: {len(changed_cells)} su {len(cells)}", "Object Heights", level=Qgis.Info)
+
+        if changed_cells:
+            # 2. Calcolo delle statistiche zonali
+            QgsMessageLog.logMessage("Inizio calcolo statistiche zonali per DTM e DSM", "Object Heights", level=Qgis.Info)
+            fids, columns = calculate_zonal_stats(changed_cells, {'dtm_': dtm_layer, 'dsm_': dsm_layer}, mask_layer)
+
+            # 3. Calcolo dell'altezza degli elementi di rugosità
+            QgsMessageLog.logMessage("Inizio calcolo altezza elementi di rugosità", "Object Heights", level=Qgis.Info)
+            calculate_roughness_height(fids, columns)
+
+            # 4. Mediane e altezze nell'archivio per cella (grid.gpkg.cells), esportate nella griglia dallo script 14
+            cell_data.write(fids, columns)
+            for new_field in columns:
+                QgsMessageLog.logMessage(f"Campo {new_field} aggiornato con successo", "Object Heights", level=Qgis.Info)
+
+            if store is not None:
+                store.save('object_heights', cell_fids(cells), fingerprints)
 
         # Aggiorna il layer nella mappa
         grid_layer.triggerRepaint()
@@ -0,0 +1,83 @@
+from qgis.core import QgsProject, Qgis
+from qgis.utils import iface
+import os
+import sys
+
+import numpy as np
+
+try:
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+except NameError:
+    pass  # Console di QGIS: la cartella "scripts" deve essere già nel sys.path
+
+from fetch import raster as fetch_raster
+from fetch.cells import CellLabels
+from fetch.qgis_io import cell_store, cells_from_layer
+from fetch.svf import sky_view_factor_by_cell
+
+# Processi per il calcolo per cella (1 = sequenziale; il parallelo richiede fork, quindi non Windows)
+WORKERS = 1
+
+# Direzioni e raggio (metri) della ricerca dell'orizzonte
+AZIMUTHS = 16
+RADIUS = 100
+
+# SVF su un pixel ogni STRIDE in righe e colonne (2 basta per la media per cella di un DSM a 0.5 m)
+STRIDE = 1
+
+def get_layer(layer_name):
+    """
+    Funzione per ottenere un layer dal progetto QGIS corrente.
+
+    :param layer_name: Nome del layer da cercare
+    :return: Oggetto layer se trovato, altrimenti None
+    """
+    layers = QgsProject.instance().mapLayersByName(layer_name)
+    return layers[0] if layers else None
+
+def calculate_sky_view_factor(dsm_layer, mask_layer, cells):
+    """
+    Funzione per calcolare lo sky view factor medio per cella dal DSM.
+
+    :param dsm_layer: Layer raster DSM
+    :param mask_layer: Layer raster della maschera degli edifici (None = media su tutti i pixel)
+    :param cells: Celle da calcolare (oggetti Cell)
+    :return: Coppia (ID delle feature, SVF per cella)
+    """
+    cell_labels = CellLabels(cells, fetch_raster.raster_info(dsm_layer))
+    svf = sky_view_factor_by_cell(dsm_layer, cell_labels, mask=mask_layer, azimuths=AZIMUTHS, radius=RADIUS,
+                                  stride=STRIDE, workers=WORKERS)
+    return cell_labels.fids, svf
+
+def main():
+    """
+    Funzione principale dello script.
+    """
+    grid_layer = get_layer('grid')
+    dsm_layer = get_layer('dsm')
+    mask_layer = get_layer('mask')
+    if not grid_layer or not dsm_layer:
+        iface.messageBar().pushMessage("Errore", "Layer 'grid' o 'dsm' non trovato nel progetto.", level=Qgis.Critical)
+        return
+    if not mask_layer:
+        iface.messageBar().pushMessage("Avviso", "Layer 'mask' non trovato: SVF medio su tutti i pixel.", level=Qgis.Warning)
+
+    # Lo SVF di una cella dipende anche dagli edifici vicini (entro RADIUS): si ricalcolano sempre tutte le celle
+    cells = cells_from_layer(grid_layer)
+    cell_data = cell_store(grid_layer, cells)
+    fids, svf = calculate_sky_view_factor(dsm_layer, mask_layer, cells)
+
+    missing = fids[np.isnan(svf)]
+    if len(missing):
+        iface.messageBar().pushMessage("Avviso", f"Nessun pixel valido per {len(missing)} feature (ad es. ID {missing[0]})", level=Qgis.Warning)
+
+    # SVF nell'archivio per cella (grid.gpkg.cells), esportato nella griglia dallo script 14
+    cell_data.write(fids, {'sky_view_factor': svf})
+    valid = svf[~np.isnan(svf)]
+    if len(valid):
+        print(f"sky_view_factor - Min: {valid.min():.2f}, Max: {valid.max():.2f}, Media: {valid.mean():.2f}")
+
+    iface.messageBar().pushMessage("Successo", "Sky view factor calcolato con successo!", level=Qgis.Success)
+
+# Esecuzione dello script
+main()
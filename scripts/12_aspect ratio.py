@@ -1,5 +1,15 @@
-from qgis.core import QgsProject, QgsVectorLayer, QgsField, QgsExpression, QgsFeature, QgsExpressionContext, QgsExpressionContextUtils
-from PyQt5.QtCore import QVariant
+import os
+import sys
+
+import numpy as np
+from qgis.core import QgsProject
+
+try:
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+except NameError:
+    pass  # Console di QGIS: la cartella "scripts" deve essere già nel sys.path
+
+from fetch.qgis_io import cell_store, read_attributes
 
 def find_layer(layer_name):
     """
@@ -9,65 +19,31 @@ def find_layer(layer_name):
     layers = QgsProject.instance().mapLayersByName(layer_name)
     return layers[0] if layers else None
 
-def check_field_exists(layer, field_name):
-    """
-    Verifica se un campo esiste nel layer.
-    """
-    return field_name in [field.name() for field in layer.fields()]
-
-def add_field(layer, field_name, field_type):
-    """
-    Aggiunge un nuovo campo al layer se non esiste già.
-    """
-    if not check_field_exists(layer, field_name):
-        layer.dataProvider().addAttributes([QgsField(field_name, field_type)])
-        layer.updateFields()
-
 def main():
     # Identificazione e selezione del layer "grid"
     grid_layer = find_layer("grid")
     if not grid_layer:
         raise ValueError("Il layer 'grid' non è stato trovato nel progetto.")
 
-    # Verifica della presenza delle colonne richieste
-    required_fields = ["median_dist", "mean_build_height"]
-    for field in required_fields:
-        if not check_field_exists(grid_layer, field):
-            raise ValueError(f"La colonna '{field}' non è presente nel layer 'grid'.")
-
-    # Aggiunta della nuova colonna "aspect_ratio" se non esiste già
-    add_field(grid_layer, "aspect_ratio", QVariant.Double)
-
-    # Inizia la modifica del layer
-    grid_layer.startEditing()
-
-    # Aggiorna i valori di median_dist per essere sempre >= 1 e sostituisce i valori NULL con 1
-    median_dist_idx = grid_layer.fields().indexOf("median_dist")
-    for feature in grid_layer.getFeatures():
-        median_dist = feature["median_dist"]
-        # Controllo per NULL e valori inferiori a 1
-        if median_dist is None or median_dist < 1:
-            grid_layer.changeAttributeValue(feature.id(), median_dist_idx, 1)
-
-    # Calcolo dei valori per la colonna "aspect_ratio"
-    expression = QgsExpression('CASE WHEN "median_dist" < 1 THEN "mean_build_height" ELSE "mean_build_height" / "median_dist" END')
-    context = QgsExpressionContext()
-    context.appendScopes(QgsExpressionContextUtils.globalProjectLayerScopes(grid_layer))
-
-    # Itera attraverso le features e calcola l'aspect_ratio
-    aspect_ratio_idx = grid_layer.fields().indexOf("aspect_ratio")
-    for feature in grid_layer.getFeatures():
-        context.setFeature(feature)
-        aspect_ratio = expression.evaluate(context)
-        grid_layer.changeAttributeValue(feature.id(), aspect_ratio_idx, aspect_ratio)
-
-    # Commit delle modifiche
-    success = grid_layer.commitChanges()
-
-    if success:
-        print("Calcolo dell'aspect_ratio completato con successo.")
-    else:
-        print("Si è verificato un errore durante il calcolo dell'aspect_ratio.")
+    # median_dist dall'archivio per cella (grid.gpkg.cells)
+    cell_data = cell_store(grid_layer)
+    if "median_dist" not in cell_data:
+        raise ValueError("La colonna 'median_dist' non è presente: eseguire prima lo script 08 o 09.")
+    # L'altezza media degli edifici è un campo della griglia, preparato dall'utente a partire
+    # dalle mediane dello script 10 (errore se manca); letta senza geometrie e allineata all'archivio
+    fids, columns = read_attributes(grid_layer, ["mean_build_height"])
+    building_height = np.full(len(cell_data.fids), np.nan)
+    building_height[cell_data.rows(fids)] = columns["mean_build_height"]
+
+    # median_dist sempre >= 1, con i valori NULL sostituiti da 1
+    median_dist = cell_data.read("median_dist").astype(np.float64)
+    median_dist = np.where(np.isnan(median_dist) | (median_dist < 1), 1.0, median_dist)
+
+    # Calcolo dei valori per la colonna "aspect_ratio" (NULL dove manca l'altezza)
+    aspect_ratio = building_height / median_dist
+
+    cell_data.write(cell_data.fids, {"median_dist": median_dist, "aspect_ratio": aspect_ratio})
+    print("Calcolo dell'aspect_ratio completato con successo.")
 
 # Esecuzione dello script
 try:
@@ -1,10 +1,23 @@
 # Importazione delle librerie necessarie
-from qgis.core import (QgsProject, QgsVectorLayer, QgsRasterLayer, 
-                       QgsField, QgsExpression, QgsExpressionContext, 
-                       QgsExpressionContextUtils)
-from qgis.PyQt.QtCore import QVariant
+from qgis.core import QgsProject, Qgis
 from qgis.utils import iface
-import processing
+import os
+import sys
+
+import numpy as np
+
+try:
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+except NameError:
+    pass  # Console di QGIS: la cartella "scripts" deve essere già nel sys.path
+
+from fetch.cells import cell_fids, select_cells
+from fetch.incremental import stale_cells
+from fetch.qgis_io import cell_store, cells_from_layer, fingerprint_store
+from fetch.zonal import ZonalEngine
+
+# Processi per il calcolo per cella (1 = sequenziale; il parallelo richiede fork, quindi non Windows)
+WORKERS = 1
 
 def get_layer(layer_name):
     """
@@ -31,61 +44,32 @@ def check_layers(grid_layer, albedo_layer):
         return False
     return True
 
-def calculate_zonal_statistics(grid_layer, albedo_layer):
+def calculate_zonal_statistics(albedo_layer, cells):
     """
-    Funzione per calcolare le statistiche zonali utilizzando l'algoritmo di processing.
+    Funzione per calcolare la maggioranza zonale dell'albedo con il motore a passaggio singolo.
     
-    :param grid_layer: Layer vettoriale grid
     :param albedo_layer: Layer raster albedo
-    :return: Il nome del campo creato per la maggioranza
+    :param cells: Celle da calcolare (oggetti Cell)
+    :return: Coppia (ID delle feature, maggioranza per cella)
     """
-    # Utilizzo dell'algoritmo 'qgis:zonalstatistics' per calcolare le statistiche
-    params = {
-        'INPUT_RASTER': albedo_layer,
-        'RASTER_BAND': 1,
-        'INPUT_VECTOR': grid_layer,
-        'COLUMN_PREFIX': 'albedo_',
-        'STATISTICS': [9],  # 9 corrisponde alla statistica "Majority"
-    }
-    processing.run("qgis:zonalstatistics", params)
-    
-    # Identifica il campo creato per la maggioranza
-    majority_field = next((field.name() for field in grid_layer.fields() 
-                           if field.name().startswith('albedo_') and field.name().endswith('majority')), None)
-    
-    if majority_field:
-        return majority_field
-    else:
-        iface.messageBar().pushMessage("Errore", "Campo di maggioranza non trovato dopo il calcolo delle statistiche zonali.", level=Qgis.Critical)
-        return None
+    engine = ZonalEngine(cells, workers=WORKERS)
+    engine.add('albedo', albedo_layer, ['majority'])
+    results = engine.run()
+    return engine.fids, results['albedo']['majority']
 
-def normalize_albedo(grid_layer, field_name):
+def normalize_albedo(fids, majority):
     """
     Funzione per normalizzare i valori di albedo.
     
-    :param grid_layer: Layer vettoriale grid
-    :param field_name: Nome del campo contenente i valori di albedo da normalizzare
+    :param fids: ID delle feature
+    :param majority: Maggioranza dell'albedo per cella, in decimillesimi
+    :return: Albedo normalizzato (NaN per le celle senza pixel)
     """
-    # Verifica se il campo esiste
-    if field_name not in [field.name() for field in grid_layer.fields()]:
-        iface.messageBar().pushMessage("Errore", f"Campo '{field_name}' non trovato nel layer.", level=Qgis.Critical)
-        return
-    
-    # Creazione di un'espressione per dividere i valori per 10000
-    expression = QgsExpression(f'"{field_name}" / 10000')
-    context = QgsExpressionContext()
-    context.appendScopes(QgsExpressionContextUtils.globalProjectLayerScopes(grid_layer))
-    
-    # Aggiornamento dei valori
-    with edit(grid_layer):
-        for feature in grid_layer.getFeatures():
-            context.setFeature(feature)
-            new_value = expression.evaluate(context)
-            if new_value is not None:  # Verifica che il nuovo valore non sia None
-                feature[field_name] = new_value
-                grid_layer.updateFeature(feature)
-            else:
-                iface.messageBar().pushMessage("Avviso", f"Valore nullo trovato durante la normalizzazione per la feature ID {feature.id()}", level=Qgis.Warning)
+    albedo = np.asarray(majority, dtype=np.float64) / 10000
+    missing = fids[np.isnan(albedo)]
+    if len(missing):
+        iface.messageBar().pushMessage("Avviso", f"Valore nullo trovato durante la normalizzazione per {len(missing)} feature (ad es. ID {missing[0]})", level=Qgis.Warning)
+    return albedo
 
 def main():
     """
@@ -99,13 +83,25 @@ def main():
     if not check_layers(grid_layer, albedo_layer):
         return
     
-    # Calcolo delle statistiche zonali
-    albedo_field = calculate_zonal_statistics(grid_layer, albedo_layer)
-    if not albedo_field:
+    # Solo le celle con albedo cambiato dall'ultima esecuzione (impronte accanto a grid.gpkg)
+    cells = cells_from_layer(grid_layer)
+    cell_data = cell_store(grid_layer, cells)
+    store = fingerprint_store(grid_layer)
+    fingerprints, stale = stale_cells(store, 'albedo', cells, [albedo_layer])
+    if 'albedo_majority' not in cell_data:
+        stale[:] = True
+    changed_cells = select_cells(cells, stale)
+    if not changed_cells:
+        iface.messageBar().pushMessage("Info", "Albedo invariato: nessuna cella da ricalcolare.", level=Qgis.Info)
         return
     
-    # Normalizzazione dei valori di albedo
-    normalize_albedo(grid_layer, albedo_field)
+    # Calcolo delle statistiche zonali
+    fids, majority = calculate_zonal_statistics(albedo_layer, changed_cells)
+    
+    # Normalizzazione dei valori di albedo, salvati nell'archivio per cella (esportati nella griglia dallo script 14)
+    cell_data.write(fids, {'albedo_majority': normalize_albedo(fids, majority)})
+    if store is not None:
+        store.save('albedo', cell_fids(cells), fingerprints)
     
     iface.messageBar().pushMessage("Successo", "Analisi completata con successo!", level=Qgis.Success)
 
@@ -0,0 +1,11 @@
+"""
+Pacchetto di supporto agli script numerati di FETCH.
+
+Raccoglie i motori di calcolo vettorializzati (NumPy + GDAL) condivisi dagli
+script 01-14, in modo che possano essere usati sia dalla console di QGIS sia
+in modalità headless.
+
+Per usarlo dalla console di QGIS la cartella ``scripts`` deve essere nel
+``sys.path``; gli script numerati la aggiungono automaticamente quando
+``__file__`` è disponibile.
+"""
@@ -0,0 +1,261 @@
+"""
+Cache delle fasi indirizzata per contenuto.
+
+La chiave di una fase è l'hash di: nome e versione della fase, contenuto dei
+raster di input, parametri e colonne per cella da cui dipende. Se nessuno di
+questi cambia, la fase restituisce subito gli artefatti salvati (file e array)
+invece di ricalcolarli. Ad esempio cambiare la dimensione delle celle non
+invalida DTM e raster delle distanze, che non dipendono dalla griglia.
+
+Lo spazio occupato è limitato: oltre ``max_bytes`` vengono eliminate le voci
+usate meno di recente. Le voci lette o salvate da un oggetto StageCache
+restano bloccate fino a ``release()``, perché le fasi successive della stessa
+esecuzione (o i layer QGIS aperti dagli script) leggono i file direttamente
+dalla cache. Il blocco è un file ``.pin-*`` nella cartella della voce, quindi
+vale anche per gli altri processi che usano la stessa cache; i blocchi non
+rilasciati (ad es. da un processo interrotto) scadono dopo ``PIN_SECONDS``.
+
+Le impronte dei file (``hashes.json``) sono condivise tra i processi: ogni
+scrittura rilegge il file e vi unisce le impronte nuove.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import uuid
+
+import numpy as np
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'fetch')
+DEFAULT_MAX_BYTES = 10 * 1024 ** 3
+
+# Durata massima (secondi) del blocco di una voce non rilasciato con release()
+PIN_SECONDS = 24 * 3600
+
+# Dimensione dei blocchi letti per calcolare l'hash dei file
+_HASH_CHUNK = 4 * 1024 * 1024
+
+_PIN_PREFIX = '.pin-'
+
+
+def _json_default(value):
+    """Serializza in JSON i tipi NumPy usati nei parametri."""
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    raise TypeError(f"Parametro non serializzabile: {value!r}")
+
+
+class StageCache:
+    """
+    Cache LRU su disco degli artefatti delle fasi.
+
+    :param root: Cartella della cache (default ``~/.cache/fetch``)
+    :param max_bytes: Spazio massimo occupato dagli artefatti
+    """
+
+    def __init__(self, root=None, max_bytes=DEFAULT_MAX_BYTES):
+        self.root = root or DEFAULT_CACHE_DIR
+        self.max_bytes = max_bytes
+        self._objects = os.path.join(self.root, 'objects')
+        self._hash_index_path = os.path.join(self.root, 'hashes.json')
+        os.makedirs(self._objects, exist_ok=True)
+        self._hash_index = self._load_json(self._hash_index_path, {})
+        # Impronte calcolate da questo oggetto e non ancora scritte in hashes.json
+        self._new_hashes = {}
+        # Chiavi usate in questa esecuzione: non vengono eliminate da evict(), anche di altri processi
+        self._pinned = set()
+        self._pin_name = f'{_PIN_PREFIX}{os.getpid()}-{uuid.uuid4().hex}'
+
+    @staticmethod
+    def _load_json(path, default):
+        try:
+            with open(path, encoding='utf-8') as handle:
+                return json.load(handle)
+        except (OSError, ValueError):
+            return default
+
+    @staticmethod
+    def _write_json(path, data):
+        """Scrive un file JSON in modo atomico."""
+        handle, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(handle, 'w', encoding='utf-8') as output:
+            json.dump(data, output)
+        os.replace(tmp, path)
+
+    def file_digest(self, path):
+        """
+        Hash SHA-256 del contenuto di un file.
+
+        L'hash viene ricalcolato solo se dimensione o data di modifica del file
+        sono cambiate dall'ultima volta.
+        """
+        digest = self._digest(path)
+        self._save_hashes()
+        return digest
+
+    def _digest(self, path):
+        """Come ``file_digest``, senza scrivere ``hashes.json``."""
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        cached = self._hash_index.get(path)
+        if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+        digest = hashlib.sha256()
+        with open(path, 'rb') as handle:
+            for chunk in iter(lambda: handle.read(_HASH_CHUNK), b''):
+                digest.update(chunk)
+        self._hash_index[path] = self._new_hashes[path] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+        return digest.hexdigest()
+
+    def _save_hashes(self):
+        """Unisce le impronte nuove a quelle scritte nel frattempo da altri processi."""
+        if not self._new_hashes:
+            return
+        index = self._load_json(self._hash_index_path, {})
+        index.update(self._new_hashes)
+        self._write_json(self._hash_index_path, index)
+        self._hash_index = index
+        self._new_hashes = {}
+
+    def key(self, stage, version, inputs=None, params=None, arrays=None):
+        """
+        Chiave di una fase.
+
+        :param stage: Nome della fase
+        :param version: Versione dell'algoritmo (da incrementare quando cambia il risultato)
+        :param inputs: Dizionario nome -> percorso dei file di input
+        :param params: Dizionario di parametri serializzabili in JSON
+        :param arrays: Dizionario nome -> array NumPy da cui dipende la fase
+        :return: Stringa esadecimale
+        """
+        digest = hashlib.sha256()
+        header = {
+            'stage': stage,
+            'version': version,
+            'inputs': {name: self._digest(path) for name, path in sorted((inputs or {}).items())},
+            'params': params or {},
+        }
+        self._save_hashes()
+        digest.update(json.dumps(header, sort_keys=True, default=_json_default).encode('utf-8'))
+        for name, values in sorted((arrays or {}).items()):
+            values = np.ascontiguousarray(values)
+            digest.update(f'{name}:{values.dtype.str}:{values.shape}'.encode('utf-8'))
+            digest.update(values.tobytes())
+        return digest.hexdigest()
+
+    def _entry_dir(self, key):
+        return os.path.join(self._objects, key)
+
+    def get(self, key):
+        """
+        Artefatti di una fase già calcolata. La voce resta bloccata fino a ``release()``.
+
+        :return: Dizionario {'files': {nome: percorso}, 'arrays': {nome: array}}
+                 oppure None se la chiave non è in cache
+        """
+        entry_dir = self._entry_dir(key)
+        manifest_path = os.path.join(entry_dir, 'manifest.json')
+        manifest = self._load_json(manifest_path, None)
+        if manifest is None:
+            return None
+        files = {name: os.path.join(entry_dir, filename) for name, filename in manifest['files'].items()}
+        if not all(os.path.exists(path) for path in files.values()):
+            return None
+        arrays = {name: np.load(os.path.join(entry_dir, filename))
+                  for name, filename in manifest['arrays'].items()}
+        # La data di modifica del manifest registra l'ultimo utilizzo (LRU)
+        os.utime(manifest_path)
+        self._pin(key)
+        return {'files': files, 'arrays': arrays}
+
+    def put(self, key, files=None, arrays=None):
+        """
+        Salva gli artefatti di una fase.
+
+        I file vengono spostati nella cache: da quel momento vanno letti dai
+        percorsi restituiti. La voce resta bloccata fino a ``release()``.
+
+        :param files: Dizionario nome -> percorso dei file prodotti
+        :param arrays: Dizionario nome -> array NumPy prodotti
+        :return: Gli artefatti come restituiti da ``get``
+        """
+        entry_dir = self._entry_dir(key)
+        tmp_dir = tempfile.mkdtemp(dir=self._objects, suffix='.tmp')
+        manifest = {'files': {}, 'arrays': {}}
+        for name, path in (files or {}).items():
+            filename = f'{name}{os.path.splitext(path)[1]}'
+            shutil.move(path, os.path.join(tmp_dir, filename))
+            manifest['files'][name] = filename
+        for name, values in (arrays or {}).items():
+            filename = f'{name}.npy'
+            np.save(os.path.join(tmp_dir, filename), np.asarray(values), allow_pickle=False)
+            manifest['arrays'][name] = filename
+        self._write_json(os.path.join(tmp_dir, 'manifest.json'), manifest)
+
+        if os.path.exists(entry_dir):
+            # I blocchi degli altri processi restano sulla voce riscritta
+            for name in os.listdir(entry_dir):
+                if name.startswith(_PIN_PREFIX):
+                    os.replace(os.path.join(entry_dir, name), os.path.join(tmp_dir, name))
+            shutil.rmtree(entry_dir)
+        os.replace(tmp_dir, entry_dir)
+        self._pin(key)
+        self.evict()
+        return self.get(key)
+
+    def _pin(self, key):
+        """Blocca una voce con un file di blocco proprio di questo oggetto."""
+        pin_path = os.path.join(self._entry_dir(key), self._pin_name)
+        with open(pin_path, 'a'):
+            pass
+        os.utime(pin_path)
+        self._pinned.add(key)
+
+    @staticmethod
+    def _is_pinned(path):
+        """True se la voce ha un blocco non scaduto, di qualsiasi processo."""
+        now = time.time()
+        return any(entry.name.startswith(_PIN_PREFIX) and now - entry.stat().st_mtime < PIN_SECONDS
+                   for entry in os.scandir(path))
+
+    @staticmethod
+    def _dir_size(path):
+        return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+    def evict(self):
+        """
+        Elimina le voci usate meno di recente finché la cache supera ``max_bytes``.
+
+        Le voci bloccate non vengono eliminate, anche se la cache resta oltre il limite.
+        """
+        entries = []
+        for entry in os.scandir(self._objects):
+            manifest_path = os.path.join(entry.path, 'manifest.json')
+            if not entry.is_dir() or not os.path.exists(manifest_path):
+                continue
+            entries.append((os.stat(manifest_path).st_mtime, self._dir_size(entry.path), entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if self._is_pinned(path):
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def release(self):
+        """Sblocca le voci usate nell'esecuzione e riporta la cache entro ``max_bytes``."""
+        for key in self._pinned:
+            try:
+                os.remove(os.path.join(self._entry_dir(key), self._pin_name))
+            except OSError:
+                pass  # Voce già eliminata
+        self._pinned.clear()
+        self.evict()
+
+    def clear(self):
+        """Svuota la cache."""
+        shutil.rmtree(self._objects, ignore_errors=True)
+        os.makedirs(self._objects, exist_ok=True)
@@ -0,0 +1,411 @@
+"""
+Assegnazione dei pixel di un raster alle celle della griglia di analisi.
+
+Un pixel appartiene a una cella se il suo centro cade all'interno del poligono
+della cella, come nel test ``geometry.contains(point)`` usato dagli script.
+Per le griglie regolari prodotte da ``native:creategrid`` l'assegnazione si
+riduce ad aritmetica intera; le celle non rettangolari vengono rasterizzate
+una sola volta con un test punto-in-poligono vettorializzato.
+
+Una griglia di celle quadrate può anche restare implicita (``RasterGrid``):
+origine, lato e numero di righe e colonne bastano a calcolare le etichette
+dei pixel con divisioni intere, senza leggere né creare i poligoni, che
+vengono costruiti solo quando servono (ad esempio per l'esportazione).
+"""
+import json
+import os
+
+import numpy as np
+
+# Tolleranza relativa usata per riconoscere rettangoli e griglie regolari
+_TOLERANCE = 1e-6
+
+
+class Cell:
+    """
+    Cella della griglia: identificativo della feature e anelli del poligono.
+
+    :param fid: ID della feature nel layer grid
+    :param rings: Lista di anelli, ciascuno una sequenza di coppie (x, y).
+                  Buchi e parti multiple sono gestiti con la regola pari-dispari.
+    """
+
+    def __init__(self, fid, rings):
+        self.fid = fid
+        self.rings = [np.asarray(ring, dtype=np.float64) for ring in rings if len(ring) >= 3]
+        if not self.rings:
+            raise ValueError(f"Geometria non valida per la cella {fid}")
+        points = np.concatenate(self.rings)
+        self.xmin, self.ymin = points.min(axis=0)
+        self.xmax, self.ymax = points.max(axis=0)
+
+    @classmethod
+    def from_bounds(cls, fid, xmin, ymin, xmax, ymax):
+        """Crea una cella rettangolare dai suoi limiti."""
+        return cls(fid, [[(xmin, ymin), (xmax, ymin), (xmax, ymax), (xmin, ymax), (xmin, ymin)]])
+
+    def is_rectangle(self):
+        """True se la cella è un rettangolo allineato agli assi."""
+        if len(self.rings) != 1:
+            return False
+        ring = self.rings[0]
+        if np.allclose(ring[0], ring[-1]):
+            ring = ring[:-1]
+        if len(ring) != 4:
+            return False
+        tol = _TOLERANCE * max(self.xmax - self.xmin, self.ymax - self.ymin)
+        on_x = np.minimum(abs(ring[:, 0] - self.xmin), abs(ring[:, 0] - self.xmax)) <= tol
+        on_y = np.minimum(abs(ring[:, 1] - self.ymin), abs(ring[:, 1] - self.ymax)) <= tol
+        return bool(on_x.all() and on_y.all())
+
+
+def grid_cells(extent, cell_size, first_fid=1):
+    """
+    Celle quadrate che coprono un'estensione, come ``native:creategrid``.
+
+    La griglia parte dall'angolo in alto a sinistra; l'ultima riga e l'ultima
+    colonna possono sporgere oltre l'estensione.
+
+    :param extent: Estensione come (xmin, ymin, xmax, ymax)
+    :param cell_size: Lato della cella in unità di mappa
+    :param first_fid: ID della prima cella (le feature GeoPackage partono da 1)
+    :return: Lista di oggetti Cell, per righe da nord a sud
+    """
+    xmin, ymin, xmax, ymax = extent
+    ncols = max(1, int(np.ceil((xmax - xmin) / cell_size - _TOLERANCE)))
+    nrows = max(1, int(np.ceil((ymax - ymin) / cell_size - _TOLERANCE)))
+    cells = []
+    for row in range(nrows):
+        top = ymax - row * cell_size
+        for col in range(ncols):
+            left = xmin + col * cell_size
+            cells.append(Cell.from_bounds(first_fid + len(cells), left, top - cell_size, left + cell_size, top))
+    return cells
+
+
+# Suffisso del file con la definizione di una griglia implicita, accanto al file della griglia
+GRID_DEFINITION_SUFFIX = '.grid.json'
+
+
+class RasterGrid:
+    """
+    Griglia implicita di celle quadrate, senza poligoni.
+
+    Le celle sono numerate per righe da nord a sud come in ``grid_cells``:
+    la cella in riga ``r`` e colonna ``c`` ha ID ``first_fid + r * ncols + c``.
+    Si comporta come una lista di oggetti Cell (lunghezza, iterazione,
+    indici), ma i poligoni vengono creati solo quando una cella viene letta.
+
+    :param origin_x: X dell'angolo in alto a sinistra
+    :param origin_y: Y dell'angolo in alto a sinistra
+    :param cell_size: Lato della cella in unità di mappa
+    :param ncols: Numero di colonne di celle
+    :param nrows: Numero di righe di celle
+    :param first_fid: ID della prima cella
+    :param index: Posizioni (riga * ncols + colonna) delle celle incluse (default: tutte)
+    """
+
+    def __init__(self, origin_x, origin_y, cell_size, ncols, nrows, first_fid=1, index=None):
+        if cell_size <= 0 or ncols < 1 or nrows < 1:
+            raise ValueError("Lato, righe e colonne della griglia devono essere positivi.")
+        self.origin_x = float(origin_x)
+        self.origin_y = float(origin_y)
+        self.cell_size = float(cell_size)
+        self.ncols = int(ncols)
+        self.nrows = int(nrows)
+        self.first_fid = int(first_fid)
+        self.index = np.arange(self.ncols * self.nrows, dtype=np.int64) if index is None \
+            else np.asarray(index, dtype=np.int64)
+
+    @classmethod
+    def from_extent(cls, extent, cell_size, first_fid=1):
+        """Griglia che copre un'estensione, con le stesse celle di ``grid_cells``."""
+        xmin, ymin, xmax, ymax = extent
+        ncols = max(1, int(np.ceil((xmax - xmin) / cell_size - _TOLERANCE)))
+        nrows = max(1, int(np.ceil((ymax - ymin) / cell_size - _TOLERANCE)))
+        return cls(xmin, ymax, cell_size, ncols, nrows, first_fid)
+
+    @classmethod
+    def beside(cls, grid_path):
+        """Percorso della definizione accanto a un file di griglia: ``<griglia>.grid.json``."""
+        return grid_path + GRID_DEFINITION_SUFFIX
+
+    @classmethod
+    def load(cls, path):
+        """Legge una griglia salvata con ``save``."""
+        with open(path, encoding='utf-8') as handle:
+            definition = json.load(handle)
+        return cls(definition['origin_x'], definition['origin_y'], definition['cell_size'],
+                   definition['ncols'], definition['nrows'], definition.get('first_fid', 1))
+
+    def save(self, path):
+        """Salva la definizione della griglia completa in JSON."""
+        definition = {'origin_x': self.origin_x, 'origin_y': self.origin_y, 'cell_size': self.cell_size,
+                      'ncols': self.ncols, 'nrows': self.nrows, 'first_fid': self.first_fid}
+        tmp = path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as handle:
+            json.dump(definition, handle, indent=2)
+        os.replace(tmp, path)
+        return path
+
+    @property
+    def fids(self):
+        """ID delle celle incluse."""
+        return self.first_fid + self.index
+
+    @property
+    def rows(self):
+        """Riga di ogni cella inclusa (0 = nord)."""
+        return self.index // self.ncols
+
+    @property
+    def cols(self):
+        """Colonna di ogni cella inclusa (0 = ovest)."""
+        return self.index % self.ncols
+
+    @property
+    def extent(self):
+        """Estensione della griglia completa come (xmin, ymin, xmax, ymax)."""
+        return (self.origin_x, self.origin_y - self.nrows * self.cell_size,
+                self.origin_x + self.ncols * self.cell_size, self.origin_y)
+
+    def bounds(self):
+        """Limiti delle celle incluse come array (celle, 4): xmin, ymin, xmax, ymax."""
+        xmin = self.origin_x + self.cols * self.cell_size
+        ymax = self.origin_y - self.rows * self.cell_size
+        return np.column_stack([xmin, ymax - self.cell_size, xmin + self.cell_size, ymax])
+
+    def subset(self, selection):
+        """Griglia con le sole celle selezionate (maschera booleana o posizioni)."""
+        return RasterGrid(self.origin_x, self.origin_y, self.cell_size, self.ncols, self.nrows,
+                          self.first_fid, self.index[selection])
+
+    def cell(self, position):
+        """Cella (con il suo poligono) in una posizione della griglia."""
+        index = int(self.index[position])
+        row, col = divmod(index, self.ncols)
+        xmin = self.origin_x + col * self.cell_size
+        ymax = self.origin_y - row * self.cell_size
+        return Cell.from_bounds(self.first_fid + index, xmin, ymax - self.cell_size, xmin + self.cell_size, ymax)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        return (self.cell(position) for position in range(len(self.index)))
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            return self.cell(key)
+        return self.subset(key)
+
+
+def cell_fids(cells):
+    """ID delle celle (lista di Cell o RasterGrid) come array int64."""
+    if isinstance(cells, RasterGrid):
+        return cells.fids
+    return np.array([cell.fid for cell in cells], dtype=np.int64)
+
+
+def cell_bounds(cells):
+    """Limiti delle celle come array (celle, 4): xmin, ymin, xmax, ymax."""
+    if isinstance(cells, RasterGrid):
+        return cells.bounds()
+    return np.array([(cell.xmin, cell.ymin, cell.xmax, cell.ymax) for cell in cells], dtype=np.float64).reshape(-1, 4)
+
+
+def select_cells(cells, flags):
+    """Celle con flag True; per una griglia implicita il risultato resta implicito."""
+    if isinstance(cells, RasterGrid):
+        return cells.subset(np.asarray(flags, dtype=bool))
+    return [cell for cell, flag in zip(cells, flags) if flag]
+
+
+def cells_touching(cells, extents):
+    """
+    Celle il cui rettangolo di ingombro interseca almeno una delle estensioni.
+
+    :param extents: Sequenza di (xmin, ymin, xmax, ymax)
+    :return: Array booleano allineato a cells
+    """
+    bounds = cell_bounds(cells)
+    touching = np.zeros(len(cells), dtype=bool)
+    for xmin, ymin, xmax, ymax in extents:
+        touching |= ((bounds[:, 0] < xmax) & (bounds[:, 2] > xmin)
+                     & (bounds[:, 1] < ymax) & (bounds[:, 3] > ymin))
+    return touching
+
+
+def points_in_rings(xs, ys, rings):
+    """
+    Test punto-in-poligono pari-dispari, vettorializzato sui punti.
+
+    :param xs: Array delle coordinate X dei punti
+    :param ys: Array delle coordinate Y dei punti (stessa forma di xs)
+    :param rings: Anelli del poligono come array (n, 2)
+    :return: Array booleano con la forma di xs
+    """
+    inside = np.zeros(np.shape(xs), dtype=bool)
+    for ring in rings:
+        closed = ring if np.allclose(ring[0], ring[-1]) else np.vstack([ring, ring[:1]])
+        for (x1, y1), (x2, y2) in zip(closed[:-1], closed[1:]):
+            if y1 == y2:
+                continue
+            crosses = (y1 > ys) != (y2 > ys)
+            x_cross = x1 + (ys - y1) * (x2 - x1) / (y2 - y1)
+            inside ^= crosses & (xs < x_cross)
+    return inside
+
+
+def _first_index(position):
+    """Primo indice intero i tale che i >= position (con tolleranza numerica)."""
+    return int(np.ceil(position - _TOLERANCE))
+
+
+class CellLabels:
+    """
+    Immagine delle etichette di cella allineata a un raster.
+
+    L'etichetta di un pixel è l'indice (0..n-1) della cella che lo contiene
+    nella lista passata al costruttore, oppure -1 se il pixel non appartiene
+    a nessuna cella. Gli ID delle feature corrispondenti sono in ``fids``.
+
+    :param cells: Lista di oggetti Cell
+    :param info: RasterInfo del raster a cui allineare le etichette
+    """
+
+    def __init__(self, cells, info):
+        self.info = info
+        self.fids = cell_fids(cells)
+        # Prima riga di pixel di ogni cella e riga (esclusa) dopo l'ultima: oltre
+        # row_end la cella è completa e le sue statistiche possono essere chiuse.
+        # Le celle senza pixel hanno row_start == row_end.
+        self.row_start = np.zeros(len(cells), dtype=np.int64)
+        self.row_end = np.zeros(len(cells), dtype=np.int64)
+        self._lut = None
+        self._image = None
+        if not len(cells):
+            self._image = np.full((info.height, info.width), -1, dtype=np.int32)
+        elif isinstance(cells, RasterGrid):
+            self._build_lattice(cells.origin_x, cells.origin_y, cells.cell_size, cells.cell_size,
+                                cells.rows, cells.cols)
+        elif not self._build_regular(cells):
+            self._build_image(cells)
+
+    @property
+    def count(self):
+        """Numero di celle."""
+        return len(self.fids)
+
+    @property
+    def is_regular(self):
+        """True se le etichette sono calcolate per divisione intera (griglia regolare)."""
+        return self._lut is not None
+
+    def _build_regular(self, cells):
+        """Prepara la tabella (riga, colonna) -> cella per una griglia regolare."""
+        if not all(cell.is_rectangle() for cell in cells):
+            return False
+        widths = np.array([cell.xmax - cell.xmin for cell in cells])
+        heights = np.array([cell.ymax - cell.ymin for cell in cells])
+        cell_w, cell_h = widths[0], heights[0]
+        if not (np.allclose(widths, cell_w, rtol=_TOLERANCE) and np.allclose(heights, cell_h, rtol=_TOLERANCE)):
+            return False
+
+        x0 = min(cell.xmin for cell in cells)
+        y0 = max(cell.ymax for cell in cells)
+        cols = np.array([(cell.xmin - x0) / cell_w for cell in cells])
+        rows = np.array([(y0 - cell.ymax) / cell_h for cell in cells])
+        col_idx = np.rint(cols).astype(np.int64)
+        row_idx = np.rint(rows).astype(np.int64)
+        if not (np.allclose(cols, col_idx, atol=_TOLERANCE) and np.allclose(rows, row_idx, atol=_TOLERANCE)):
+            return False
+        if len(set(zip(row_idx, col_idx))) != len(cells):
+            return False
+        self._build_lattice(x0, y0, cell_w, cell_h, row_idx, col_idx)
+        return True
+
+    def _build_lattice(self, x0, y0, cell_w, cell_h, row_idx, col_idx):
+        """
+        Tabella (riga, colonna) -> cella e indici di riga e colonna di cella dei pixel.
+
+        :param x0: X del bordo ovest della colonna di celle 0
+        :param y0: Y del bordo nord della riga di celle 0
+        :param row_idx: Riga di cella di ogni cella (array int)
+        :param col_idx: Colonna di cella di ogni cella (array int)
+        """
+        info = self.info
+        # Ultima riga e ultima colonna a -1: gli indici fuori griglia puntano lì
+        lut = np.full((row_idx.max() + 2, col_idx.max() + 2), -1, dtype=np.int32)
+        lut[row_idx, col_idx] = np.arange(len(row_idx), dtype=np.int32)
+        self._lut = lut
+        self._col_of_pixel = self._pixel_cells(info.width, (x0 - info.origin_x) / info.pixel_width,
+                                               cell_w / info.pixel_width, lut.shape[1] - 1)
+
+        # Righe di pixel di ogni riga di celle: l'indice della riga di celle non
+        # decresce scendendo lungo il raster, quindi le righe sono contigue
+        row_of_pixel = self._pixel_cells(info.height, (info.origin_y - y0) / info.pixel_height,
+                                         cell_h / info.pixel_height, lut.shape[0] - 1)
+        self._row_of_pixel = row_of_pixel
+        pixel_rows = np.flatnonzero(row_of_pixel >= 0)
+        cell_rows, first_index, counts = np.unique(row_of_pixel[pixel_rows], return_index=True,
+                                                   return_counts=True)
+        first = np.zeros(lut.shape[0], dtype=np.int64)
+        end = np.zeros(lut.shape[0], dtype=np.int64)
+        first[cell_rows] = pixel_rows[first_index]
+        end[cell_rows] = first[cell_rows] + counts
+        self.row_start = first[row_idx]
+        self.row_end = end[row_idx]
+
+    @staticmethod
+    def _pixel_cells(npixels, offset, pixels_per_cell, size):
+        """
+        Indice di cella lungo un asse per ogni pixel; -1 fuori griglia.
+
+        :param offset: Posizione del bordo della cella 0, in pixel dal bordo del raster
+        :param pixels_per_cell: Lato della cella in pixel
+        :param size: Numero di celle lungo l'asse
+        """
+        pixels = np.arange(npixels, dtype=np.int64)
+        whole_offset, whole_size = round(offset), round(pixels_per_cell)
+        if whole_size >= 1 and abs(offset - whole_offset) <= _TOLERANCE \
+                and abs(pixels_per_cell - whole_size) <= _TOLERANCE * pixels_per_cell:
+            # Celle allineate ai pixel: divisione intera
+            index = (pixels - whole_offset) // whole_size
+        else:
+            index = np.floor((pixels + 0.5 - offset) / pixels_per_cell).astype(np.int64)
+        index[(index < 0) | (index >= size)] = -1
+        return index
+
+    def _build_image(self, cells):
+        """Rasterizza una volta sola le celle in un'immagine di etichette."""
+        info = self.info
+        image = np.full((info.height, info.width), -1, dtype=np.int32)
+        for label, cell in enumerate(cells):
+            c0 = max(0, _first_index((cell.xmin - info.origin_x) / info.pixel_width - 0.5))
+            c1 = min(info.width, _first_index((cell.xmax - info.origin_x) / info.pixel_width - 0.5))
+            r0 = max(0, _first_index((info.origin_y - cell.ymax) / info.pixel_height - 0.5))
+            r1 = min(info.height, _first_index((info.origin_y - cell.ymin) / info.pixel_height - 0.5))
+            if c0 >= c1 or r0 >= r1:
+                continue
+            self.row_start[label], self.row_end[label] = r0, r1
+            if cell.is_rectangle():
+                image[r0:r1, c0:c1] = label
+                continue
+            xs = info.column_centers()[c0:c1][None, :]
+            ys = info.row_centers(r0, r1 - r0)[:, None]
+            inside = points_in_rings(*np.broadcast_arrays(xs, ys), cell.rings)
+            image[r0:r1, c0:c1][inside] = label
+        self._image = image
+
+    def window(self, row_off, nrows):
+        """
+        Etichette per una striscia di righe complete del raster.
+
+        :param row_off: Indice della prima riga
+        :param nrows: Numero di righe
+        :return: Array int32 (nrows, larghezza del raster)
+        """
+        if self._image is not None:
+            return self._image[row_off:row_off + nrows]
+        return self._lut[self._row_of_pixel[row_off:row_off + nrows, None], self._col_of_pixel[None, :]]
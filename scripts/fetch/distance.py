@@ -0,0 +1,186 @@
+"""
+Trasformata della distanza euclidea esatta dai pixel di una maschera.
+
+Sostituisce ``gdal:proximity``: per ogni pixel calcola la distanza dal centro
+del pixel bersaglio (valore 1) più vicino, in unità del terreno (tenendo conto
+delle dimensioni del pixel, anche diverse in x e y) oppure in pixel.
+
+La trasformata è ``scipy.ndimage.distance_transform_edt`` (algoritmo di
+Maurer, lineare nel numero di pixel ed esatto, a meno dell'arrotondamento a
+float32 nel file scritto); SciPy è già richiesto da statsmodels.
+
+Differenze da ``gdal:proximity``: GDAL propaga il bersaglio più vicino tra
+pixel adiacenti e può solo sovrastimare la distanza. Sulle maschere degli
+edifici (bersagli compatti) i valori coincidono; con bersagli sparsi e isolati
+la differenza massima misurata è 0.17 pixel, su meno dello 0.1% dei pixel.
+La tolleranza dichiarata è ``PROXIMITY_TOLERANCE_PX``: per ogni pixel
+``0 <= gdal - fetch <= PROXIMITY_TOLERANCE_PX`` pixel (verificato in
+``tests/test_distance.py`` contro ``gdal.ComputeProximity``).
+
+Il raster è diviso in strisce di righe, lette una volta ciascuna con un alone
+di righe sopra e sotto ed elaborate anche in parallelo. L'alone contiene il
+bersaglio più vicino di ogni pixel della striscia, quindi il risultato è lo
+stesso di un calcolo unico:
+
+- con una distanza massima l'alone è pari alla distanza massima (i bersagli
+  più lontani sono comunque oltre);
+- senza distanza massima una prima lettura della maschera segna i blocchi di
+  ``COARSE_PIXELS`` pixel che contengono bersagli; la distanza tra i blocchi
+  più la loro diagonale limita dall'alto la distanza di ogni pixel, e quindi
+  l'alone della sua striscia. L'alone cresce con la distanza dagli edifici
+  più vicini, non con la dimensione del raster.
+
+Esempio::
+
+    distance_raster('mask.tif', 'distance.tif', max_distance=500, workers=4)
+"""
+import functools
+import math
+
+import numpy as np
+from scipy import ndimage
+
+from .parallel import CHUNKS_PER_WORKER, effective_workers, map_chunks
+from .raster import DEFAULT_BLOCK_BYTES, RasterReader, block_windows, create_raster, raster_info
+
+# Differenza massima (in pixel) ammessa rispetto a gdal:proximity, che può solo sovrastimare
+PROXIMITY_TOLERANCE_PX = 0.3
+
+# Valore di nodata dei pixel senza bersagli (come nella pipeline)
+NODATA = -9999.0
+
+# Unità delle distanze, come l'opzione DISTUNITS di gdal:proximity
+DISTANCE_UNITS = ('geo', 'pixel')
+
+# Lato (pixel) dei blocchi della prima lettura che limita l'alone senza distanza massima
+COARSE_PIXELS = 32
+
+# Altezza minima delle strisce, in multipli dell'alone
+HALO_MULTIPLE = 4
+
+# Byte per pixel della trasformata: maschera, indici dei bersagli (2 x int32) e distanze
+_EDT_BYTES = 24
+
+
+def distance_transform(targets, sampling=(1.0, 1.0)):
+    """
+    Trasformata della distanza esatta di un array in memoria.
+
+    :param targets: Array booleano (righe, colonne) dei pixel bersaglio
+    :param sampling: Distanza tra i centri dei pixel (x, y)
+    :return: Array float64 delle distanze, inf se non ci sono bersagli
+    """
+    targets = np.asarray(targets, dtype=bool)
+    if not targets.any():
+        return np.full(targets.shape, np.inf)
+    return ndimage.distance_transform_edt(~targets, sampling=(float(sampling[1]), float(sampling[0])))
+
+
+def _targets(block, values):
+    """Pixel bersaglio di un blocco: quelli con uno dei valori indicati."""
+    return np.isin(block, values)
+
+
+def _coarse_targets(reader, values, factor):
+    """
+    Blocchi di ``factor`` x ``factor`` pixel che contengono almeno un bersaglio.
+
+    La maschera è letta una volta, a strisce di righe complete.
+    """
+    width = reader.width
+    coarse = np.zeros((-(-reader.height // factor), -(-width // factor)), dtype=bool)
+    step = factor * max(1, DEFAULT_BLOCK_BYTES // (max(width, 1) * 8 * factor))
+    for row_off, nrows in block_windows(reader.height, step):
+        coarse_rows = -(-nrows // factor)
+        padded = np.zeros((coarse_rows * factor, coarse.shape[1] * factor), dtype=bool)
+        padded[:nrows, :width] = _targets(reader.rows(row_off, nrows), values)
+        coarse[row_off // factor:row_off // factor + coarse_rows] = \
+            padded.reshape(coarse_rows, factor, -1, factor).any(axis=(1, 3))
+    return coarse
+
+
+def _bound_halos(coarse, factor, spacing_x, spacing_y, height):
+    """
+    Alone (righe) sufficiente per ogni riga del raster, dai blocchi con bersagli.
+
+    Un pixel dista dal suo bersaglio più vicino al più la distanza tra il
+    centro del suo blocco e quello del blocco con bersagli più vicino, più
+    la diagonale di un blocco.
+    """
+    between = ndimage.distance_transform_edt(~coarse, sampling=(factor * spacing_y, factor * spacing_x))
+    bound = between.max(axis=1) + factor * math.hypot(spacing_x, spacing_y)
+    return np.repeat(np.ceil(bound / spacing_y).astype(np.int64), factor)[:height]
+
+
+def _halo_rows(mask, band, values, spacing_x, spacing_y, halos, row_start, row_stop):
+    """
+    Distanze di una striscia letta con un alone di righe sopra e sotto.
+
+    :param halos: Alone (righe) sufficiente per ogni riga del raster
+    """
+    reader = RasterReader(mask, band)
+    halo = int(halos[row_start:row_stop].max())
+    first, last = max(0, row_start - halo), min(reader.height, row_stop + halo)
+    distance = distance_transform(_targets(reader.rows(first, last - first), values), (spacing_x, spacing_y))
+    return distance[row_start - first:row_stop - first]
+
+
+def distance_raster(mask, output, band=1, values=(1,), units='geo', max_distance=None, nodata=NODATA,
+                    block_rows=None, workers=None):
+    """
+    Scrive il raster delle distanze dai pixel bersaglio di una maschera.
+
+    :param mask: Raster della maschera (percorso o layer QGIS)
+    :param output: Percorso del GeoTIFF float32 da scrivere (uno per esecuzione)
+    :param values: Valori dei pixel bersaglio (come l'opzione VALUES di gdal:proximity)
+    :param units: 'geo' per le unità del terreno, 'pixel' per i pixel (come DISTUNITS)
+    :param max_distance: Distanza massima, nelle stesse unità; oltre si scrive nodata
+                         (e l'alone delle strisce è limitato alla distanza massima)
+    :param nodata: Valore scritto dove non ci sono bersagli (entro la distanza massima)
+    :param block_rows: Righe per striscia (default: circa DEFAULT_BLOCK_BYTES di memoria,
+                       e almeno ``HALO_MULTIPLE`` volte l'alone)
+    :param workers: Processi per le strisce (1 o None = sequenziale)
+    :return: Percorso del file scritto
+    """
+    if units not in DISTANCE_UNITS:
+        raise ValueError(f"Unità delle distanze non valide: {units} (ammesse: {', '.join(DISTANCE_UNITS)})")
+    if max_distance is not None and max_distance <= 0:
+        raise ValueError("La distanza massima deve essere positiva.")
+    info = raster_info(mask, band)
+    spacing_x, spacing_y = (abs(info.pixel_width), abs(info.pixel_height)) if units == 'geo' else (1.0, 1.0)
+    values = np.asarray(values)
+
+    reader = RasterReader(mask, band)
+    if max_distance is None:
+        coarse = _coarse_targets(reader, values, COARSE_PIXELS)
+        if not coarse.any():
+            halos = np.zeros(info.height, dtype=np.int64)
+        else:
+            halos = _bound_halos(coarse, COARSE_PIXELS, spacing_x, spacing_y, info.height)
+    else:
+        halos = np.full(info.height, int(math.ceil(max_distance / spacing_y)), dtype=np.int64)
+    compute = functools.partial(_halo_rows, mask, band, values, spacing_x, spacing_y, halos)
+
+    # Strisce di circa DEFAULT_BLOCK_BYTES, ma alte almeno HALO_MULTIPLE volte l'alone tipico
+    rows_per_band = int(block_rows) if block_rows else max(1, DEFAULT_BLOCK_BYTES // (max(info.width, 1) * _EDT_BYTES))
+    workers = effective_workers(workers)
+    if workers > 1:
+        rows_per_band = min(rows_per_band, max(1, -(-info.height // (workers * CHUNKS_PER_WORKER))))
+    if not block_rows and len(halos):
+        rows_per_band = max(rows_per_band, HALO_MULTIPLE * int(np.median(halos)))
+    windows = [(row_off, row_off + nrows) for row_off, nrows in block_windows(info.height, rows_per_band)]
+
+    dataset = create_raster(output, info, np.float32, nodata)
+    target = dataset.GetRasterBand(1)
+    # Un gruppo di strisce per processo alla volta: la memoria resta limitata
+    for first in range(0, len(windows), workers):
+        group = windows[first:first + workers]
+        for (row_start, _), distance in zip(group, map_chunks(compute, group, workers)):
+            beyond = ~np.isfinite(distance)
+            if max_distance is not None:
+                beyond |= distance > max_distance
+            distance[beyond] = nodata
+            target.WriteArray(distance.astype(np.float32), 0, row_start)
+    dataset.FlushCache()
+    dataset = None
+    return output
@@ -0,0 +1,389 @@
+"""
+Scaricamento concorrente dei tile DSM, RGB e MASK dalla Google Solar API.
+
+Fa lo stesso lavoro di ``downloadTiles()`` in ``index.html`` senza browser:
+le richieste ``dataLayers:get`` e i download dei GeoTIFF procedono in
+parallelo (con un limite al numero di richieste contemporanee), riusando le
+connessioni HTTP. Gli errori temporanei vengono ritentati con attesa
+esponenziale e ogni file è scritto direttamente su disco, con un nome
+identico a quello dello ZIP dell'interfaccia web.
+
+I tile completati sono registrati in un manifest (una riga JSON per tile):
+rilanciando lo stesso comando dopo un'interruzione vengono scaricati solo i
+tile mancanti.
+
+Usa solo la libreria standard: le connessioni ``http.client`` lavorano in un
+pool di thread coordinato da asyncio.
+
+Uso dalla cartella ``scripts``::
+
+    python -m fetch.download --bounds 45.48 9.17 45.46 9.20 --out /dati/area_1
+
+con la chiave API nella variabile d'ambiente ``SOLAR_API_KEY`` o in ``--key``.
+Con ``--polygon area.geojson`` (o ``--plan``) i centri sono calcolati da
+``fetch.tiling`` per coprire solo il poligono; ``--plan-only`` mostra il
+numero di richieste, la sovrapposizione e il volume atteso senza scaricare.
+"""
+import argparse
+import asyncio
+import http.client
+import json
+import math
+import os
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode, urljoin, urlsplit
+
+SOLAR_ENDPOINT = 'https://solar.googleapis.com/v1/dataLayers:get'
+
+# Parametri di subdivideRectangle e delle richieste in index.html
+TILE_SIZE = 195
+METERS_PER_DEGREE = 111320
+REQUEST_RADIUS = 100
+PIXEL_SIZE = 0.5
+
+# Prodotti scaricati per ogni tile: prefisso del file e campo della risposta JSON
+TILE_PRODUCTS = (('dsm', 'dsmUrl'), ('rgb', 'rgbUrl'), ('mask', 'maskUrl'))
+
+MANIFEST_NAME = 'manifest.jsonl'
+
+# Stati HTTP per cui la richiesta viene ritentata
+RETRY_STATUS = (408, 429, 500, 502, 503, 504)
+
+_CHUNK_BYTES = 1024 * 1024
+_MAX_REDIRECTS = 5
+
+
+class DownloadError(RuntimeError):
+    """Errore HTTP o di rete di una richiesta."""
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+    @property
+    def retryable(self):
+        return self.status is None or self.status in RETRY_STATUS
+
+
+def subdivide_rectangle(north, west, south, east, size=TILE_SIZE):
+    """
+    Centri dei quadrati che coprono un rettangolo, come ``subdivideRectangle``.
+
+    La scala della longitudine è calcolata alla latitudine dell'angolo nord-ovest.
+
+    :return: Lista di coppie (latitudine, longitudine), per righe da nord a sud
+    """
+    size_lat = size / METERS_PER_DEGREE
+    size_lng = size / (METERS_PER_DEGREE * math.cos(north * (math.pi / 180)))
+    centroids = []
+    current_lat = north
+    while current_lat > south:
+        current_lng = west
+        while current_lng < east:
+            centroids.append((current_lat - size_lat / 2, current_lng + size_lng / 2))
+            current_lng += size_lng
+        current_lat -= size_lat
+    return centroids
+
+
+def format_coordinate(value):
+    """Coordinata come la scrive JavaScript nei link e nei nomi dei file."""
+    text = repr(float(value))
+    return text[:-2] if text.endswith('.0') else text
+
+
+def tile_id(lat, lng):
+    """Identificativo del tile usato nei nomi dei file: ``<lat>_<lng>``."""
+    return f'{format_coordinate(lat)}_{format_coordinate(lng)}'
+
+
+def data_layers_url(lat, lng, api_key, endpoint=SOLAR_ENDPOINT):
+    """Link ``dataLayers:get`` di un tile, come ``generateApiLinks``."""
+    query = urlencode({
+        'location.latitude': format_coordinate(lat),
+        'location.longitude': format_coordinate(lng),
+        'radiusMeters': REQUEST_RADIUS,
+        'view': 'FULL_LAYERS',
+        'requiredQuality': 'HIGH',
+        'pixelSizeMeters': PIXEL_SIZE,
+        'key': api_key,
+    })
+    return f'{endpoint}?{query}'
+
+
+def append_api_key(url, api_key):
+    """Aggiunge la chiave API a un URL di GeoTIFF, come ``appendApiKey``."""
+    return f'{url}&key={api_key}'
+
+
+class ConnectionPool:
+    """
+    Connessioni HTTP(S) persistenti riusate tra le richieste, per host.
+
+    :param timeout: Timeout di rete in secondi
+    """
+
+    def __init__(self, timeout=60):
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, scheme, netloc):
+        """Connessione libera verso un host (nuova se non ce ne sono)."""
+        with self._lock:
+            idle = self._idle.get((scheme, netloc))
+            if idle:
+                return idle.pop()
+        if scheme == 'https':
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(netloc, timeout=self.timeout)
+
+    def release(self, scheme, netloc, connection):
+        """Rimette a disposizione una connessione ancora utilizzabile."""
+        with self._lock:
+            self._idle.setdefault((scheme, netloc), []).append(connection)
+
+    def close(self):
+        """Chiude tutte le connessioni inattive."""
+        with self._lock:
+            for connections in self._idle.values():
+                for connection in connections:
+                    connection.close()
+            self._idle = {}
+
+
+def _get(pool, url, destination=None):
+    """
+    Esegue una GET bloccante seguendo i redirect.
+
+    :param destination: Se indicato, il corpo viene scritto a blocchi in questo
+                        file (passando da ``<destination>.part``); altrimenti
+                        viene restituito come bytes
+    :return: Corpo della risposta (bytes) oppure numero di byte scritti
+    """
+    for _ in range(_MAX_REDIRECTS + 1):
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path = f'{path}?{parts.query}'
+        connection = pool.acquire(parts.scheme, parts.netloc)
+        try:
+            connection.request('GET', path, headers={'Accept-Encoding': 'identity'})
+            response = connection.getresponse()
+            if response.status in (301, 302, 303, 307, 308) and response.getheader('Location'):
+                response.read()
+                url = urljoin(url, response.getheader('Location'))
+                pool.release(parts.scheme, parts.netloc, connection)
+                continue
+            if response.status != 200:
+                body = response.read(2048)
+                connection.close()
+                raise DownloadError(f"HTTP {response.status} da {parts.netloc}{parts.path}: "
+                                    f"{body.decode('utf-8', 'replace')[:200]}", response.status)
+            if destination is None:
+                body = response.read()
+            else:
+                body = _stream_to_file(response, destination)
+            if response.will_close:
+                connection.close()
+            else:
+                pool.release(parts.scheme, parts.netloc, connection)
+            return body
+        except (OSError, http.client.HTTPException) as error:
+            connection.close()
+            raise DownloadError(f"Errore di rete da {parts.netloc}: {error}") from error
+    # Senza query string, che contiene la chiave API
+    parts = urlsplit(url)
+    raise DownloadError(f"Troppi redirect per {parts.netloc}{parts.path}")
+
+
+def _stream_to_file(response, destination):
+    """
+    Scrive il corpo della risposta in un file, rinominandolo solo se completo.
+
+    Il file parziale non viene mai ripreso: ogni tentativo riparte da zero e,
+    se il trasferimento si interrompe, il file parziale viene eliminato.
+    """
+    partial = f'{destination}.part'
+    written = 0
+    try:
+        with open(partial, 'wb') as output:
+            for chunk in iter(lambda: response.read(_CHUNK_BYTES), b''):
+                output.write(chunk)
+                written += len(chunk)
+    except BaseException:
+        # Corpo interrotto (ad es. IncompleteRead di una risposta chunked)
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    expected = response.getheader('Content-Length')
+    if expected is not None and int(expected) != written:
+        os.remove(partial)
+        raise DownloadError(f"Download incompleto di {os.path.basename(destination)}: "
+                            f"{written} byte su {expected}")
+    os.replace(partial, destination)
+    return written
+
+
+class Manifest:
+    """
+    Registro dei tile completati, una riga JSON per tile.
+
+    :param path: Percorso del file (creato se non esiste)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.completed = {}
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as handle:
+                for line in handle:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # Riga troncata da un'interruzione
+                    self.completed[entry['tile']] = entry['files']
+
+    def is_done(self, tile, directory):
+        """True se il tile è registrato e tutti i suoi file esistono."""
+        files = self.completed.get(tile)
+        return bool(files) and all(os.path.exists(os.path.join(directory, name)) for name in files)
+
+    def add(self, tile, files):
+        """Registra un tile completato."""
+        self.completed[tile] = files
+        with open(self.path, 'a', encoding='utf-8') as handle:
+            handle.write(json.dumps({'tile': tile, 'files': files}) + '\n')
+
+
+class TileDownloader:
+    """
+    Scarica i tile con un numero limitato di richieste contemporanee.
+
+    :param api_key: Chiave della Google Solar API
+    :param output_dir: Cartella in cui scrivere i GeoTIFF e il manifest
+    :param concurrency: Richieste HTTP contemporanee al massimo
+    :param retries: Tentativi aggiuntivi per gli errori temporanei
+    :param backoff: Attesa (secondi) prima del primo nuovo tentativo, poi raddoppiata
+    :param endpoint: URL di ``dataLayers:get`` (ad es. un server di prova locale)
+    :param log: Funzione per i messaggi di avanzamento
+    """
+
+    def __init__(self, api_key, output_dir, concurrency=8, retries=5, backoff=1.0,
+                 endpoint=SOLAR_ENDPOINT, timeout=60, log=print):
+        self.api_key = api_key
+        self.output_dir = output_dir
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.endpoint = endpoint
+        self.log = log
+        self.pool = ConnectionPool(timeout)
+        os.makedirs(output_dir, exist_ok=True)
+        self.manifest = Manifest(os.path.join(output_dir, MANIFEST_NAME))
+
+    async def _request(self, url, destination=None):
+        """GET con limite di concorrenza e nuovi tentativi con attesa esponenziale."""
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.retries + 1):
+            async with self._semaphore:
+                try:
+                    return await loop.run_in_executor(self._executor, _get, self.pool, url, destination)
+                except DownloadError as error:
+                    if not error.retryable or attempt == self.retries:
+                        raise
+            # Attesa esponenziale con una componente casuale, fuori dal semaforo
+            await asyncio.sleep(self.backoff * 2 ** attempt * (0.5 + random.random() / 2))
+
+    async def _download_tile(self, lat, lng):
+        """Scarica i tre file di un tile; restituisce i nomi dei file scritti."""
+        tile = tile_id(lat, lng)
+        if self.manifest.is_done(tile, self.output_dir):
+            return None
+        body = await self._request(data_layers_url(lat, lng, self.api_key, self.endpoint))
+        layers = json.loads(body)
+        files = [f'{prefix}_{tile}.tif' for prefix, _ in TILE_PRODUCTS]
+        missing = [field for _, field in TILE_PRODUCTS if not layers.get(field)]
+        if missing:
+            raise DownloadError(f"Risposta senza {', '.join(missing)} per il tile {tile}")
+        await asyncio.gather(*[
+            self._request(append_api_key(layers[field], self.api_key), os.path.join(self.output_dir, name))
+            for (_, field), name in zip(TILE_PRODUCTS, files)
+        ])
+        self.manifest.add(tile, files)
+        return files
+
+    async def run(self, centroids):
+        """
+        Scarica tutti i tile.
+
+        :param centroids: Sequenza di coppie (latitudine, longitudine)
+        :return: Dizionario con i tile 'downloaded', 'skipped' e 'failed' ({tile: errore})
+        """
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._executor = ThreadPoolExecutor(self.concurrency)
+        summary = {'downloaded': [], 'skipped': [], 'failed': {}}
+        try:
+            tasks = [self._download_tile(lat, lng) for lat, lng in centroids]
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            self._executor.shutdown()
+            self.pool.close()
+        for (lat, lng), result in zip(centroids, results):
+            tile = tile_id(lat, lng)
+            if isinstance(result, Exception):
+                summary['failed'][tile] = str(result)
+                self.log(f"Tile {tile} non scaricato: {result}")
+            elif result is None:
+                summary['skipped'].append(tile)
+            else:
+                summary['downloaded'].append(tile)
+        self.log(f"Tile scaricati: {len(summary['downloaded'])}, già presenti: {len(summary['skipped'])}, "
+                 f"falliti: {len(summary['failed'])}")
+        return summary
+
+
+def download_tiles(centroids, api_key, output_dir, **options):
+    """
+    Versione sincrona di ``TileDownloader.run``.
+
+    :param options: Argomenti di ``TileDownloader`` (concurrency, retries, endpoint, ...)
+    """
+    return asyncio.run(TileDownloader(api_key, output_dir, **options).run(centroids))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Scarica i tile DSM, RGB e MASK dalla Google Solar API.")
+    area = parser.add_mutually_exclusive_group(required=True)
+    area.add_argument('--bounds', nargs=4, type=float, metavar=('NORD', 'OVEST', 'SUD', 'EST'),
+                      help="Rettangolo da coprire in gradi (tile come in index.html)")
+    area.add_argument('--polygon', help="File GeoJSON del poligono da coprire (tile pianificati con fetch.tiling)")
+    parser.add_argument('--plan', action='store_true', help="Pianifica i tile anche per --bounds")
+    parser.add_argument('--plan-only', action='store_true', help="Mostra il piano dei tile senza scaricare")
+    parser.add_argument('--out', required=True, help="Cartella dei tile")
+    parser.add_argument('--key', default=os.environ.get('SOLAR_API_KEY'), help="Chiave API (default: $SOLAR_API_KEY)")
+    parser.add_argument('--concurrency', type=int, default=8, help="Richieste contemporanee")
+    parser.add_argument('--retries', type=int, default=5, help="Nuovi tentativi per gli errori temporanei")
+    parser.add_argument('--endpoint', default=SOLAR_ENDPOINT, help="URL di dataLayers:get")
+    args = parser.parse_args(argv)
+    if args.polygon or args.plan or args.plan_only:
+        from .tiling import plan_tiles, read_polygon, rectangle_rings
+        plan = plan_tiles(read_polygon(args.polygon) if args.polygon else rectangle_rings(*args.bounds))
+        print(plan.summary())
+        if args.plan_only:
+            return 0
+        centroids = plan.centroids
+    else:
+        centroids = subdivide_rectangle(*args.bounds)
+    if not args.key:
+        parser.error("Indicare la chiave API con --key o SOLAR_API_KEY.")
+    print(f"Tile da scaricare: {len(centroids)}")
+    summary = download_tiles(centroids, args.key, args.out, concurrency=args.concurrency,
+                             retries=args.retries, endpoint=args.endpoint)
+    return 1 if summary['failed'] else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,100 @@
+"""
+Generazione del DTM dal DSM a blocchi, senza file intermedi.
+
+Sostituisce la catena di ``07_make_dtm.py`` (``native:slope`` e due
+``grass7:r.mapcalc.simple``): pendenza, soglia e maschera degli edifici sono
+calcolate in un solo passaggio su strisce di righe con un pixel di bordo, e
+ogni striscia viene scritta subito nel raster di uscita. La memoria occupata
+dipende dalla dimensione dei blocchi, non da quella del DSM.
+"""
+import numpy as np
+
+from .raster import RasterReader, create_raster, raster_info, rows_per_block, same_grid
+
+# Pendenza massima (gradi) dei pixel considerati terreno
+MAX_SLOPE = 5.71
+
+# Valore di nodata del DTM scritto
+NODATA = -9999.0
+
+
+def slope_degrees(window, pixel_width, pixel_height):
+    """
+    Pendenza in gradi con il metodo di Horn, come ``native:slope`` di QGIS.
+
+    I vicini nulli (NaN o fuori dal raster) vengono sostituiti dal valore del
+    pixel centrale; i pixel centrali nulli danno pendenza nulla.
+
+    :param window: Array (righe + 2, colonne) con una riga di bordo sopra e sotto
+    :return: Array (righe, colonne) delle pendenze
+    """
+    z = np.pad(np.asarray(window, dtype=np.float64), ((0, 0), (1, 1)), constant_values=np.nan)
+    rows, cols = z.shape[0] - 2, z.shape[1] - 2
+    center = z[1:-1, 1:-1]
+
+    def neighbour(dr, dc):
+        values = z[1 + dr:1 + dr + rows, 1 + dc:1 + dc + cols]
+        return np.where(np.isnan(values), center, values)
+
+    x11, x12, x13 = neighbour(-1, -1), neighbour(-1, 0), neighbour(-1, 1)
+    x21, x23 = neighbour(0, -1), neighbour(0, 1)
+    x31, x32, x33 = neighbour(1, -1), neighbour(1, 0), neighbour(1, 1)
+    dz_dx = ((x13 + 2 * x23 + x33) - (x11 + 2 * x21 + x31)) / (8 * pixel_width)
+    dz_dy = ((x31 + 2 * x32 + x33) - (x11 + 2 * x12 + x13)) / (8 * pixel_height)
+    return np.degrees(np.arctan(np.hypot(dz_dx, dz_dy)))
+
+
+def _read_rows(reader, row_off, nrows, nodata):
+    """Legge righe in virgola mobile; righe fuori dal raster e nodata diventano NaN."""
+    first, last = max(0, row_off), min(reader.height, row_off + nrows)
+    block = np.full((nrows, reader.width), np.nan, dtype=np.float64)
+    block[first - row_off:last - row_off] = reader.rows(first, last - first)
+    if nodata is not None:
+        block[block == nodata] = np.nan
+    return block
+
+
+def dsm_to_dtm(dsm, mask, output, max_slope=MAX_SLOPE, nodata=NODATA, block_rows=None):
+    """
+    Calcola il DTM a blocchi e lo scrive in ``output``.
+
+    Per ogni pixel: nullo se DSM o maschera sono nulli o se la pendenza supera
+    ``max_slope``, 0 se la maschera vale 1 (edifici, come ``A * (B != 1)`` in r.mapcalc),
+    altrimenti la quota del DSM.
+
+    :param dsm: Raster DSM (percorso o layer QGIS)
+    :param mask: Raster della maschera degli edifici, con la stessa griglia del DSM
+    :param output: Percorso del GeoTIFF di uscita
+    :param block_rows: Righe elaborate per blocco (default automatico)
+    :return: Percorso del file scritto
+    """
+    dsm_reader = RasterReader(dsm)
+    mask_reader = RasterReader(mask)
+    info = raster_info(dsm_reader.dataset)
+    if not same_grid(info, raster_info(mask_reader.dataset)):
+        raise ValueError("DSM e maschera devono avere la stessa griglia.")
+
+    mask_nodata = mask_reader.band.GetNoDataValue()
+    target = create_raster(output, info, np.float32, nodata)
+    target_band = target.GetRasterBand(1)
+    if block_rows is None:
+        block_rows = rows_per_block(dsm_reader.dataset)
+
+    for row_off in range(0, info.height, block_rows):
+        nrows = min(block_rows, info.height - row_off)
+        # Una riga di bordo sopra e sotto per la finestra 3x3 della pendenza (dalla cache dei blocchi)
+        window = _read_rows(dsm_reader, row_off - 1, nrows + 2, info.nodata)
+        slope = slope_degrees(window, info.pixel_width, info.pixel_height)
+        elevation = window[1:-1]
+        mask_values = mask_reader.rows(row_off, nrows)
+
+        dtm = np.where(mask_values == 1, 0.0, elevation)
+        null = np.isnan(elevation) | ~(slope <= max_slope)
+        if mask_nodata is not None:
+            null |= mask_values == mask_nodata
+        dtm[null] = nodata
+        target_band.WriteArray(dtm.astype(np.float32), 0, row_off)
+
+    target.FlushCache()
+    target = None
+    return output
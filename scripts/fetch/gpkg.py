@@ -0,0 +1,166 @@
+"""
+Lettura e scrittura a colonne degli attributi di un GeoPackage, senza QGIS né GDAL.
+
+Un GeoPackage è un database SQLite: gli attributi di un layer sono colonne di
+una tabella con chiave primaria intera (l'ID delle feature). Qui le colonne
+sono lette e scritte come array allineati agli ID, con una sola transazione
+per scrittura; le geometrie e gli indici spaziali non vengono toccati.
+
+Da usare quando il file non è aperto in modifica in QGIS: dentro QGIS si
+passa dal provider con ``qgis_io.write_attributes``.
+
+Esempio::
+
+    fids, columns = read_gpkg_attributes('grid.gpkg', ['median_dist'])
+    write_gpkg_attributes('grid.gpkg', fids, {'median_dist': np.maximum(columns['median_dist'], 1)})
+"""
+import math
+import sqlite3
+
+import numpy as np
+
+
+def _quote(name):
+    """Identificatore SQL tra virgolette."""
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def _sql_type(values):
+    """Tipo di colonna SQLite adatto a una colonna NumPy (come ``vector._field_type``)."""
+    kind = np.asarray(values).dtype.kind
+    if kind in 'iub':
+        return 'INTEGER'
+    if kind == 'f':
+        return 'REAL'
+    return 'TEXT'
+
+
+def _to_sql(value):
+    """Converte un valore NumPy in un valore SQLite (NaN -> NULL)."""
+    if value is None:
+        return None
+    value = value.item() if hasattr(value, 'item') else value
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+
+def attribute_column(values):
+    """Colonna di attributi letti: float con NaN per i NULL se numerica, altrimenti array di oggetti."""
+    if all(value is None or isinstance(value, (int, float)) for value in values):
+        return np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+    return np.array(values, dtype=object)
+
+
+class GeoPackageTable:
+    """
+    Tabella degli attributi di un layer di un GeoPackage.
+
+    :param path: Percorso del file .gpkg
+    :param layer: Nome del layer (tabella) da leggere e aggiornare
+    """
+
+    def __init__(self, path, layer='grid'):
+        self.path = path
+        self.layer = layer
+        self.connection = sqlite3.connect(path)
+        try:
+            registered = self.connection.execute(
+                "SELECT 1 FROM gpkg_contents WHERE table_name = ?", (layer,)).fetchone()
+        except sqlite3.DatabaseError:
+            self.close()
+            raise ValueError(f"{path} non è un GeoPackage valido.")
+        if not registered:
+            self.close()
+            raise ValueError(f"Layer '{layer}' non trovato in {path}.")
+        self.fid_column = None
+        for _, name, _, _, _, primary_key in self._table_info():
+            if primary_key:
+                self.fid_column = name
+        if self.fid_column is None:
+            self.close()
+            raise ValueError(f"Il layer '{layer}' non ha una colonna di ID delle feature.")
+
+    def _table_info(self):
+        return self.connection.execute(f"PRAGMA table_info({_quote(self.layer)})").fetchall()
+
+    @property
+    def columns(self):
+        """Nomi delle colonne della tabella."""
+        return [row[1] for row in self._table_info()]
+
+    def read(self, names, fids=None):
+        """
+        Legge alcune colonne.
+
+        :param names: Nomi delle colonne
+        :param fids: ID delle feature da leggere (default: tutte, in ordine di ID)
+        :return: Coppia (array degli ID, dizionario nome -> array allineato agli ID)
+        """
+        missing = [name for name in names if name not in self.columns]
+        if missing:
+            raise ValueError(f"Colonne non presenti nel layer '{self.layer}': {', '.join(missing)}")
+        selected = ', '.join(_quote(name) for name in [self.fid_column] + list(names))
+        rows = self.connection.execute(
+            f"SELECT {selected} FROM {_quote(self.layer)} ORDER BY {_quote(self.fid_column)}").fetchall()
+        values = list(zip(*rows)) if rows else [()] * (len(names) + 1)
+        all_fids = np.array(values[0], dtype=np.int64)
+        columns = {name: attribute_column(column) for name, column in zip(names, values[1:])}
+        if fids is None:
+            return all_fids, columns
+        fids = np.asarray(fids, dtype=np.int64)
+        position = np.clip(np.searchsorted(all_fids, fids), 0, max(len(all_fids) - 1, 0))
+        if len(fids) and (not len(all_fids) or np.any(all_fids[position] != fids)):
+            raise ValueError(f"ID di feature non presenti nel layer '{self.layer}'.")
+        return fids, {name: column[position] for name, column in columns.items()}
+
+    def write(self, fids, columns):
+        """
+        Scrive più colonne in un'unica transazione, aggiungendo quelle mancanti.
+
+        :param fids: Sequenza di ID delle feature
+        :param columns: Dizionario nome della colonna -> sequenza di valori allineata a fids
+        :return: Numero di feature aggiornate
+        """
+        if not columns:
+            return 0
+        names = list(columns)
+        existing = set(self.columns)
+        assignments = ', '.join(f"{_quote(name)} = ?" for name in names)
+        statement = f"UPDATE {_quote(self.layer)} SET {assignments} WHERE {_quote(self.fid_column)} = ?"
+        rows = ([_to_sql(columns[name][row]) for name in names] + [int(fid)] for row, fid in enumerate(fids))
+        with self.connection:
+            for name in names:
+                if name not in existing:
+                    self.connection.execute(
+                        f"ALTER TABLE {_quote(self.layer)} ADD COLUMN {_quote(name)} {_sql_type(columns[name])}")
+            updated = self.connection.executemany(statement, rows).rowcount
+            self.connection.execute(
+                "UPDATE gpkg_contents SET last_change = strftime('%Y-%m-%dT%H:%M:%fZ', 'now') WHERE table_name = ?",
+                (self.layer,))
+        return updated
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_gpkg_attributes(path, names, layer='grid', fids=None):
+    """Legge colonne di attributi da un GeoPackage (vedi ``GeoPackageTable.read``)."""
+    with GeoPackageTable(path, layer) as table:
+        return table.read(names, fids)
+
+
+def write_gpkg_attributes(path, fids, columns, layer='grid'):
+    """
+    Scrive colonne di attributi in un GeoPackage con una sola transazione.
+
+    :return: Numero di feature aggiornate
+    """
+    with GeoPackageTable(path, layer) as table:
+        return table.write(fids, columns)
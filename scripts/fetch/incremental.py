@@ -0,0 +1,229 @@
+"""
+Ricalcolo incrementale degli attributi per cella.
+
+Per ogni fase si conserva, accanto alla griglia, un'impronta (fingerprint)
+degli input di ogni cella: un hash a 64 bit di valore e posizione di tutti i
+pixel che la cella contiene nei raster di input, combinato con nome, versione
+e parametri della fase. Rieseguendo la fase le impronte vengono ricalcolate
+(una sola lettura dei raster, senza ordinamenti) e solo le celle con impronta
+diversa, o nuove, vengono ricalcolate e riscritte.
+
+L'impronta di una cella è la somma modulo 2**64 degli hash dei suoi pixel,
+quindi non dipende dall'ordine di lettura dei blocchi. Le fasi che usano
+anche i pixel delle celle vicine (come il salto di altezza della rugosità)
+ricalcolano anche le celle adiacenti a una cella cambiata (``neighbours``).
+
+Esempio::
+
+    store = FingerprintStore.beside('grid.gpkg')
+    fingerprints = input_fingerprints(cells, ['distance.tif'], 'median_dist', params={'exclude_zero': True})
+    stale = store.stale('median_dist', fids, fingerprints)
+    ...  # ricalcola e scrive solo le celle con stale == True
+    store.save('median_dist', fids, fingerprints)
+"""
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from .cells import CellLabels, cell_fids
+from .parallel import occupied_rows
+from .raster import DEFAULT_BLOCK_BYTES, iter_row_blocks, open_raster, raster_info
+
+FINGERPRINT_DIR_SUFFIX = '.fingerprints'
+
+# Costanti di splitmix64
+_MIX_1 = np.uint64(0xBF58476D1CE4E5B9)
+_MIX_2 = np.uint64(0x94D049BB133111EB)
+_COMBINE = np.uint64(0x9E3779B97F4A7C15)
+
+
+def _mix(values):
+    """Funzione di mescolamento di splitmix64 su un array uint64."""
+    values = values ^ (values >> np.uint64(30))
+    values = values * _MIX_1
+    values = values ^ (values >> np.uint64(27))
+    values = values * _MIX_2
+    return values ^ (values >> np.uint64(31))
+
+
+def _seed(*parts):
+    """Seme a 64 bit da parametri serializzabili in JSON."""
+    text = json.dumps(parts, sort_keys=True, default=str)
+    return np.uint64(int.from_bytes(hashlib.sha256(text.encode('utf-8')).digest()[:8], 'little'))
+
+
+def _pixel_bits(block):
+    """Bit dei valori dei pixel come uint64 (i float sono confrontati bit per bit)."""
+    block = np.ascontiguousarray(block)
+    return block.view(f'u{block.dtype.itemsize}').astype(np.uint64)
+
+
+def cell_fingerprints(raster, cell_labels, band=1, seed=0, block_rows=None):
+    """
+    Impronta dei pixel di ogni cella in un raster.
+
+    :param raster: Raster (percorso o layer QGIS)
+    :param cell_labels: CellLabels allineato al raster
+    :param seed: Seme combinato con la posizione dei pixel
+    :return: Array uint64 allineato a ``cell_labels.fids`` (0 per le celle senza pixel)
+    """
+    fingerprints = np.zeros(cell_labels.count, dtype=np.uint64)
+    width = cell_labels.info.width
+    seed = np.uint64(seed)
+    row_start, row_stop = occupied_rows(cell_labels)
+    if row_stop <= row_start:
+        return fingerprints
+    for row_off, block in iter_row_blocks(raster, band, block_rows, row_start, row_stop):
+        labels = cell_labels.window(row_off, block.shape[0])
+        rows, cols = np.nonzero(labels >= 0)
+        position = (rows.astype(np.uint64) + np.uint64(row_off)) * np.uint64(width) + cols.astype(np.uint64)
+        hashes = _mix(_pixel_bits(block[rows, cols]) ^ _mix(position + seed))
+        np.add.at(fingerprints, labels[rows, cols], hashes)
+    return fingerprints
+
+
+def input_fingerprints(cells, rasters, stage, version=1, params=None, block_rows=None):
+    """
+    Impronte degli input di una fase per ogni cella.
+
+    :param cells: Lista di oggetti Cell o RasterGrid
+    :param rasters: Raster di input (percorsi o layer QGIS), nell'ordine usato dalla fase
+    :param stage: Nome della fase
+    :param version: Versione dell'algoritmo (da incrementare quando cambia il risultato)
+    :param params: Parametri della fase serializzabili in JSON
+    :return: Array uint64 allineato a cells
+    """
+    combined = np.full(len(cells), _seed(stage, version, params or {}), dtype=np.uint64)
+    labels = {}
+    for raster in rasters:
+        info = raster_info(raster)
+        key = (info.width, info.height, info.geotransform)
+        if key not in labels:
+            labels[key] = CellLabels(cells, info)
+        nodata = open_raster(raster).GetRasterBand(1).GetNoDataValue()
+        seed = _seed(info.width, info.height, info.geotransform, nodata)
+        fingerprints = cell_fingerprints(raster, labels[key], seed=seed, block_rows=block_rows)
+        combined = _mix(combined * _COMBINE + fingerprints)
+    return combined
+
+
+def neighbour_pairs(cell_labels, block_rows=None):
+    """
+    Coppie di celle con pixel adiacenti in orizzontale o in verticale.
+
+    :param cell_labels: CellLabels allineato al raster
+    :param block_rows: Righe lette per blocco (default: circa DEFAULT_BLOCK_BYTES per blocco)
+    :return: Array int64 (coppie, 2) di indici di cella, ogni coppia in entrambi gli ordini
+    """
+    count = cell_labels.count
+    if block_rows is None:
+        block_rows = max(1, DEFAULT_BLOCK_BYTES // (4 * cell_labels.info.width))
+    row_start, row_stop = occupied_rows(cell_labels)
+    keys = [np.zeros(0, dtype=np.int64)]
+    for row_off in range(row_start, row_stop, block_rows):
+        # Una riga in più per le coppie a cavallo di due blocchi
+        labels = cell_labels.window(row_off, min(block_rows + 1, row_stop - row_off))
+        for first, second in ((labels[:, :-1], labels[:, 1:]), (labels[:-1], labels[1:])):
+            touching = (first != second) & (first >= 0) & (second >= 0)
+            keys.append(np.unique(first[touching].astype(np.int64) * count + second[touching]))
+    keys = np.unique(np.concatenate(keys))
+    pairs = np.column_stack([keys // count, keys % count])
+    return np.concatenate([pairs, pairs[:, ::-1]])
+
+
+def stale_cells(store, stage, cells, rasters, version=1, params=None, neighbours=False):
+    """
+    Celle di una fase da ricalcolare.
+
+    :param store: FingerprintStore, oppure None per ricalcolare sempre tutte le celle
+    :param neighbours: Se True sono da ricalcolare anche le celle con pixel
+                       adiacenti a quelli di una cella cambiata, per le fasi il
+                       cui risultato dipende anche dai pixel vicini (sulla
+                       griglia del primo raster)
+    :return: Coppia (impronte, array booleano delle celle da ricalcolare);
+             senza archivio le impronte non vengono calcolate e sono None
+    """
+    if store is None:
+        return None, np.ones(len(cells), dtype=bool)
+    fingerprints = input_fingerprints(cells, rasters, stage, version, params)
+    fids = cell_fids(cells)
+    stale = store.stale(stage, fids, fingerprints)
+    if neighbours and stale.any() and not stale.all():
+        pairs = neighbour_pairs(CellLabels(cells, raster_info(rasters[0])))
+        stale[pairs[stale[pairs[:, 1]], 0]] = True
+    return fingerprints, stale
+
+
+class FingerprintStore:
+    """
+    Impronte per fase salvate in una cartella, un file ``<fase>.npz`` per fase.
+
+    Insieme alle impronte si possono salvare i valori calcolati per cella, per
+    chi (come la pipeline headless) non li rilegge dalla griglia.
+
+    :param directory: Cartella delle impronte (creata al primo salvataggio)
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    @classmethod
+    def beside(cls, grid_path):
+        """Archivio accanto a un file di griglia: ``<griglia>.fingerprints``."""
+        return cls(grid_path + FINGERPRINT_DIR_SUFFIX)
+
+    def _path(self, stage):
+        return os.path.join(self.directory, f'{stage}.npz')
+
+    def load(self, stage):
+        """
+        Impronte e valori salvati di una fase.
+
+        :return: Dizionario con 'fids', 'fingerprints' e le colonne salvate, oppure None
+        """
+        try:
+            with np.load(self._path(stage), allow_pickle=False) as data:
+                return {name: data[name] for name in data.files}
+        except (OSError, ValueError):
+            return None
+
+    def stale(self, stage, fids, fingerprints):
+        """
+        Celle da ricalcolare: nuove o con impronta diversa da quella salvata.
+
+        :return: Array booleano allineato a fids
+        """
+        stored = self.load(stage)
+        if stored is None or len(stored['fids']) == 0:
+            return np.ones(len(fids), dtype=bool)
+        order = np.argsort(stored['fids'])
+        stored_fids = stored['fids'][order]
+        position = np.clip(np.searchsorted(stored_fids, fids), 0, len(stored_fids) - 1)
+        known = stored_fids[position] == fids
+        return ~known | (stored['fingerprints'][order][position] != fingerprints)
+
+    def save(self, stage, fids, fingerprints, columns=None):
+        """
+        Salva le impronte (e i valori) di tutte le celle di una fase.
+
+        :param columns: Dizionario nome -> valori allineati a fids (opzionale)
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        arrays = {'fids': np.asarray(fids, dtype=np.int64), 'fingerprints': np.asarray(fingerprints, dtype=np.uint64)}
+        arrays.update((name, np.asarray(values)) for name, values in (columns or {}).items())
+        handle, tmp = tempfile.mkstemp(dir=self.directory, suffix='.npz')
+        with os.fdopen(handle, 'wb') as output:
+            np.savez(output, **arrays)
+        os.replace(tmp, self._path(stage))
+
+    def clear(self, stage=None):
+        """Elimina le impronte di una fase (o di tutte), forzando il ricalcolo completo."""
+        if not os.path.isdir(self.directory):
+            return
+        names = [f'{stage}.npz'] if stage else [name for name in os.listdir(self.directory) if name.endswith('.npz')]
+        for name in names:
+            if os.path.exists(os.path.join(self.directory, name)):
+                os.remove(os.path.join(self.directory, name))
@@ -0,0 +1,189 @@
+"""
+Frazioni di copertura del suolo per cella della griglia.
+
+Sostituisce il ciclo pixel per pixel di ``calculate_percentages`` nello
+script 06: il raster ``pervius_impervius_buildings`` viene letto una sola
+volta a strisce e i pixel di tutte le celle vengono contati con un unico
+``bincount`` per striscia.
+
+Costruisce anche lo stesso raster a partire da ``class`` e ``mask`` in un
+solo passaggio (``build_landcover_raster``), al posto della catena
+riclassificazione -> rasterize dei poligoni ``buildings`` -> merge ->
+translate dello script 05.
+"""
+import functools
+
+import numpy as np
+
+from .parallel import effective_workers, map_chunks, split_rows
+from .raster import RasterReader, create_raster, iter_row_blocks, open_raster, raster_info, rows_per_block, same_grid
+
+# Campo del layer grid e valore del pixel corrispondente nel raster
+LANDCOVER_FIELDS = (
+    ('perc_impervious', 0),
+    ('perc_pervious', 1),
+    ('perc_buildings', 2),
+)
+
+# Tabella di qgis:reclassifybytable dello script 05: (min, max, valore) con min < x <= max
+RECLASS_TABLE = ((0, 5, 1), (5, 9, 0))
+
+# Valore dei pixel di edificio (BURN di gdal:rasterize nello script 05)
+BUILDING_VALUE = 2
+
+
+class _MaskSampler:
+    """
+    Legge la maschera degli edifici sui centri dei pixel del raster delle classi.
+
+    Un pixel è edificio se il suo centro cade in un pixel della maschera
+    diverso da 0 e da nodata: è la regola di gdal:rasterize applicata ai
+    poligoni che gdal:polygonize ricava dalla maschera nello script 04.
+    """
+
+    def __init__(self, mask, info):
+        self.reader = RasterReader(mask)
+        self.info = info
+        self.mask_info = raster_info(self.reader.dataset)
+        self.nodata = self.mask_info.nodata
+        self.aligned = same_grid(info, self.mask_info)
+        if not self.aligned:
+            self.cols = np.floor((info.column_centers() - self.mask_info.origin_x)
+                                 / self.mask_info.pixel_width).astype(np.int64)
+            self.col_valid = (self.cols >= 0) & (self.cols < self.mask_info.width)
+
+    def _is_building(self, values):
+        buildings = values != 0
+        if self.nodata is not None:
+            buildings &= values != self.nodata
+        return buildings
+
+    def read(self, row_off, nrows):
+        """Array booleano (nrows, larghezza) dei pixel di edificio."""
+        if self.aligned:
+            return self._is_building(self.reader.rows(row_off, nrows))
+        result = np.zeros((nrows, self.info.width), dtype=bool)
+        rows = np.floor((self.mask_info.origin_y - self.info.row_centers(row_off, nrows))
+                        / self.mask_info.pixel_height).astype(np.int64)
+        row_valid = (rows >= 0) & (rows < self.mask_info.height)
+        if not row_valid.any() or not self.col_valid.any():
+            return result
+        rows, cols = rows[row_valid], self.cols[self.col_valid]
+        first_row, first_col = rows.min(), cols.min()
+        window = self.reader.read(int(first_col), int(first_row),
+                                  int(cols.max() - first_col + 1), int(rows.max() - first_row + 1))
+        sampled = window[np.ix_(rows - first_row, cols - first_col)]
+        result[np.ix_(row_valid, self.col_valid)] = self._is_building(sampled)
+        return result
+
+
+def reclassify(block, nodata=None):
+    """
+    Riclassifica un blocco del raster ``class`` con ``RECLASS_TABLE``.
+
+    I valori fuori tabella restano invariati; i pixel nodata diventano 0,
+    come nel raster unito da gdal:merge nello script 05.
+    """
+    labels = block.copy()
+    for low, high, value in RECLASS_TABLE:
+        labels[(block > low) & (block <= high)] = value
+    if nodata is not None:
+        labels[block == nodata] = 0
+    if labels.dtype.kind == 'f':
+        labels[np.isnan(block)] = 0
+    return labels
+
+
+def build_landcover_raster(class_raster, mask_raster, output, block_rows=None):
+    """
+    Scrive il raster impermeabile (0) / permeabile (1) / edifici (2) a blocchi.
+
+    :param class_raster: Raster delle classi di copertura (percorso o layer QGIS)
+    :param mask_raster: Raster della maschera degli edifici (percorso o layer QGIS)
+    :param output: Percorso del GeoTIFF Byte di uscita, con la griglia di ``class_raster``
+    :param block_rows: Righe elaborate per blocco (default automatico)
+    :return: Percorso del file scritto
+    """
+    dataset = open_raster(class_raster)
+    info = raster_info(dataset)
+    mask = _MaskSampler(mask_raster, info)
+    target = create_raster(output, info, np.uint8)
+    target_band = target.GetRasterBand(1)
+    if block_rows is None:
+        block_rows = rows_per_block(dataset)
+
+    for row_off, block in iter_row_blocks(dataset, block_rows=block_rows):
+        labels = reclassify(block, info.nodata)
+        labels[mask.read(row_off, block.shape[0])] = BUILDING_VALUE
+        target_band.WriteArray(labels.astype(np.uint8), 0, row_off)
+
+    target.FlushCache()
+    target = None
+    return output
+
+
+def landcover_counts(raster, cell_labels, band=1, block_rows=None, workers=None):
+    """
+    Conta i pixel di ogni classe di copertura per ogni cella.
+
+    :param raster: Raster delle classi (percorso o layer QGIS)
+    :param cell_labels: CellLabels allineato al raster
+    :param band: Banda da leggere
+    :param block_rows: Righe lette per blocco (default automatico)
+    :param workers: Numero di processi (default: sequenziale)
+    :return: Array int64 (numero di celle, numero di classi)
+    """
+    workers = effective_workers(workers)
+    chunks = split_rows(cell_labels, workers)
+    partials = map_chunks(functools.partial(_count_rows, raster, cell_labels, band, block_rows), chunks, workers)
+    counts = np.zeros((cell_labels.count, len(LANDCOVER_FIELDS)), dtype=np.int64)
+    for chunk_counts in partials:
+        counts += chunk_counts
+    return counts
+
+
+def _count_rows(raster, cell_labels, band, block_rows, row_start, row_stop):
+    """Conteggi per cella e classe dei pixel nelle righe ``row_start:row_stop``."""
+    values = np.array([value for _, value in LANDCOVER_FIELDS])
+    nclasses = len(values)
+    ncells = cell_labels.count
+    # Tabella valore del pixel -> indice di classe (-1 per i valori ignorati)
+    class_of_value = np.full(values.max() + 1, -1, dtype=np.int64)
+    class_of_value[values] = np.arange(nclasses)
+
+    counts = np.zeros(ncells * nclasses, dtype=np.int64)
+    for row_off, block in iter_row_blocks(raster, band, block_rows, row_start, row_stop):
+        labels = cell_labels.window(row_off, block.shape[0])
+        valid = (labels >= 0) & (block >= 0) & (block <= values.max())
+        # Esclude i valori non interi (raster in virgola mobile)
+        valid &= block == np.floor(block)
+        classes = class_of_value[block[valid].astype(np.int64)]
+        keep = classes >= 0
+        keys = labels[valid][keep].astype(np.int64) * nclasses + classes[keep]
+        counts += np.bincount(keys, minlength=ncells * nclasses)
+    return counts.reshape(ncells, nclasses)
+
+
+def landcover_percentages(raster, cell_labels, band=1, block_rows=None, workers=None):
+    """
+    Percentuali di superficie impermeabile, permeabile ed edificata per cella.
+
+    :param raster: Raster delle classi (percorso o layer QGIS)
+    :param cell_labels: CellLabels allineato al raster
+    :param workers: Numero di processi (default: sequenziale)
+    :return: Dizionario nome del campo -> array di percentuali (NaN per le
+             celle senza pixel validi), nell'ordine di ``cell_labels.fids``
+    """
+    return percentages_from_counts(landcover_counts(raster, cell_labels, band, block_rows, workers))
+
+
+def percentages_from_counts(counts):
+    """
+    Percentuali per cella dai conteggi di ``landcover_counts`` (anche sommati su più celle).
+
+    :return: Dizionario nome del campo -> array di percentuali (NaN per le celle senza pixel validi)
+    """
+    total = counts.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        percentages = counts * 100.0 / total[:, None]
+    return {field: percentages[:, i] for i, (field, _) in enumerate(LANDCOVER_FIELDS)}
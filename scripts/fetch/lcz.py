@@ -0,0 +1,679 @@
+"""
+Classificatore delle Local Climate Zones (LCZ) basato sul RMSEP.
+
+Spostato da ``14_rmsep.py`` per poterlo importare sia dallo script sia dalla
+pipeline headless.
+"""
+import math
+
+import numpy as np
+import statsmodels.tools.eval_measures as em
+
+
+# Definizione delle classi LCZ e relative descrizioni
+LCZ_CLASSES = {
+    '1': 'Compact highrise',
+    '2': 'Compact midrise',
+    '3': 'Compact lowrise',
+    '4': 'Open highrise',
+    '5': 'Open midrise',
+    '6': 'Open lowrise',
+    '7': 'Lightweight lowrise',
+    '8': 'Large lowrise',
+    '9': 'Sparsely built',
+    '10': 'Heavy industry',
+    'A': 'Dense trees',
+    'B': 'Scattered trees',
+    'C': 'Bush, scrub',
+    'D': 'Low plants',
+    'E': 'Bare rock or paved',
+    'F': 'Bare soil or sand',
+    'G': 'Water'
+}
+
+# Definizione dei range di parametri per ogni classe LCZ
+LCZ_PARAMETERS = {
+    '1': {
+        'sky_view_factor': (0.2, 0.4),
+        'aspect_ratio': (2, float('inf')),
+        'building_surface_fraction': (40, 60),
+        'impervious_surface_fraction': (40, 60),
+        'pervious_surface_fraction': (0, 10),
+        'height_roughness': (25, float('inf')),
+        'terrain_roughness': (8, 8),
+        'surface_admittance': (1500, 1800),
+        'surface_albedo': (0.1, 0.2),
+        'anthropogenic_heat': (50, 300)
+    },
+    '2': {
+        'sky_view_factor': (0.3, 0.6),
+        'aspect_ratio': (0.75, 2),
+        'building_surface_fraction': (40, 70),
+        'impervious_surface_fraction': (30, 50),
+        'pervious_surface_fraction': (0, 20),
+        'height_roughness': (10, 25),
+        'terrain_roughness': (6, 7),
+        'surface_admittance': (1500, 2200),
+        'surface_albedo': (0.1, 0.2),
+        'anthropogenic_heat': (0, 75)
+    },
+    '3': {
+        'sky_view_factor': (0.2, 0.6),
+        'aspect_ratio': (0.75, 1.5),
+        'building_surface_fraction': (40, 70),
+        'impervious_surface_fraction': (20, 50),
+        'pervious_surface_fraction': (0, 30),
+        'height_roughness': (3, 10),
+        'terrain_roughness': (6, 6),
+        'surface_admittance': (1200, 1800),
+        'surface_albedo': (0.1, 0.2),
+        'anthropogenic_heat': (0, 75)
+    },
+    '4': {
+        'sky_view_factor': (0.5, 0.7),
+        'aspect_ratio': (0.75, 1.25),
+        'building_surface_fraction': (20, 40),
+        'impervious_surface_fraction': (30, 40),
+        'pervious_surface_fraction': (30, 40),
+        'height_roughness': (25, float('inf')),
+        'terrain_roughness': (7, 8),
+        'surface_admittance': (1400, 1800),
+        'surface_albedo': (0.12, 0.25),
+        'anthropogenic_heat': (0, 50)
+    },
+    '5': {
+        'sky_view_factor': (0.5, 0.8),
+        'aspect_ratio': (0.3, 0.75),
+        'building_surface_fraction': (20, 40),
+        'impervious_surface_fraction': (30, 50),
+        'pervious_surface_fraction': (20, 40),
+        'height_roughness': (10, 25),
+        'terrain_roughness': (5, 6),
+        'surface_admittance': (1400, 2000),
+        'surface_albedo': (0.12, 0.25),
+        'anthropogenic_heat': (0, 25)
+    },
+    '6': {
+        'sky_view_factor': (0.6, 0.9),
+        'aspect_ratio': (0.3, 0.75),
+        'building_surface_fraction': (20, 40),
+        'impervious_surface_fraction': (20, 50),
+        'pervious_surface_fraction': (30, 60),
+        'height_roughness': (3, 10),
+        'terrain_roughness': (5, 6),
+        'surface_admittance': (1200, 1800),
+        'surface_albedo': (0.12, 0.25),
+        'anthropogenic_heat': (0, 25)
+    },
+    '7': {
+        'sky_view_factor': (0.2, 0.5),
+        'aspect_ratio': (1, 2),
+        'building_surface_fraction': (60, 90),
+        'impervious_surface_fraction': (0, 20),
+        'pervious_surface_fraction': (0, 30),
+        'height_roughness': (2, 4),
+        'terrain_roughness': (4, 5),
+        'surface_admittance': (800, 1500),
+        'surface_albedo': (0.15, 0.35),
+        'anthropogenic_heat': (0, 35)
+    },
+    '8': {
+        'sky_view_factor': (0.7, float('inf')),
+        'aspect_ratio': (0.1, 0.3),
+        'building_surface_fraction': (30, 50),
+        'impervious_surface_fraction': (40, 50),
+        'pervious_surface_fraction': (0, 20),
+        'height_roughness': (3, 10),
+        'terrain_roughness': (5, 5),
+        'surface_admittance': (1200, 1800),
+        'surface_albedo': (0.15, 0.25),
+        'anthropogenic_heat': (0, 50)
+    },
+    '9': {
+        'sky_view_factor': (0.8, 1),
+        'aspect_ratio': (0.1, 0.25),
+        'building_surface_fraction': (10, 20),
+        'impervious_surface_fraction': (0, 20),
+        'pervious_surface_fraction': (60, 80),
+        'height_roughness': (3, 10),
+        'terrain_roughness': (5, 6),
+        'surface_admittance': (1000, 1800),
+        'surface_albedo': (0.12, 0.25),
+        'anthropogenic_heat': (0, 10)
+    },
+    '10': {
+        'sky_view_factor': (0.6, 0.9),
+        'aspect_ratio': (0.2, 0.5),
+        'building_surface_fraction': (20, 30),
+        'impervious_surface_fraction': (20, 40),
+        'pervious_surface_fraction': (40, 50),
+        'height_roughness': (5, 15),
+        'terrain_roughness': (5, 6),
+        'surface_admittance': (1000, 2500),
+        'surface_albedo': (0.12, 0.2),
+        'anthropogenic_heat': (300, float('inf'))
+    },
+    'A': {
+        'sky_view_factor': (0, 0.4),
+        'aspect_ratio': (1, float('inf')),
+        'building_surface_fraction': (0, 10),
+        'impervious_surface_fraction': (0, 10),
+        'pervious_surface_fraction': (90, 100),
+        'height_roughness': (3, 30),
+        'terrain_roughness': (8, 8),
+        'surface_admittance': (1000, 1800),
+        'surface_albedo': (0.12, 0.2),
+        'anthropogenic_heat': (0, 0)
+    },
+    'B': {
+        'sky_view_factor': (0.5, 0.8),
+        'aspect_ratio': (0.25, 0.75),
+        'building_surface_fraction': (0, 10),
+        'impervious_surface_fraction': (0, 10),
+        'pervious_surface_fraction': (90, 100),
+        'height_roughness': (3, 15),
+        'terrain_roughness': (5, 6),
+        'surface_admittance': (1200, 1800),
+        'surface_albedo': (0.15, 0.25),
+        'anthropogenic_heat': (0, 0)
+    },
+    'C': {
+        'sky_view_factor': (0.7, 0.9),
+        'aspect_ratio': (0.25, 1),
+        'building_surface_fraction': (0, 10),
+        'impervious_surface_fraction': (0, 10),
+        'pervious_surface_fraction': (90, 100),
+        'height_roughness': (0, 2),
+        'terrain_roughness': (4, 5),
+        'surface_admittance': (700, 1500),
+        'surface_albedo': (0.15, 0.30),
+        'anthropogenic_heat': (0, 0)
+    },
+    'D': {
+        'sky_view_factor': (0.9, 1),
+        'aspect_ratio': (0, 0.1),
+        'building_surface_fraction': (0, 10),
+        'impervious_surface_fraction': (0, 10),
+        'pervious_surface_fraction': (90, 100),
+        'height_roughness': (0, 1),
+        'terrain_roughness': (3, 4),
+        'surface_admittance': (1200, 1600),
+        'surface_albedo': (0.15, 0.25),
+        'anthropogenic_heat': (0, 0)
+    },
+    'E': {
+        'sky_view_factor': (0.9, 1),
+        'aspect_ratio': (0, 0.1),
+        'building_surface_fraction': (0, 10),
+        'impervious_surface_fraction': (90, 100),
+        'pervious_surface_fraction': (0, 10),
+        'height_roughness': (0, 0.25),
+        'terrain_roughness': (1, 2),
+        'surface_admittance': (1200, 2500),
+        'surface_albedo': (0.15, 0.3),
+        'anthropogenic_heat': (0, 0)
+    },
+    'F': {
+        'sky_view_factor': (0.9, 1),
+        'aspect_ratio': (0, 0.1),
+        'building_surface_fraction': (0, 10),
+        'impervious_surface_fraction': (0, 10),
+        'pervious_surface_fraction': (90, 100),
+        'height_roughness': (0, 0.25),
+        'terrain_roughness': (1, 2),
+        'surface_admittance': (600, 1400),
+        'surface_albedo': (0.2, 0.35),
+        'anthropogenic_heat': (0, 0)
+    },
+    'G': {
+        'sky_view_factor': (0.9, 1),
+        'aspect_ratio': (0, 0.1),
+        'building_surface_fraction': (0, 10),
+        'impervious_surface_fraction': (0, 10),
+        'pervious_surface_fraction': (90, 100),
+        'height_roughness': (0, 0.25),
+        'terrain_roughness': (1, 1),
+        'surface_admittance': (1500, 1500),
+        'surface_albedo': (0.02, 0.10),
+        'anthropogenic_heat': (0, 0)
+    }
+}
+
+# Ordine dei parametri nelle matrici usate da ``classify_batch``
+PARAMETER_NAMES = tuple(LCZ_PARAMETERS['1'])
+
+# Colonna per cella (archivio ``records.CellStore`` o griglia) da cui viene letto ogni parametro (None = non calcolato)
+PARAMETER_COLUMNS = {
+    'sky_view_factor': 'sky_view_factor',
+    'aspect_ratio': 'aspect_ratio',
+    'building_surface_fraction': 'perc_buildings',
+    'impervious_surface_fraction': 'perc_impervious',
+    'pervious_surface_fraction': 'perc_pervious',
+    'height_roughness': 'Height_rou',
+    'terrain_roughness': 'terrain_roughness',
+    'surface_admittance': None,
+    'surface_albedo': 'albedo_majority',
+    'anthropogenic_heat': None,
+}
+
+# Classi naturali: valide solo con building_surface_fraction <= 0 (vedi _is_valid_for_class)
+NATURAL_CLASSES = ('A', 'B', 'C', 'D', 'E', 'F', 'G')
+
+# Celle classificate per volta da classify_batch (limita la memoria delle matrici celle x classi x parametri)
+BATCH_ROWS = 65536
+
+
+class LCZClassifier:
+    def __init__(self, parameters):
+        self.parameters = parameters
+        self.lcz_classes = LCZ_CLASSES
+        self.lcz_parameters = LCZ_PARAMETERS
+
+    def calculate_rmsep(self, lcz_class):
+        """
+        Calcola il RMSEP usando statsmodels per una maggiore accuratezza statistica
+        e restituisce i contributi di errore per ogni parametro.
+        """
+        if not self._is_valid_for_class(lcz_class):
+            return float('inf'), 0, {}
+        
+        params = self.lcz_parameters[lcz_class]
+        valid_params = []
+        target_values = []
+        error_contributions = {}
+        perfect_matches = 0
+        total_valid_params = 0
+        
+        for param_name, (min_val, max_val) in params.items():
+            current_val = self.parameters.get(param_name)
+            
+            if current_val is None:
+                continue
+                
+            total_valid_params += 1
+            
+            if min_val <= current_val <= max_val:
+                perfect_matches += 1
+                error_contributions[param_name] = 0
+                continue
+                
+            target_val = min_val if max_val == float('inf') else (min_val + max_val) / 2
+            
+            if target_val == 0:
+                error_contributions[param_name] = float('inf')
+                continue
+            
+            valid_params.append(current_val)
+            target_values.append(target_val)
+            
+            # Calcola l'errore percentuale
+            percentage_error = (current_val - target_val) / target_val
+            error_contributions[param_name] = percentage_error ** 2
+            
+      
+        if total_valid_params == 0:
+            return float('inf'), 0, {}
+            
+        if not valid_params:
+            return 0, perfect_matches, error_contributions
+            
+        valid_params = np.array(valid_params)
+        target_values = np.array(target_values)
+        
+        # Calcola il RMSEP
+        rmsep = em.rmspe(valid_params, target_values)/100
+
+        return rmsep, perfect_matches, error_contributions
+
+    def _is_valid_for_class(self, lcz_class):
+        """
+        Verifica se i parametri sono validi per una determinata classe LCZ
+        """
+        # building_surface_fraction threshold
+        building_surface_fraction_threshold = 0
+        # Regole specifiche per verificare la validità
+        if lcz_class in ['A', 'B', 'C', 'D', 'E', 'F', 'G']:
+            return self.parameters['building_surface_fraction'] <= building_surface_fraction_threshold
+        return self.parameters['building_surface_fraction'] > building_surface_fraction_threshold 
+
+    def classify(self, report=True, details=False):
+        """
+        Classifica la zona calcolando il RMSEP per tutte le classi
+
+        :param report: Se True stampa il resoconto e restituisce anche i risultati
+                       di tutte le classi ('all_results'). Se False non stampa e non
+                       formatta nulla e restituisce un record compatto con
+                       'lcz_class', 'rmsep', 'perfect_matches' e 'available_params'
+        :param details: Solo con report=False: aggiunge al record gli
+                        'error_contributions' della classe assegnata
+        """
+        # Verifica che 'building_surface_fraction' non sia None
+        if self.parameters.get('building_surface_fraction') is None:
+            raise ValueError("Il parametro 'building_surface_fraction' è fondamentale e non può essere None.")
+        
+        # Verifica che la somma delle frazioni sia 100
+        building_fraction = self.parameters.get('building_surface_fraction', 0)
+        impervious_fraction = self.parameters.get('impervious_surface_fraction', 0)
+        pervious_fraction = self.parameters.get('pervious_surface_fraction', 0)
+        
+        total_fraction = building_fraction + impervious_fraction + pervious_fraction
+        # Tolleranza per le frazioni calcolate dai raster, che sono numeri in virgola mobile
+        if not math.isclose(total_fraction, 100, abs_tol=1e-6):
+            raise ValueError(
+                f"La somma di 'building_surface_fraction', 'impervious_surface_fraction' e 'pervious_surface_fraction' deve essere 100. "
+                f"Valori attuali: building_surface_fraction={building_fraction}, "
+                f"impervious_surface_fraction={impervious_fraction}, "
+                f"pervious_surface_fraction={pervious_fraction}."
+            )
+        
+        results = {}
+        available_params = sum(1 for val in self.parameters.values() if val is not None)
+        
+        for lcz in self.lcz_classes.keys():
+            rmsep, perfect_matches, error_contributions = self.calculate_rmsep(lcz)
+            results[lcz] = {
+                'rmsep': rmsep,
+                'perfect_matches': perfect_matches,
+                'available_params': available_params,
+                'error_contributions': error_contributions
+            }
+        
+        # Trova il numero massimo di match perfetti tra tutte le classi
+        max_perfect_matches = max(data['perfect_matches'] for data in results.values())
+        
+        # Filtra le classi che hanno il numero massimo di match perfetti
+        best_matches = {
+            lcz: data 
+            for lcz, data in results.items() 
+            if data['perfect_matches'] == max_perfect_matches
+        }
+        
+        # Tra queste, trova quella con il RMSEP minimo
+        best_class = min(best_matches.items(), key=lambda x: x[1]['rmsep'])
+
+        if not report:
+            record = {
+                'lcz_class': best_class[0],
+                'rmsep': best_class[1]['rmsep'],
+                'perfect_matches': best_class[1]['perfect_matches'],
+                'available_params': available_params
+            }
+            if details:
+                record['error_contributions'] = best_class[1]['error_contributions']
+            return record
+        
+        classification_result = {
+            'lcz_class': best_class[0],
+            'rmsep': best_class[1]['rmsep'],
+            'perfect_matches': best_class[1]['perfect_matches'],
+            'available_params': available_params,
+            'all_results': results
+        }
+
+        # Stampa i risultati
+        print("\nRisultati della classificazione LCZ:")
+        print("\n" + "°." * 30 + "\n")
+        print(f"Classe LCZ assegnata: {classification_result['lcz_class']}")
+        print(f"RMSEP: {classification_result['rmsep']:.4f}")
+        print(f"Parametri perfettamente nel range: {classification_result['perfect_matches']}/{classification_result['available_params']}")
+        print(f"Parametri disponibili: {classification_result['available_params']}/10")
+        print("\nValori per tutte le classi:")
+        print("\n" + "°." * 30 + "\n")
+
+        # Filtra e ordina solo i risultati con il massimo numero di match perfetti
+        max_matches_results = {
+            lcz: data 
+            for lcz, data in classification_result['all_results'].items()
+            if data['perfect_matches'] == max_perfect_matches
+        }
+        
+        sorted_results = dict(sorted(max_matches_results.items(),
+                                   key=lambda x: x[1]['rmsep']))
+        
+        for lcz_class, values in sorted_results.items():
+            if values['rmsep'] != float('inf'):
+                print(f"LCZ {lcz_class}: RMSEP={values['rmsep']:.4f}, "
+                      f"Match perfetti={values['perfect_matches']}/{values['available_params']}")
+                
+                for param, error in values['error_contributions'].items():
+                    param_range = self.lcz_parameters[lcz_class][param]
+                    current_val = self.parameters.get(param)
+                    
+                    if error == 0:
+                        print(f"  {param}: nessun errore ---> match perfetto")
+                    else:
+                        if param_range[1] == float('inf'):
+                            range_str = f">{param_range[0]}"
+                        else:
+                            range_str = f"({param_range[0]}, {param_range[1]})"
+                        print(f"  {param}: {range_str} ---> valore inserito: {current_val}")
+                
+                print("-" * 60)
+
+        return classification_result
+
+    def get_lcz_description(self, lcz_class):
+        """
+        Restituisce la descrizione di una classe LCZ
+        """
+        return self.lcz_classes.get(lcz_class, "Classe non trovata")
+
+
+def pack_ranges(lcz_parameters=LCZ_PARAMETERS):
+    """
+    Range dei parametri come array.
+
+    :param lcz_parameters: Dizionario classe -> {parametro: (min, max)}
+    :return: Tupla (classi in ordine, array (classi, parametri, 2) dei minimi e massimi
+             nell'ordine di ``PARAMETER_NAMES``)
+    """
+    classes = tuple(lcz_parameters)
+    ranges = np.array([[lcz_parameters[lcz][name] for name in PARAMETER_NAMES] for lcz in classes],
+                      dtype=np.float64)
+    return classes, ranges
+
+
+def parameter_matrix(records):
+    """
+    Matrice (celle, parametri) da una sequenza di dizionari di parametri.
+
+    I parametri mancanti o None diventano NaN.
+    """
+    values = np.full((len(records), len(PARAMETER_NAMES)), np.nan)
+    for row, parameters in enumerate(records):
+        for col, name in enumerate(PARAMETER_NAMES):
+            value = parameters.get(name)
+            if value is not None:
+                values[row, col] = value
+    return values
+
+
+def store_parameter_matrix(store, fids=None):
+    """
+    Matrice (celle, parametri) letta dall'archivio per cella in una sola chiamata.
+
+    :param store: ``records.CellStore``
+    :param fids: ID delle celle (default: tutte, nell'ordine dell'archivio)
+    :return: Array contiguo nell'ordine di ``PARAMETER_NAMES``, NaN per i parametri non calcolati
+    """
+    return store.matrix([PARAMETER_COLUMNS[name] for name in PARAMETER_NAMES], fids)
+
+
+def _fractions_valid(values):
+    """
+    Celle classificabili: building_surface_fraction presente e somma delle
+    frazioni pari a 100 con la stessa tolleranza di ``math.isclose`` in ``classify``.
+    """
+    building = values[:, PARAMETER_NAMES.index('building_surface_fraction')]
+    total = (building + values[:, PARAMETER_NAMES.index('impervious_surface_fraction')]
+             + values[:, PARAMETER_NAMES.index('pervious_surface_fraction')])
+    tolerance = np.maximum(1e-9 * np.maximum(np.abs(total), 100), 1e-6)
+    with np.errstate(invalid='ignore'):
+        return ~np.isnan(building) & (np.abs(total - 100) <= tolerance)
+
+
+def _class_scores(values, classes, ranges):
+    """
+    RMSEP e match perfetti di ogni cella per ogni classe, come ``calculate_rmsep``.
+
+    :return: Tupla (rmsep, match perfetti), array (celle, classi)
+    """
+    ncells, nclasses = len(values), len(classes)
+    low, high = ranges[..., 0], ranges[..., 1]
+    present = ~np.isnan(values)[:, None, :]
+    cell_values = values[:, None, :]
+    with np.errstate(invalid='ignore'):
+        in_range = present & (low <= cell_values) & (cell_values <= high)
+    target = np.where(high == np.inf, low, (low + high) / 2)
+    # Parametri che entrano nel RMSEP: presenti, fuori range e con obiettivo diverso da 0
+    scored = present & ~in_range & (target != 0)
+    perfect = in_range.sum(axis=2)
+    nscored = scored.sum(axis=2)
+
+    rmsep = np.zeros((ncells, nclasses))
+    # I parametri usati vengono portati in testa mantenendo l'ordine, poi
+    # rmspe viene calcolato su gruppi con lo stesso numero di parametri: le
+    # operazioni sono le stesse della chiamata per singola cella
+    order = np.argsort(~scored, axis=2, kind='stable')
+    packed_values = np.take_along_axis(np.broadcast_to(cell_values, scored.shape), order, axis=2)
+    packed_target = np.take_along_axis(np.broadcast_to(target, scored.shape), order, axis=2)
+    for count in np.unique(nscored):
+        if count == 0:
+            continue
+        group = nscored == count
+        rmsep[group] = em.rmspe(packed_values[group][:, :count], packed_target[group][:, :count], axis=1) / 100
+
+    building = values[:, PARAMETER_NAMES.index('building_surface_fraction')]
+    natural = np.isin(np.array(classes, dtype=object), NATURAL_CLASSES)
+    valid = np.where(natural, building[:, None] <= 0, building[:, None] > 0)
+    valid &= present.any(axis=2)
+    rmsep[~valid] = np.inf
+    perfect[~valid] = 0
+    return rmsep, perfect
+
+
+def _error_contributions(values, class_ranges):
+    """
+    Contributi di errore per parametro della classe assegnata, come
+    ``error_contributions``: 0 nel range, inf se l'obiettivo è 0, NaN se mancante.
+
+    :param values: Array (celle, parametri)
+    :param class_ranges: Array (celle, parametri, 2) dei range della classe di ogni cella
+    """
+    low, high = class_ranges[..., 0], class_ranges[..., 1]
+    present = ~np.isnan(values)
+    with np.errstate(invalid='ignore'):
+        in_range = present & (low <= values) & (values <= high)
+    target = np.where(high == np.inf, low, (low + high) / 2)
+    scored = present & ~in_range & (target != 0)
+    contributions = np.full(values.shape, np.nan)
+    contributions[in_range] = 0.0
+    contributions[present & ~in_range & (target == 0)] = np.inf
+    # Il quadrato con ** sui float di Python (pow del C) può differire di un ulp
+    # da quello di NumPy (x * x): si usa lo stesso di calculate_rmsep
+    errors = (values[scored] - target[scored]) / target[scored]
+    contributions[scored] = [error ** 2 for error in errors.tolist()]
+    return contributions
+
+
+def classify_batch(values, ranges=None, classes=None, batch_rows=BATCH_ROWS, details=False):
+    """
+    Classifica molte celle insieme, con le stesse regole di ``LCZClassifier.classify``.
+
+    Si sceglie la classe con più parametri nel range; a parità vince quella
+    con RMSEP minore e, a parità di RMSEP, la prima nell'ordine delle classi.
+    Non stampa nulla.
+
+    :param values: Array (celle, parametri) nell'ordine di ``PARAMETER_NAMES``, NaN per i mancanti
+    :param ranges: Array (classi, parametri, 2) dei range (default: ``LCZ_PARAMETERS``)
+    :param classes: Nomi delle classi corrispondenti a ``ranges``
+    :param batch_rows: Celle elaborate per volta
+    :param details: Se True aggiunge 'error_contributions', array (celle, parametri)
+                    dei contributi di errore della classe assegnata
+    :return: Dizionario con gli array per cella 'lcz_class' (None per le celle non
+             classificabili), 'rmsep', 'perfect_matches', 'available_params' e
+             'valid' (celle classificabili)
+    """
+    if ranges is None:
+        classes, ranges = pack_ranges()
+    elif classes is None:
+        raise ValueError("Con 'ranges' vanno indicate anche le classi.")
+    values = np.asarray(values, dtype=np.float64)
+    if values.ndim != 2 or values.shape[1] != len(PARAMETER_NAMES):
+        raise ValueError(f"Attesa una matrice (celle, {len(PARAMETER_NAMES)}) di parametri.")
+
+    ncells = len(values)
+    valid = _fractions_valid(values)
+    best = np.full(ncells, -1, dtype=np.int64)
+    rmsep = np.full(ncells, np.nan)
+    perfect_matches = np.zeros(ncells, dtype=np.int64)
+    contributions = np.full((ncells, len(PARAMETER_NAMES)), np.nan) if details else None
+    for start in range(0, ncells, batch_rows):
+        rows = np.flatnonzero(valid[start:start + batch_rows]) + start
+        if not len(rows):
+            continue
+        class_rmsep, class_perfect = _class_scores(values[rows], classes, ranges)
+        candidates = class_perfect == class_perfect.max(axis=1, keepdims=True)
+        # Come min() in classify: la prima candidata, sostituita solo da un RMSEP strettamente minore
+        chosen = np.full(len(rows), -1, dtype=np.int64)
+        chosen_rmsep = np.full(len(rows), np.nan)
+        for index in range(len(classes)):
+            take = candidates[:, index] & ((chosen < 0) | (class_rmsep[:, index] < chosen_rmsep))
+            chosen[take] = index
+            chosen_rmsep[take] = class_rmsep[take, index]
+        best[rows] = chosen
+        rmsep[rows] = chosen_rmsep
+        perfect_matches[rows] = class_perfect[np.arange(len(rows)), chosen]
+        if details:
+            contributions[rows] = _error_contributions(values[rows], ranges[chosen])
+
+    lcz_class = np.full(ncells, None, dtype=object)
+    lcz_class[valid] = np.array(classes, dtype=object)[best[valid]]
+    result = {
+        'lcz_class': lcz_class,
+        'rmsep': rmsep,
+        'perfect_matches': perfect_matches,
+        'available_params': (~np.isnan(values)).sum(axis=1),
+        'valid': valid,
+    }
+    if details:
+        result['error_contributions'] = contributions
+    return result
+
+
+def result_columns(result, prefix='lcz_'):
+    """
+    Colonne per cella da scrivere nella griglia o in un archivio a colonne.
+
+    :param result: Risultato di ``classify_batch``
+    :return: Dizionario nome della colonna -> array; con i dettagli una colonna
+             ``<prefix>err_<parametro>`` per ogni parametro
+    """
+    columns = {
+        f'{prefix}class': result['lcz_class'],
+        f'{prefix}rmsep': result['rmsep'],
+        f'{prefix}perfect': result['perfect_matches'],
+    }
+    if 'error_contributions' in result:
+        for col, name in enumerate(PARAMETER_NAMES):
+            columns[f'{prefix}err_{name}'] = result['error_contributions'][:, col]
+    return columns
+
+
+def stream_classification(writer, fids, values, batch_rows=BATCH_ROWS, details=False):
+    """
+    Classifica le celle a blocchi e passa ogni blocco di record a ``writer``.
+
+    :param writer: Oggetto con ``append(fids, columns)``, ad es.
+                   ``records.ColumnWriter`` o ``qgis_io.AttributeWriter``
+    :param fids: ID delle feature, allineati alle righe di ``values``
+    :param values: Array (celle, parametri) come in ``classify_batch``
+    :return: Numero di celle classificate
+    """
+    fids = np.asarray(fids)
+    classified = 0
+    for start in range(0, len(fids), batch_rows):
+        result = classify_batch(values[start:start + batch_rows], batch_rows=batch_rows, details=details)
+        writer.append(fids[start:start + batch_rows], result_columns(result))
+        classified += int(result['valid'].sum())
+    return classified
@@ -0,0 +1,344 @@
+"""
+Mosaici dei tile DSM, RGB e MASK scaricati.
+
+Il mosaico di ogni prodotto è un VRT: un indice XML dei tile che GDAL legge a
+finestre come un unico raster, senza copiare i pixel. Le fasi successive
+leggono direttamente dal VRT; ``materialize`` lo converte in un GeoTIFF a
+blocchi, compresso e con le piramidi (overview), solo quando serve un file
+autonomo.
+
+Dove i tile si sovrappongono vince il tile che segue nell'ordine di
+``tile_sort_key`` (da nord a sud, da ovest a est), indipendentemente
+dall'ordine dei file nella cartella; i pixel nodata di un tile lasciano
+vedere quelli dei tile sottostanti.
+
+Accanto a ogni mosaico ``refresh_mosaics`` salva l'indice dei tile usati
+(``<mosaico>.tiles.json``: dimensione, data di modifica ed estensione di ogni
+tile). Quando arrivano tile nuovi o riscaricati, il confronto con l'indice
+individua le aree cambiate: nel GeoTIFF vengono riscritti solo i blocchi (e le
+piramidi) che le coprono, e le aree sono restituite per segnare le celle della
+griglia da ricalcolare.
+"""
+import json
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from osgeo import gdal
+
+from .raster import GTIFF_OPTIONS
+
+# Prodotti dei tile: prefisso, tipo del mosaico materializzato e ricampionamento delle piramidi
+MOSAIC_PRODUCTS = (('dsm', 'Float32', 'AVERAGE'), ('rgb', 'Byte', 'AVERAGE'), ('mask', 'Byte', 'NEAREST'))
+
+# Le piramidi si fermano quando il livello più piccolo scende sotto questo lato in pixel
+OVERVIEW_MIN_SIZE = 256
+
+TILE_INDEX_SUFFIX = '.tiles.json'
+
+_RESAMPLE_ALGORITHMS = {'AVERAGE': gdal.GRIORA_Average, 'NEAREST': gdal.GRIORA_NearestNeighbour}
+
+# Tolleranza in pixel nel convertire le estensioni in finestre
+_TOLERANCE = 1e-6
+
+
+def tile_sort_key(path):
+    """
+    Ordine dei tile nel mosaico: per latitudine decrescente, poi longitudine.
+
+    Le coordinate sono lette dal nome ``<prodotto>_<lat>_<lng>.tif``; i file con
+    nomi diversi seguono in ordine alfabetico.
+    """
+    name = os.path.splitext(os.path.basename(path))[0]
+    parts = name.split('_')
+    try:
+        lat, lng = float(parts[-2]), float(parts[-1])
+    except (IndexError, ValueError):
+        return (1, 0.0, 0.0, name)
+    return (0, -lat, lng, name)
+
+
+def find_tiles(folder, product):
+    """Tile di un prodotto in una cartella, esclusi i mosaici già uniti, nell'ordine del mosaico."""
+    files = [os.path.join(folder, name) for name in os.listdir(folder)
+             if name.startswith(product) and name.endswith('.tif') and not name.endswith('_unito.tif')]
+    return sorted(files, key=tile_sort_key)
+
+
+def build_vrt(files, output):
+    """
+    Scrive il mosaico virtuale di un insieme di tile.
+
+    :param files: Percorsi dei tile (vengono riordinati con ``tile_sort_key``)
+    :param output: Percorso del file .vrt
+    :return: output
+    """
+    dataset = gdal.BuildVRT(output, sorted(files, key=tile_sort_key), resampleAlg='nearest')
+    if dataset is None:
+        raise RuntimeError(f"Impossibile creare il mosaico virtuale {output}")
+    dataset = None
+    return output
+
+
+def overview_factors(width, height, min_size=OVERVIEW_MIN_SIZE):
+    """Fattori di riduzione delle piramidi (2, 4, 8, ...) per un raster."""
+    factors = []
+    factor = 2
+    while max(width, height) / factor >= min_size:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+def materialize(source, output, output_type=None, resampling='AVERAGE', options=GTIFF_OPTIONS):
+    """
+    Converte un mosaico (o qualsiasi raster) in un GeoTIFF a blocchi compresso con piramidi.
+
+    :param source: Raster di origine, tipicamente il VRT di ``build_vrt``
+    :param output_type: Nome del tipo GDAL dei pixel (default: quello dell'origine)
+    :param resampling: Ricampionamento delle piramidi
+    :return: output
+    """
+    kwargs = {'creationOptions': list(options) + ['NUM_THREADS=ALL_CPUS']}
+    if output_type:
+        kwargs['outputType'] = gdal.GetDataTypeByName(output_type)
+    dataset = gdal.Translate(output, source, **kwargs)
+    if dataset is None:
+        raise RuntimeError(f"Impossibile scrivere il mosaico {output}")
+    factors = overview_factors(dataset.RasterXSize, dataset.RasterYSize)
+    if factors:
+        dataset.BuildOverviews(resampling, factors)
+    dataset = None
+    return output
+
+
+def build_mosaics(tiles_dir, output_dir, products=MOSAIC_PRODUCTS, log=print):
+    """
+    Crea i mosaici virtuali ``<prodotto>_unito.vrt``.
+
+    :param tiles_dir: Cartella dei tile scaricati
+    :param output_dir: Cartella dei mosaici
+    :param products: Sequenza di (prefisso, tipo, ricampionamento delle piramidi)
+    :return: Dizionario prefisso -> percorso del VRT (solo prodotti con almeno un tile)
+    """
+    mosaics = {}
+    for product, _, _ in products:
+        files = find_tiles(tiles_dir, product)
+        if not files:
+            log(f"Nessun file {product.upper()} trovato con il prefisso '{product}'.")
+            continue
+        mosaics[product] = build_vrt(files, os.path.join(output_dir, f'{product}_unito.vrt'))
+        log(f"Mosaico {product.upper()} di {len(files)} tile: {mosaics[product]}")
+    return mosaics
+
+
+def materialize_mosaics(mosaics, output_dir, products=MOSAIC_PRODUCTS, log=print):
+    """
+    Scrive ``<prodotto>_unito.tif`` per ogni mosaico, un prodotto per thread.
+
+    :param mosaics: Dizionario prefisso -> mosaico (ad es. il risultato di ``build_mosaics``)
+    :return: Dizionario prefisso -> percorso del GeoTIFF
+    """
+    products = [product for product in products if product[0] in mosaics]
+
+    def write(product):
+        name, output_type, resampling = product
+        return materialize(mosaics[name], os.path.join(output_dir, f'{name}_unito.tif'), output_type, resampling)
+
+    with ThreadPoolExecutor(max(1, len(products))) as executor:
+        paths = dict(zip([name for name, _, _ in products], executor.map(write, products)))
+    for name, path in paths.items():
+        log(f"File {name.upper()} unito salvato in: {path}")
+    return paths
+
+
+def tile_index(files):
+    """
+    Indice dei tile di un mosaico.
+
+    :return: Dizionario nome del file -> {'fingerprint': [dimensione, mtime_ns],
+             'extent': [xmin, ymin, xmax, ymax]}
+    """
+    index = {}
+    for path in files:
+        stat = os.stat(path)
+        dataset = gdal.Open(path)
+        x0, pixel_width, _, y0, _, pixel_height = dataset.GetGeoTransform()
+        x1 = x0 + dataset.RasterXSize * pixel_width
+        y1 = y0 + dataset.RasterYSize * pixel_height
+        index[os.path.basename(path)] = {
+            'fingerprint': [stat.st_size, stat.st_mtime_ns],
+            'extent': [min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1)],
+        }
+        dataset = None
+    return index
+
+
+def read_tile_index(mosaic):
+    """Indice dei tile salvato accanto a un mosaico (None se manca)."""
+    try:
+        with open(mosaic + TILE_INDEX_SUFFIX, encoding='utf-8') as handle:
+            return json.load(handle)
+    except (OSError, ValueError):
+        return None
+
+
+def write_tile_index(mosaic, index):
+    """Salva l'indice dei tile accanto a un mosaico."""
+    tmp = mosaic + TILE_INDEX_SUFFIX + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as handle:
+        json.dump(index, handle)
+    os.replace(tmp, mosaic + TILE_INDEX_SUFFIX)
+
+
+def changed_extents(old_index, new_index):
+    """
+    Aree cambiate tra due indici: tile nuovi, modificati o rimossi.
+
+    Per un tile modificato o rimosso conta anche l'estensione precedente.
+
+    :return: Lista di estensioni (xmin, ymin, xmax, ymax)
+    """
+    extents = []
+    for name in sorted(set(old_index) | set(new_index)):
+        old, new = old_index.get(name), new_index.get(name)
+        if old is not None and new is not None and old == new:
+            continue
+        for entry in (old, new):
+            if entry is not None and tuple(entry['extent']) not in extents:
+                extents.append(tuple(entry['extent']))
+    return extents
+
+
+def _same_grid(dataset, other):
+    return (dataset.RasterXSize == other.RasterXSize and dataset.RasterYSize == other.RasterYSize
+            and dataset.RasterCount == other.RasterCount
+            and all(abs(a - b) <= _TOLERANCE * max(1.0, abs(a))
+                    for a, b in zip(dataset.GetGeoTransform(), other.GetGeoTransform())))
+
+
+def _dirty_windows(dataset, extents):
+    """
+    Finestre di pixel allineate ai blocchi che coprono le estensioni.
+
+    I blocchi interessati sono raggruppati in sequenze contigue per riga di blocchi.
+
+    :return: Lista di (xoff, yoff, xsize, ysize)
+    """
+    x0, pixel_width, _, y0, _, pixel_height = dataset.GetGeoTransform()
+    width, height = dataset.RasterXSize, dataset.RasterYSize
+    block_x, block_y = dataset.GetRasterBand(1).GetBlockSize()
+    blocks = set()
+    for xmin, ymin, xmax, ymax in extents:
+        col0 = max(0, math.floor((xmin - x0) / pixel_width + _TOLERANCE))
+        col1 = min(width, math.ceil((xmax - x0) / pixel_width - _TOLERANCE))
+        row0 = max(0, math.floor((y0 - ymax) / abs(pixel_height) + _TOLERANCE))
+        row1 = min(height, math.ceil((y0 - ymin) / abs(pixel_height) - _TOLERANCE))
+        if col1 <= col0 or row1 <= row0:
+            continue
+        for block_row in range(row0 // block_y, (row1 - 1) // block_y + 1):
+            for block_col in range(col0 // block_x, (col1 - 1) // block_x + 1):
+                blocks.add((block_row, block_col))
+
+    windows = []
+    for block_row, block_col in sorted(blocks):
+        yoff = block_row * block_y
+        xoff = block_col * block_x
+        ysize = min(block_y, height - yoff)
+        xsize = min(block_x, width - xoff)
+        last = windows[-1] if windows else None
+        if last and last[1] == yoff and last[0] + last[2] == xoff:
+            windows[-1] = (last[0], yoff, last[2] + xsize, ysize)
+        else:
+            windows.append((xoff, yoff, xsize, ysize))
+    return windows
+
+
+def _refresh_overviews(band, window, resampling):
+    """Ricalcola la parte delle piramidi di una banda che copre una finestra aggiornata."""
+    xoff, yoff, xsize, ysize = window
+    width, height = band.XSize, band.YSize
+    algorithm = _RESAMPLE_ALGORITHMS.get(resampling.upper(), gdal.GRIORA_NearestNeighbour)
+    for level in range(band.GetOverviewCount()):
+        overview = band.GetOverview(level)
+        factor_x, factor_y = width / overview.XSize, height / overview.YSize
+        ox0, oy0 = math.floor(xoff / factor_x), math.floor(yoff / factor_y)
+        ox1 = min(overview.XSize, math.ceil((xoff + xsize) / factor_x))
+        oy1 = min(overview.YSize, math.ceil((yoff + ysize) / factor_y))
+        sx0, sy0 = round(ox0 * factor_x), round(oy0 * factor_y)
+        sx1, sy1 = min(width, round(ox1 * factor_x)), min(height, round(oy1 * factor_y))
+        data = band.ReadAsArray(sx0, sy0, sx1 - sx0, sy1 - sy0, buf_xsize=ox1 - ox0, buf_ysize=oy1 - oy0,
+                                resample_alg=algorithm)
+        overview.WriteArray(data, ox0, oy0)
+
+
+def update_blocks(source, target, extents, resampling='AVERAGE'):
+    """
+    Copia da ``source`` a ``target`` solo i blocchi che coprono le estensioni.
+
+    I due raster devono avere la stessa griglia; le piramidi di ``target``
+    vengono aggiornate nelle stesse aree.
+
+    :return: Numero di pixel riscritti per banda
+    """
+    source_dataset = gdal.Open(source)
+    target_dataset = gdal.Open(target, gdal.GA_Update)
+    if not _same_grid(source_dataset, target_dataset):
+        raise ValueError(f"{source} e {target} non hanno la stessa griglia.")
+    windows = _dirty_windows(target_dataset, extents)
+    for index in range(1, target_dataset.RasterCount + 1):
+        source_band = source_dataset.GetRasterBand(index)
+        target_band = target_dataset.GetRasterBand(index)
+        for window in windows:
+            target_band.WriteArray(source_band.ReadAsArray(*window), window[0], window[1])
+        for window in windows:
+            _refresh_overviews(target_band, window, resampling)
+    target_dataset.FlushCache()
+    target_dataset = source_dataset = None
+    return sum(xsize * ysize for _, _, xsize, ysize in windows)
+
+
+def refresh_mosaics(tiles_dir, output_dir, materialize_output=False, products=MOSAIC_PRODUCTS, log=print):
+    """
+    Aggiorna i mosaici dopo l'arrivo di tile nuovi o riscaricati.
+
+    I VRT vengono sempre ricreati (contengono solo l'elenco dei tile). Con
+    ``materialize_output`` un GeoTIFF esistente con la stessa griglia viene
+    aggiornato solo nei blocchi cambiati; se l'area si è estesa viene riscritto.
+
+    :return: Coppia (dizionario prefisso -> percorso del mosaico, lista delle
+             estensioni cambiate in coordinate di mappa)
+    """
+    mosaics = build_mosaics(tiles_dir, output_dir, products, log)
+    products = [product for product in products if product[0] in mosaics]
+
+    def refresh(product):
+        name, output_type, resampling = product
+        vrt = mosaics[name]
+        target = os.path.join(output_dir, f'{name}_unito.tif') if materialize_output else vrt
+        index = tile_index(find_tiles(tiles_dir, name))
+        previous = read_tile_index(target) if os.path.exists(target) else None
+        if previous is None:
+            extents = changed_extents({}, index)
+        else:
+            extents = changed_extents(previous, index)
+        if materialize_output and extents:
+            existing = gdal.Open(target) if previous is not None else None
+            incremental = existing is not None and _same_grid(gdal.Open(vrt), existing)
+            existing = None
+            if incremental:
+                pixels = update_blocks(vrt, target, extents, resampling)
+                log(f"File {name.upper()} aggiornato: {pixels} pixel riscritti in {target}")
+            else:
+                materialize(vrt, target, output_type, resampling)
+                log(f"File {name.upper()} unito salvato in: {target}")
+        write_tile_index(target, index)
+        return target, extents
+
+    with ThreadPoolExecutor(max(1, len(products))) as executor:
+        results = list(executor.map(refresh, products))
+    paths, dirty = {}, []
+    for (name, _, _), (path, extents) in zip(products, results):
+        paths[name] = path
+        dirty.extend(extent for extent in extents if extent not in dirty)
+    return paths, dirty
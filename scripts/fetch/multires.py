@@ -0,0 +1,116 @@
+"""
+Analisi a più risoluzioni da una sola lettura dei raster.
+
+Alla risoluzione più fine ogni fase salva, oltre alle colonne della griglia,
+delle statistiche sufficienti per cella (colonne ``summary_*``): conteggi e
+somme, che si sommano, e riassunti dei quantili (vedi ``sketch``), che si
+uniscono. Una griglia più grossa, con lato multiplo intero di quello fine e
+la stessa origine, ha le sue statistiche come aggregazione di quelle delle
+celle fini che contiene, senza rileggere i raster:
+
+- somme e conteggi (medie, percentuali, sky view factor) sono esatti;
+- mediane e maggioranze vengono dai riassunti dei quantili, con un errore di
+  rango di circa ``0.5 / punti`` per ogni livello di aggregazione.
+
+Esempio::
+
+    coarse = coarser_grid(grid, 100)
+    parent = parent_positions(grid, coarse)
+    summaries = aggregate_summaries({'summary_dsm_sketch': ..., 'summary_dsm_count': ...}, parent, len(coarse))
+"""
+import numpy as np
+
+from .cells import RasterGrid
+from .sketch import merge_sketches
+from .zonal import sorted_majority
+
+# Prefisso delle colonne delle statistiche sufficienti (non esportate nella griglia)
+SUMMARY_PREFIX = 'summary_'
+
+# Suffisso dei riassunti dei quantili; il conteggio dei pixel è nella colonna ``<input>_count``
+_SKETCH_SUFFIX = '_sketch'
+_COUNT_SUFFIX = '_count'
+
+
+def summary_name(name, statistic):
+    """Nome della colonna di una statistica sufficiente: ``summary_<input>_<statistica>``."""
+    return f'{SUMMARY_PREFIX}{name}_{statistic}'
+
+
+def is_summary(name):
+    """True per le colonne delle statistiche sufficienti."""
+    return name.startswith(SUMMARY_PREFIX)
+
+
+def coarser_grid(grid, cell_size):
+    """
+    Griglia con la stessa origine e un lato multiplo intero di quello della griglia fine.
+
+    :param grid: RasterGrid della risoluzione più fine
+    :param cell_size: Lato delle celle della griglia più grossa
+    :return: RasterGrid che copre tutte le celle della griglia fine
+    """
+    if not isinstance(grid, RasterGrid):
+        raise ValueError("L'analisi a più risoluzioni richiede una griglia implicita (RasterGrid).")
+    factor = cell_size / grid.cell_size
+    if factor < 1 or abs(factor - round(factor)) > 1e-6:
+        raise ValueError(f"Il lato {cell_size:g} non è multiplo intero di quello della griglia ({grid.cell_size:g}).")
+    factor = int(round(factor))
+    return RasterGrid(grid.origin_x, grid.origin_y, grid.cell_size * factor, -(-grid.ncols // factor),
+                      -(-grid.nrows // factor), grid.first_fid)
+
+
+def parent_positions(grid, coarse):
+    """
+    Posizione nella griglia più grossa della cella che contiene ogni cella fine.
+
+    :return: Array int64 allineato alle celle di ``grid``, indici nelle celle di ``coarse``
+    """
+    factor = int(round(coarse.cell_size / grid.cell_size))
+    position = (grid.rows // factor) * coarse.ncols + grid.cols // factor
+    # Le celle della griglia grossa possono essere un sottoinsieme: posizioni nel suo indice
+    lookup = np.full(coarse.ncols * coarse.nrows, -1, dtype=np.int64)
+    lookup[coarse.index] = np.arange(len(coarse))
+    return lookup[position]
+
+
+def aggregate_summaries(summaries, parent, nparents):
+    """
+    Statistiche sufficienti delle celle grosse da quelle delle celle fini.
+
+    I riassunti dei quantili (``*_sketch``) vengono uniti pesando ogni cella
+    con il suo conteggio (``*_count``); le altre colonne vengono sommate.
+
+    :param summaries: Dizionario nome -> array (celle fini, ...) delle statistiche sufficienti
+    :param parent: Posizione del genitore di ogni cella fine (-1 = cella ignorata)
+    :param nparents: Numero di celle grosse
+    :return: Dizionario nome -> array (nparents, ...)
+    """
+    parent = np.asarray(parent, dtype=np.int64)
+    valid = parent >= 0
+    aggregated = {}
+    for name, values in summaries.items():
+        values = np.asarray(values)
+        if name.endswith(_SKETCH_SUFFIX):
+            counts = np.nan_to_num(np.asarray(summaries[name[:-len(_SKETCH_SUFFIX)] + _COUNT_SUFFIX], dtype=np.float64))
+            aggregated[name] = merge_sketches(values, counts, parent, nparents)[0]
+            continue
+        total = np.zeros((nparents,) + values.shape[1:], dtype=np.result_type(values.dtype, np.int64))
+        np.add.at(total, parent[valid], np.nan_to_num(values[valid]) if values.dtype.kind == 'f' else values[valid])
+        aggregated[name] = total
+    return aggregated
+
+
+def sketch_majority(values):
+    """
+    Maggioranza per cella dai riassunti dei quantili: il valore ripetuto in più punti.
+
+    Esatta per le celle con al più tanti pixel quanti punti; per le altre ogni
+    punto rappresenta la stessa quota di pixel.
+
+    :param values: Punti (celle, punti) con NaN in coda
+    :return: Array float64, NaN per le celle senza punti
+    """
+    used = ~np.isnan(values)
+    rows, _ = np.nonzero(used)
+    return sorted_majority(rows, values[used].astype(np.float64), len(values))
@@ -0,0 +1,119 @@
+"""
+Esecuzione parallela dei calcoli per cella su più processi.
+
+L'estensione del raster viene divisa in strisce di righe i cui confini non
+tagliano nessuna cella: ogni cella è calcolata per intero da un solo processo
+e i risultati si uniscono senza cuciture. Dentro ogni striscia i blocchi letti
+seguono la stessa suddivisione di una lettura completa (vedi
+``raster.block_windows``), quindi anche le somme in virgola mobile sono
+identiche a quelle di un'esecuzione in un solo processo.
+
+I processi vengono creati con ``fork``: ereditano motore, celle e funzioni
+degli input derivati (anche lambda) senza doverli serializzare. Dove ``fork``
+non è disponibile (Windows) il calcolo resta sequenziale.
+"""
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# Strisce per processo: più strisce che processi bilanciano il carico
+CHUNKS_PER_WORKER = 4
+
+# Funzione eseguita dai processi figli, ereditata tramite fork
+_TASK = None
+
+
+def can_fork():
+    """True se i processi possono essere creati con ``fork``."""
+    return 'fork' in multiprocessing.get_all_start_methods()
+
+
+def effective_workers(workers):
+    """Numero di processi realmente utilizzabili (1 = sequenziale)."""
+    if not workers or workers <= 1 or not can_fork():
+        return 1
+    return int(workers)
+
+
+def occupied_rows(cell_labels):
+    """
+    Righe del raster che contengono pixel di almeno una cella.
+
+    :return: Coppia (prima riga, riga esclusa); (0, 0) se nessuna cella ha pixel
+    """
+    nonempty = cell_labels.row_end > cell_labels.row_start
+    if not nonempty.any():
+        return 0, 0
+    return int(cell_labels.row_start[nonempty].min()), int(cell_labels.row_end[nonempty].max())
+
+
+def plan_chunks(cell_labels, nchunks):
+    """
+    Divide le righe del raster in strisce allineate ai confini delle celle.
+
+    :param cell_labels: CellLabels del raster
+    :param nchunks: Numero di strisce desiderato (quelle prodotte possono essere meno)
+    :return: Lista di coppie (prima riga, riga esclusa) che coprono tutte le
+             righe occupate dalle celle (vedi ``occupied_rows``)
+    """
+    height = cell_labels.info.height
+    first, last = occupied_rows(cell_labels)
+    if last <= first:
+        return []
+    starts, ends = cell_labels.row_start, cell_labels.row_end
+    nonempty = ends > starts
+    # crossing[b] > 0 se almeno una cella ha pixel sia sopra sia sotto la riga b
+    crossing = np.zeros(height + 2, dtype=np.int64)
+    np.add.at(crossing, starts[nonempty] + 1, 1)
+    np.add.at(crossing, ends[nonempty], -1)
+    allowed = np.flatnonzero(np.cumsum(crossing)[:height + 1] == 0)
+
+    targets = np.linspace(first, last, max(1, nchunks) + 1)[1:-1]
+    position = np.clip(np.searchsorted(allowed, targets), 1, len(allowed) - 1)
+    before, after = allowed[position - 1], allowed[position]
+    nearest = np.clip(np.where(targets - before <= after - targets, before, after), first, last)
+    bounds = np.unique(np.concatenate(([first], nearest, [last])))
+    return [(int(start), int(stop)) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+
+def split_rows(cell_labels, workers):
+    """
+    Strisce da elaborare con ``workers`` processi: le righe occupate dalle
+    celle in un'unica striscia se il calcolo è sequenziale, altrimenti
+    ``CHUNKS_PER_WORKER`` strisce per processo. Le righe senza celle non
+    vengono lette, quindi un sottoinsieme di celle legge solo le sue righe.
+    """
+    if workers <= 1:
+        first, last = occupied_rows(cell_labels)
+        return [(first, last)] if last > first else []
+    return plan_chunks(cell_labels, workers * CHUNKS_PER_WORKER)
+
+
+def owned_cells(cell_labels, row_start, row_stop):
+    """Maschera delle celle con tutti i pixel nella striscia ``row_start:row_stop``."""
+    return ((cell_labels.row_start >= row_start) & (cell_labels.row_end <= row_stop)
+            & (cell_labels.row_end > cell_labels.row_start))
+
+
+def _run_task(chunk):
+    return _TASK(*chunk)
+
+
+def map_chunks(func, chunks, workers):
+    """
+    Applica ``func(row_start, row_stop)`` a ogni striscia.
+
+    :param workers: Numero massimo di processi (1 o None = sequenziale)
+    :return: Lista dei risultati nell'ordine di ``chunks``
+    """
+    global _TASK
+    workers = min(effective_workers(workers), len(chunks))
+    if workers <= 1:
+        return [func(*chunk) for chunk in chunks]
+    _TASK = func
+    try:
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork')) as executor:
+            return list(executor.map(_run_task, chunks))
+    finally:
+        _TASK = None
@@ -0,0 +1,662 @@
+"""
+Pipeline headless: dai tile scaricati alla classe LCZ per cella, senza QGIS.
+
+Ogni fase corrisponde a uno o più script numerati, ma si scambia percorsi e
+array attraverso un contesto comune invece del registro dei layer di QGIS e
+delle finestre di dialogo. Non importa ``qgis`` né ``qgis.utils.iface``:
+bastano NumPy, GDAL e statsmodels.
+
+Configurazione (file JSON)::
+
+    {
+        "tiles_dir": "/dati/area_1",            # tile dsm_*, rgb_*, mask_*
+        "class_raster": "/dati/area_1/class.tif",
+        "albedo_raster": null,                   # opzionale (script 13)
+        "cell_size": 30,                         # lato delle celle (script 03)
+        "work_dir": null,                        # default: <tiles_dir>/fetch
+        "output": "grid.gpkg",                   # relativo a work_dir
+        "stages": null,                          # opzionale: sottoinsieme di STAGES
+        "cache": true,                           # riusa le fasi con input invariati
+        "cache_dir": null,                       # default: ~/.cache/fetch
+        "cache_max_mb": 10240,
+        "workers": null,                         # processi per i calcoli per cella (default: tutti i core)
+        "materialize_mosaics": false,            # scrive anche i GeoTIFF dei mosaici (default: solo VRT)
+        "incremental": true,                     # ricalcola solo le celle con input cambiati
+        "raster_cache_mb": 256,                  # cache LRU dei blocchi raster letti (0 = disattivata)
+        "distance_units": "geo",                 # distanze dagli edifici in metri ("pixel" come gdal:proximity)
+        "distance_max": null,                    # distanza massima: oltre è nodata, calcolo a strisce in parallelo
+        "svf_azimuths": 16,                      # direzioni della ricerca dell'orizzonte per lo sky view factor
+        "svf_radius": 100,                       # raggio di ricerca dell'orizzonte (metri)
+        "svf_stride": 1,                         # SVF su un pixel ogni svf_stride (2 basta per un DSM a 0.5 m)
+        "resolutions": [],                       # lati di griglie più grosse, multipli di cell_size (es. [90, 180])
+        "sketch_points": 64,                     # punti per cella dei riassunti dei quantili delle altre risoluzioni
+        "median_error": null                     # errore di rango delle mediane approssimate (es. 0.01; null = esatte)
+    }
+
+Con ``resolutions`` le fasi salvano anche statistiche sufficienti per cella
+(vedi ``multires``) e la fase ``resolutions`` ne ricava le colonne LCZ delle
+griglie più grosse senza rileggere i raster; ``export`` scrive una griglia
+per risoluzione (``grid_100m.gpkg``...).
+
+Uso dalla cartella ``scripts``::
+
+    python -m fetch.pipeline config.json
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+
+from .cache import DEFAULT_MAX_BYTES, StageCache
+from .cells import CellLabels, RasterGrid, cell_bounds, cell_fids, select_cells
+from .distance import distance_raster
+from .dtm import dsm_to_dtm
+from .incremental import FingerprintStore, stale_cells
+from .landcover import build_landcover_raster, landcover_counts, percentages_from_counts
+from .mosaic import MOSAIC_PRODUCTS, build_mosaics, find_tiles, materialize_mosaics
+from .multires import (aggregate_summaries, coarser_grid, is_summary, parent_positions, sketch_majority,
+                       summary_name)
+from .raster import DEFAULT_CACHE_MB, raster_info, raster_inputs, set_cache_size
+from .records import CellStore
+from .roughness import ROUGHNESS_INPUTS, add_roughness_inputs, roughness_columns
+from .sketch import DEFAULT_POINTS, sketch_median
+from .svf import DEFAULT_AZIMUTHS, DEFAULT_RADIUS, sky_view_factor_totals, svf_from_totals
+from .vector import write_grid
+from .zonal import ZonalEngine
+
+# Soglia di pendenza (gradi) per i pixel di terreno, come in 07_make_dtm.py
+DTM_MAX_SLOPE = 5.71
+
+# Valore di nodata dei raster in virgola mobile scritti dalla pipeline
+NODATA = -9999.0
+
+# Distanza mediana delle celle senza pixel a distanza diversa da 0, come nello script 09
+EMPTY_DISTANCE = 0.001
+
+
+class PipelineContext:
+    """
+    Stato condiviso tra le fasi: configurazione, percorsi dei raster, celle
+    della griglia e colonne di attributi per cella.
+
+    Le colonne prodotte da ogni fase sono salvate anche nell'archivio per cella
+    ``<work_dir>/cells`` (``records.CellStore``): le fasi successive, anche in
+    esecuzioni separate, le rileggono da lì senza passare dalla griglia.
+    """
+
+    def __init__(self, config, log=print):
+        if not config.get('tiles_dir'):
+            raise ValueError("La configurazione deve indicare 'tiles_dir'.")
+        self.config = config
+        self.tiles_dir = config['tiles_dir']
+        self.work_dir = config.get('work_dir') or os.path.join(self.tiles_dir, 'fetch')
+        os.makedirs(self.work_dir, exist_ok=True)
+        self.log = log
+        self.workers = config.get('workers') or os.cpu_count()
+        self.paths = {}
+        self.cells = None
+        self.columns = {}
+        self.store = CellStore(self.work_path('cells'))
+
+    def work_path(self, name):
+        """Percorso di un file di lavoro di questa esecuzione."""
+        return os.path.join(self.work_dir, name)
+
+    def require(self, *names):
+        """Percorsi dei raster richiesti da una fase."""
+        missing = [name for name in names if name not in self.paths]
+        if missing:
+            raise ValueError(f"Raster non disponibili: {', '.join(missing)}. Eseguire prima le fasi precedenti.")
+        return [self.paths[name] for name in names]
+
+    def column(self, name):
+        """Colonna per cella prodotta in questa esecuzione o salvata nell'archivio per cella."""
+        if name in self.columns:
+            return self.columns[name]
+        if self.cells is not None and name in self.store:
+            return self.store.read(name, self.fids)
+        raise ValueError(f"Colonna '{name}' non disponibile. Eseguire prima la fase che la calcola.")
+
+    @property
+    def fids(self):
+        """ID delle celle della griglia."""
+        return cell_fids(self.cells)
+
+    @property
+    def summary_points(self):
+        """Punti dei riassunti dei quantili per cella, o None se non sono richieste altre risoluzioni."""
+        if not self.config.get('resolutions'):
+            return None
+        return int(self.config.get('sketch_points') or DEFAULT_POINTS)
+
+    def summary_params(self, params=None):
+        """Parametri di una fase con il numero di punti dei riassunti, se richiesti."""
+        if self.summary_points is None:
+            return params
+        return dict(params or {}, summary_points=self.summary_points)
+
+    @property
+    def median_error(self):
+        """Errore di rango ammesso per le mediane per cella, o None per mediane esatte."""
+        return self.config.get('median_error')
+
+    def median_params(self, params):
+        """Parametri di una fase che calcola mediane, con l'errore ammesso se sono approssimate."""
+        params = self.summary_params(params)
+        if self.median_error is None:
+            return params
+        return dict(params or {}, median_error=self.median_error)
+
+    def labels_for(self, raster):
+        """Etichette di cella allineate a un raster."""
+        if self.cells is None:
+            raise ValueError("Griglia non disponibile. Eseguire prima la fase 'grid'.")
+        return CellLabels(self.cells, raster_info(raster))
+
+
+def cell_columns(context, stage, rasters, compute, params=None, version=1, neighbours=False):
+    """
+    Colonne per cella di una fase, ricalcolando solo le celle i cui pixel di input sono cambiati.
+
+    Impronte e valori dell'ultima esecuzione sono salvati in ``<work_dir>/fingerprints``;
+    con ``"incremental": false`` tutte le celle vengono sempre ricalcolate.
+
+    :param rasters: Raster di input della fase
+    :param compute: Funzione che riceve una lista di celle e restituisce un
+                    dizionario nome della colonna -> valori allineati alle celle
+    :param params: Parametri della fase che influiscono sul risultato
+    :param version: Versione dell'algoritmo della fase (da incrementare quando cambia il risultato)
+    :param neighbours: Se True ricalcola anche le celle adiacenti a una cella cambiata
+                       (vedi ``incremental.stale_cells``)
+    :return: Dizionario nome della colonna -> valori allineati a ``context.cells``
+    """
+    if not context.config.get('incremental', True):
+        return compute(context.cells)
+    store = FingerprintStore(context.work_path('fingerprints'))
+    fingerprints, stale = stale_cells(store, stage, context.cells, rasters, version, params, neighbours)
+    fids = context.fids
+    previous = None if stale.all() else store.load(stage)
+    if previous is None or not set(previous) - {'fids', 'fingerprints'}:
+        # Senza i valori dell'esecuzione precedente si ricalcola tutto
+        previous = None
+        stale[:] = True
+    computed = compute(select_cells(context.cells, stale)) if stale.any() else {}
+    if previous is None:
+        columns = computed
+    else:
+        order = np.argsort(previous['fids'])
+        kept = order[np.searchsorted(previous['fids'][order], fids[~stale])]
+        columns = {}
+        for name in previous:
+            if name in ('fids', 'fingerprints'):
+                continue
+            values = previous[name]
+            if name in computed:
+                values = np.empty((len(fids),) + values.shape[1:], dtype=np.result_type(values, computed[name]))
+                values[stale] = computed[name]
+            else:
+                values = np.empty((len(fids),) + values.shape[1:], dtype=values.dtype)
+            values[~stale] = previous[name][kept]
+            columns[name] = values
+    store.save(stage, fids, fingerprints, columns)
+    context.log(f"Fase '{stage}': {int(stale.sum())} celle ricalcolate su {len(fids)}")
+    return columns
+
+
+def stage_merge(context):
+    """01: mosaico virtuale (VRT) dei tile DSM, RGB e MASK, letto a finestre dalle fasi successive."""
+    context.paths.update(build_mosaics(context.tiles_dir, context.work_dir, log=context.log))
+
+
+def stage_materialize(context):
+    """01: GeoTIFF a blocchi compressi dei mosaici, solo se richiesto dalla configurazione."""
+    if not context.config.get('materialize_mosaics'):
+        return
+    mosaics = {product: context.paths[product] for product, _, _ in MOSAIC_PRODUCTS if product in context.paths}
+    context.paths.update(materialize_mosaics(mosaics, context.work_dir, log=context.log))
+
+
+def stage_import(context):
+    """02: verifica i raster di input e registra quelli esterni ai tile."""
+    for name in ('rgb', 'dsm', 'mask'):
+        if name not in context.paths:
+            for extension in ('.tif', '.vrt'):
+                candidate = context.work_path(f'{name}_unito{extension}')
+                if os.path.exists(candidate):
+                    context.paths[name] = candidate
+                    break
+    for name in ('class', 'albedo'):
+        path = context.config.get(f'{name}_raster')
+        if path:
+            if not os.path.exists(path):
+                raise ValueError(f"Raster '{name}' non trovato: {path}")
+            context.paths[name] = path
+    context.require('rgb', 'dsm', 'mask', 'class')
+
+
+def stage_grid(context):
+    """03: crea la griglia di analisi sull'estensione del raster RGB."""
+    cell_size = float(context.config.get('cell_size', 30))
+    if cell_size <= 0:
+        raise ValueError("La dimensione della cella deve essere positiva.")
+    rgb, = context.require('rgb')
+    # Griglia implicita: i poligoni vengono creati solo nell'esportazione
+    context.cells = RasterGrid.from_extent(raster_info(rgb).extent, cell_size)
+    context.store.set_fids(context.fids)
+    context.log(f"Griglia creata: {len(context.cells)} celle da {cell_size} m")
+
+
+def stage_landcover_raster(context):
+    """04-05: raster impermeabile (0) / permeabile (1) / edifici (2)."""
+    class_path, mask_path = context.require('class', 'mask')
+    context.paths['landcover'] = build_landcover_raster(class_path, mask_path,
+                                                        context.work_path('raster_modified.tif'))
+
+
+def stage_landcover(context):
+    """06: percentuali di copertura del suolo per cella."""
+    landcover, = context.require('landcover')
+
+    def compute(cells):
+        counts = landcover_counts(landcover, CellLabels(cells, raster_info(landcover)), workers=context.workers)
+        columns = percentages_from_counts(counts)
+        if context.summary_points:
+            columns[summary_name('landcover', 'count')] = counts
+        return columns
+
+    context.columns.update(cell_columns(context, 'landcover', [landcover], compute, params=context.summary_params()))
+
+
+def stage_dtm(context):
+    """07: DTM dai pixel del DSM con pendenza <= 5.71 gradi, esclusi gli edifici."""
+    dsm_path, mask_path = context.require('dsm', 'mask')
+    context.paths['dtm'] = dsm_to_dtm(dsm_path, mask_path, context.work_path('dtm.tif'),
+                                      max_slope=DTM_MAX_SLOPE, nodata=NODATA)
+
+
+def stage_distance_raster(context):
+    """08-09: raster delle distanze esatte dagli edifici (vedi ``distance.distance_raster``)."""
+    mask_path, = context.require('mask')
+    context.paths['distance'] = distance_raster(
+        mask_path, context.work_path('distance_raster.tif'), units=context.config.get('distance_units', 'geo'),
+        max_distance=context.config.get('distance_max'), nodata=NODATA, workers=context.workers)
+
+
+def stage_distance(context):
+    """09: distanza mediana per cella, esclusi i pixel a 0 (0.001 per le celle vuote)."""
+    distance, = context.require('distance')
+    points = context.summary_points
+
+    def compute(cells):
+        engine = ZonalEngine(cells, workers=context.workers, sketch_points=points, median_error=context.median_error)
+        engine.add('distance', distance)
+        # Pixel a 0 esclusi, come ``val != 0`` nello script 09
+        engine.add_derived('nonzero', lambda distance: np.where(distance == 0, np.nan, distance), ['distance'],
+                           ['median', 'count', 'sketch'] if points else ['median', 'count'], nan_sources=True)
+        results = engine.run()['nonzero']
+        columns = {'median_dist': np.where(results['count'] > 0, results['median'], EMPTY_DISTANCE)}
+        if points:
+            columns[summary_name('distance', 'sketch')] = results['sketch']
+            columns[summary_name('distance', 'count')] = results['count']
+        return columns
+
+    context.columns.update(cell_columns(context, 'distance', [distance], compute, params=context.median_params(
+        {'exclude_zero': True, 'empty_value': EMPTY_DISTANCE})))
+
+
+def stage_heights(context):
+    """
+    10-11: mediane di DSM, DTM e DSM*MASK, altezza degli elementi di rugosità e,
+    nella stessa lettura, lunghezza di rugosità e classe di Davenport.
+    """
+    dsm, dtm, mask = context.require('dsm', 'dtm', 'mask')
+    pixel_width = raster_info(dsm).pixel_width
+    points = context.summary_points
+    statistics = ['median', 'count', 'sketch'] if points else ['median']
+
+    def compute(cells):
+        engine = ZonalEngine(cells, workers=context.workers, sketch_points=points, median_error=context.median_error)
+        engine.add('dsm', dsm, statistics)
+        engine.add('dtm', dtm, statistics)
+        engine.add('mask', mask)
+        engine.add_derived('med', lambda dsm, mask: dsm.astype(np.float32) * mask, ['dsm', 'mask'], statistics)
+        add_roughness_inputs(engine, statistics=('mean', 'count', 'sum') if points else ('mean',))
+        results = engine.run()
+        columns = _height_columns({name: results[name]['median'] for name in ('dsm', 'dtm', 'med')})
+        columns.update(roughness_columns(results, pixel_width))
+        if points:
+            for name in ('dsm', 'dtm', 'med'):
+                columns[summary_name(name, 'sketch')] = results[name]['sketch']
+                columns[summary_name(name, 'count')] = results[name]['count']
+            for name in ROUGHNESS_INPUTS:
+                columns[summary_name(name, 'sum')] = results[name]['sum']
+                columns[summary_name(name, 'count')] = results[name]['count']
+        return columns
+
+    # Versione 2: con la rugosità. Il salto di altezza usa il primo pixel della cella a destra
+    context.columns.update(cell_columns(context, 'heights', [dsm, dtm, mask], compute,
+                                        params=context.median_params(None), version=2, neighbours=True))
+
+
+def _height_columns(medians):
+    """Colonne delle altezze dalle mediane di DSM, DTM e DSM*MASK (chiavi 'dsm', 'dtm', 'med')."""
+    return {
+        'med_median': np.nan_to_num(medians['med'], nan=0.0),
+        'dtm_median': medians['dtm'],
+        'dsm_median': medians['dsm'],
+        'Height_rou': medians['dsm'] - medians['dtm'],
+    }
+
+
+def stage_sky_view_factor(context):
+    """Sky view factor medio per cella dal DSM (vedi ``svf.sky_view_factor_by_cell``)."""
+    dsm, mask = context.require('dsm', 'mask')
+    config = context.config
+    totals = sky_view_factor_totals(
+        dsm, context.labels_for(dsm), mask=mask, azimuths=config.get('svf_azimuths') or DEFAULT_AZIMUTHS,
+        radius=config.get('svf_radius') or DEFAULT_RADIUS, stride=config.get('svf_stride') or 1,
+        workers=context.workers)
+    context.columns['sky_view_factor'] = svf_from_totals(totals)
+    if context.summary_points:
+        context.columns[summary_name('svf', 'totals')] = totals.T
+
+
+def stage_aspect_ratio(context):
+    """
+    12: rapporto d'aspetto altezza / distanza mediana.
+
+    A differenza dello script 12, che legge il campo ``mean_build_height``
+    preparato dall'utente nella griglia, la pipeline non ha una griglia
+    modificabile a mano: l'altezza media degli edifici è la mediana di
+    DSM*MASK (``med_median``, fase 'heights'), scritta anche come ``mean_build_height``.
+    """
+    building_height = np.asarray(context.column('med_median'))
+    context.columns.update(_aspect_ratio_columns(context.column('median_dist'), building_height))
+
+
+def _aspect_ratio_columns(median_dist, building_height):
+    """Distanza mediana (almeno 1), altezza media degli edifici e rapporto d'aspetto."""
+    median_dist = np.asarray(median_dist, dtype=np.float64)
+    median_dist = np.where(np.isnan(median_dist) | (median_dist < 1), 1.0, median_dist)
+    return {'median_dist': median_dist, 'mean_build_height': building_height,
+            'aspect_ratio': building_height / median_dist}
+
+
+def stage_albedo(context):
+    """13: albedo come maggioranza per cella, normalizzata su 10000."""
+    if 'albedo' not in context.paths:
+        context.log("Raster 'albedo' non configurato: fase saltata.")
+        return
+    albedo = context.paths['albedo']
+    points = context.summary_points
+
+    def compute(cells):
+        engine = ZonalEngine(cells, workers=context.workers, sketch_points=points)
+        engine.add('albedo', albedo, ['majority', 'count', 'sketch'] if points else ['majority'])
+        results = engine.run()['albedo']
+        columns = {'albedo_majority': results['majority'] / 10000}
+        if points:
+            columns[summary_name('albedo', 'sketch')] = results['sketch']
+            columns[summary_name('albedo', 'count')] = results['count']
+        return columns
+
+    context.columns.update(cell_columns(context, 'albedo', [albedo], compute, params=context.summary_params()))
+
+
+def stage_classify(context):
+    """14: classe LCZ e RMSEP per ogni cella, dai 10 parametri letti come matrice dall'archivio per cella."""
+    from .lcz import classify_batch, store_parameter_matrix
+
+    if context.cells is None:
+        raise ValueError("Griglia non disponibile. Eseguire prima la fase 'grid'.")
+    result = classify_batch(store_parameter_matrix(context.store, context.fids))
+    context.columns['lcz_class'] = result['lcz_class']
+    context.columns['lcz_rmsep'] = result['rmsep']
+
+
+def summary_columns(summaries, pixel_width):
+    """
+    Colonne delle fasi per cella dalle statistiche sufficienti, anche aggregate su celle più grosse.
+
+    Le colonne delle fasi senza statistiche sufficienti mancano dal risultato.
+
+    :param summaries: Dizionario nome -> array delle colonne ``summary_*`` (vedi ``multires``)
+    :param pixel_width: Lato del pixel del DSM, per l'indice di area frontale
+    :return: Dizionario nome della colonna -> valori
+    """
+    def sketch(name):
+        return summaries.get(summary_name(name, 'sketch'))
+
+    def count(name):
+        return np.asarray(summaries[summary_name(name, 'count')], dtype=np.float64)
+
+    columns = {}
+    if summary_name('landcover', 'count') in summaries:
+        columns.update(percentages_from_counts(np.asarray(summaries[summary_name('landcover', 'count')])))
+    if sketch('distance') is not None:
+        columns['median_dist'] = np.where(count('distance') > 0, sketch_median(sketch('distance')), EMPTY_DISTANCE)
+    if all(sketch(name) is not None for name in ('dsm', 'dtm', 'med')):
+        columns.update(_height_columns({name: sketch_median(sketch(name)) for name in ('dsm', 'dtm', 'med')}))
+    if all(summary_name(name, 'sum') in summaries for name in ROUGHNESS_INPUTS):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = {name: {'mean': np.where(count(name) > 0, summaries[summary_name(name, 'sum')] / count(name),
+                                             np.nan)} for name in ROUGHNESS_INPUTS}
+        columns.update(roughness_columns(means, pixel_width))
+    if summary_name('svf', 'totals') in summaries:
+        columns['sky_view_factor'] = svf_from_totals(np.asarray(summaries[summary_name('svf', 'totals')]).T)
+    if 'median_dist' in columns and 'med_median' in columns:
+        columns.update(_aspect_ratio_columns(columns['median_dist'], columns['med_median']))
+    if sketch('albedo') is not None:
+        columns['albedo_majority'] = sketch_majority(sketch('albedo')) / 10000
+    return columns
+
+
+def _resolution_grids(context):
+    """Coppie (lato, griglia) delle risoluzioni più grosse richieste dalla configurazione."""
+    if context.cells is None:
+        raise ValueError("Griglia non disponibile. Eseguire prima la fase 'grid'.")
+    return [(float(size), coarser_grid(context.cells, float(size))) for size in context.config.get('resolutions') or []]
+
+
+def _resolution_store(context, size):
+    """Archivio per cella di una risoluzione: ``<work_dir>/cells_<lato>m``."""
+    return CellStore(context.work_path(f'cells_{size:g}m'))
+
+
+def stage_resolutions(context):
+    """
+    Colonne e classe LCZ delle griglie più grosse (``"resolutions"``), aggregando
+    le statistiche sufficienti delle celle fini senza rileggere i raster.
+    """
+    from .lcz import classify_batch, store_parameter_matrix
+
+    grids = _resolution_grids(context)
+    if not grids:
+        return
+    dsm, = context.require('dsm')
+    names = sorted({name for name in list(context.columns) + context.store.names if is_summary(name)})
+    if not names:
+        raise ValueError("Statistiche per cella non disponibili: eseguire le fasi con 'resolutions' configurato.")
+    summaries = {name: np.asarray(context.column(name)) for name in names}
+    for size, grid in grids:
+        aggregated = aggregate_summaries(summaries, parent_positions(context.cells, grid), len(grid))
+        columns = summary_columns(aggregated, raster_info(dsm).pixel_width)
+        store = _resolution_store(context, size)
+        store.set_fids(grid.fids)
+        store.write(grid.fids, columns)
+        result = classify_batch(store_parameter_matrix(store, grid.fids))
+        store.write(grid.fids, {'lcz_class': result['lcz_class'], 'lcz_rmsep': result['rmsep']})
+        context.log(f"Risoluzione {size:g} m: {len(grid)} celle da {len(names)} statistiche per cella")
+
+
+def stage_export(context):
+    """Scrive la griglia con tutti gli attributi calcolati (e una griglia per ogni risoluzione più grossa)."""
+    output = context.work_path(context.config.get('output') or 'grid.gpkg')
+    projection = raster_info(context.paths['rgb']).projection if 'rgb' in context.paths else ''
+    # Unico punto in cui le colonne per cella vengono unite alle geometrie
+    columns = context.store.columns([name for name in context.store.names if not is_summary(name)], context.fids)
+    context.paths['grid'] = write_grid(output, context.cells, columns, projection)
+    context.log(f"Griglia salvata in: {output}")
+    root, extension = os.path.splitext(output)
+    for size, grid in _resolution_grids(context):
+        store = _resolution_store(context, size)
+        if not store.names:
+            continue
+        path = write_grid(f'{root}_{size:g}m{extension}', grid, store.columns(fids=grid.fids), projection)
+        context.log(f"Griglia a {size:g} m salvata in: {path}")
+
+
+STAGES = (
+    ('merge', stage_merge),
+    ('materialize', stage_materialize),
+    ('import', stage_import),
+    ('grid', stage_grid),
+    ('landcover_raster', stage_landcover_raster),
+    ('landcover', stage_landcover),
+    ('dtm', stage_dtm),
+    ('distance_raster', stage_distance_raster),
+    ('distance', stage_distance),
+    ('heights', stage_heights),
+    ('sky_view_factor', stage_sky_view_factor),
+    ('aspect_ratio', stage_aspect_ratio),
+    ('albedo', stage_albedo),
+    ('resolutions', stage_resolutions),
+    ('classify', stage_classify),
+    ('export', stage_export),
+)
+
+
+class StageSpec:
+    """
+    Dipendenze di una fase memorizzabile nella cache.
+
+    :param version: Versione dell'algoritmo della fase
+    :param rasters: Raster di input (chiavi di ``context.paths``)
+    :param grid: True se il risultato dipende dalla griglia
+    :param tiles: True se la fase legge i tile scaricati
+    :param params: Chiavi della configurazione da cui dipende il risultato
+    :param summaries: True se la fase salva le statistiche sufficienti delle altre risoluzioni
+    """
+
+    def __init__(self, version, rasters=(), grid=False, tiles=False, params=(), summaries=False):
+        self.version = version
+        self.rasters = rasters
+        self.grid = grid
+        self.tiles = tiles
+        self.params = params
+        self.summaries = summaries
+
+
+# Fasi memorizzabili nella cache. Le altre sono economiche (come i mosaici
+# virtuali, che contengono solo i percorsi dei tile) o dipendono da colonne
+# modificate in place e vengono sempre rieseguite.
+CACHE_SPECS = {
+    'materialize': StageSpec(1, tiles=True, params=('materialize_mosaics',)),
+    'landcover_raster': StageSpec(2, rasters=('class', 'mask')),
+    'landcover': StageSpec(1, rasters=('landcover',), grid=True, summaries=True),
+    'dtm': StageSpec(2, rasters=('dsm', 'mask')),
+    'distance_raster': StageSpec(2, rasters=('mask',), params=('distance_units', 'distance_max')),
+    'distance': StageSpec(1, rasters=('distance',), grid=True, params=('median_error',), summaries=True),
+    'heights': StageSpec(2, rasters=('dsm', 'dtm', 'mask'), grid=True, params=('median_error',), summaries=True),
+    'sky_view_factor': StageSpec(1, rasters=('dsm', 'mask'), grid=True,
+                                 params=('svf_azimuths', 'svf_radius', 'svf_stride'), summaries=True),
+    'albedo': StageSpec(1, rasters=('albedo',), grid=True, summaries=True),
+}
+
+
+def _grid_signature(cells):
+    """Array che identifica la griglia: ID e limiti di ogni cella."""
+    return np.column_stack([cell_fids(cells).astype(np.float64), cell_bounds(cells)])
+
+
+def _run_stage(context, name, stage, cache):
+    """Esegue una fase, riusando il risultato in cache se gli input non sono cambiati."""
+    spec = CACHE_SPECS.get(name)
+    if cache is None or spec is None or any(raster not in context.paths for raster in spec.rasters) \
+            or (spec.grid and context.cells is None):
+        stage(context)
+        return
+
+    inputs = {}
+    for raster in spec.rasters:
+        inputs.update(raster_inputs(raster, context.paths[raster]))
+    if spec.tiles:
+        for product, _, _ in MOSAIC_PRODUCTS:
+            inputs.update({os.path.basename(path): path for path in find_tiles(context.tiles_dir, product)})
+    arrays = {'grid': _grid_signature(context.cells)} if spec.grid else None
+    params = {param: context.config.get(param) for param in spec.params}
+    if spec.summaries and context.summary_points:
+        params['summary_points'] = context.summary_points
+    key = cache.key(name, spec.version, inputs, params=params, arrays=arrays)
+
+    entry = cache.get(key)
+    if entry is not None:
+        context.log(f"Fase '{name}': risultato in cache")
+    else:
+        paths_before = dict(context.paths)
+        columns_before = dict(context.columns)
+        stage(context)
+        files = {raster: path for raster, path in context.paths.items() if paths_before.get(raster) != path}
+        arrays = {column: values for column, values in context.columns.items()
+                  if columns_before.get(column) is not values}
+        entry = cache.put(key, files, arrays)
+    context.paths.update(entry['files'])
+    context.columns.update(entry['arrays'])
+
+
+def run_pipeline(config, stages=None, log=print):
+    """
+    Esegue la pipeline.
+
+    :param config: Dizionario di configurazione (vedi docstring del modulo)
+    :param stages: Nomi delle fasi da eseguire (default: ``config['stages']`` o tutte)
+    :param log: Funzione usata per i messaggi di avanzamento
+    :return: PipelineContext con percorsi e colonne prodotti
+    """
+    names = [name for name, _ in STAGES]
+    selected = stages or config.get('stages') or names
+    unknown = set(selected) - set(names)
+    if unknown:
+        raise ValueError(f"Fasi sconosciute: {', '.join(sorted(unknown))}")
+
+    set_cache_size(config.get('raster_cache_mb', DEFAULT_CACHE_MB))
+    cache = None
+    if config.get('cache', True):
+        max_bytes = config['cache_max_mb'] * 1024 ** 2 if config.get('cache_max_mb') else DEFAULT_MAX_BYTES
+        cache = StageCache(config.get('cache_dir'), max_bytes)
+
+    context = PipelineContext(config, log)
+    try:
+        for name, stage in STAGES:
+            if name in selected:
+                log(f"Fase '{name}'...")
+                columns_before = dict(context.columns)
+                _run_stage(context, name, stage, cache)
+                changed = {column: values for column, values in context.columns.items()
+                           if columns_before.get(column) is not values}
+                if changed and context.cells is not None:
+                    context.store.write(context.fids, changed)
+    finally:
+        # I percorsi del contesto restano validi fino alla fine dell'esecuzione
+        if cache is not None:
+            cache.release()
+    return context
+
+
+def load_config(path):
+    """Legge la configurazione da un file JSON."""
+    with open(path, encoding='utf-8') as handle:
+        return json.load(handle)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pipeline FETCH headless: dai tile alla classe LCZ per cella.")
+    parser.add_argument('config', help="File di configurazione JSON")
+    parser.add_argument('--stages', nargs='+', help="Fasi da eseguire (default: tutte)")
+    args = parser.parse_args(argv)
+    run_pipeline(load_config(args.config), args.stages)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+"""
+Vettorializzazione a strisce dei soli pixel in primo piano di una maschera.
+
+Sostituisce ``gdal:polygonize`` seguito dalla cancellazione dei poligoni con
+``value = 0`` dello script 04: ``gdal.Polygonize`` viene eseguito nel
+processo su una striscia di righe alla volta, con una banda maschera che
+esclude lo sfondo (0 e nodata), quindi l'enorme poligono dello sfondo non
+viene mai creato, scritto o cancellato. I poligoni di ogni striscia vengono
+scritti nel GeoPackage in un'unica transazione.
+
+Un edificio attraversato dal bordo tra due strisce viene diviso in frammenti.
+Con ``merge_seams`` i poligoni che toccano un bordo interno vengono tenuti da
+parte e, alla fine, uniti con gli altri frammenti dello stesso valore: il
+risultato copre gli stessi pixel, con gli stessi poligoni, di una
+vettorializzazione unica (con ``eight_connected`` i pixel uniti solo in
+diagonale attraverso un bordo restano poligoni distinti). In memoria restano
+solo la striscia corrente e i frammenti sui bordi.
+
+Esempio::
+
+    polygonize_mask('mask_unito.vrt', 'mask_unito_buildings.gpkg', simplify=0.25)
+"""
+import os
+from collections import defaultdict
+
+import numpy as np
+from osgeo import gdal, ogr, osr
+
+from .raster import RasterReader, block_windows, raster_info, rows_per_block
+
+gdal.UseExceptions()
+ogr.UseExceptions()
+
+
+def _foreground(block, nodata):
+    """Pixel in primo piano di un blocco: diversi da 0, da nodata e da NaN."""
+    foreground = block != 0
+    if np.issubdtype(block.dtype, np.floating):
+        foreground &= ~np.isnan(block)
+    if nodata is not None:
+        foreground &= block != nodata
+    return foreground
+
+
+def _strip_dataset(array, geotransform, gdal_type):
+    """Dataset in memoria di una striscia, con la geotrasformazione della sua prima riga."""
+    dataset = gdal.GetDriverByName('MEM').Create('', array.shape[1], array.shape[0], 1, gdal_type)
+    dataset.SetGeoTransform(geotransform)
+    dataset.GetRasterBand(1).WriteArray(array)
+    return dataset
+
+
+def _polygonize_strip(block, geotransform, nodata, field, eight_connected):
+    """
+    Poligoni dei pixel in primo piano di una striscia.
+
+    :return: Lista di coppie (geometria OGR, valore del pixel)
+    """
+    values = _strip_dataset(np.asarray(block, dtype=np.int32), geotransform, gdal.GDT_Int32)
+    mask = _strip_dataset(_foreground(block, nodata).astype(np.uint8), geotransform, gdal.GDT_Byte)
+    datasource = ogr.GetDriverByName('Memory').CreateDataSource('')
+    layer = datasource.CreateLayer('strip', None, ogr.wkbPolygon)
+    layer.CreateField(ogr.FieldDefn(field, ogr.OFTInteger))
+    options = ['8CONNECTED=8'] if eight_connected else []
+    gdal.Polygonize(values.GetRasterBand(1), mask.GetRasterBand(1), layer, 0, options)
+    return [(feature.GetGeometryRef().Clone(), feature.GetField(field)) for feature in layer]
+
+
+def _polygon_parts(geometry):
+    """Poligoni semplici di una geometria (un poligono o un multipoligono)."""
+    if ogr.GT_Flatten(geometry.GetGeometryType()) == ogr.wkbPolygon:
+        return [geometry]
+    return [geometry.GetGeometryRef(index).Clone() for index in range(geometry.GetGeometryCount())]
+
+
+def _merge_fragments(fragments):
+    """Unisce i frammenti adiacenti di uno stesso valore: lista di poligoni."""
+    collection = ogr.Geometry(ogr.wkbMultiPolygon)
+    for fragment in fragments:
+        collection.AddGeometry(fragment)
+    return _polygon_parts(collection.UnionCascaded())
+
+
+class _PolygonWriter:
+    """Scrive i poligoni in un layer, semplificandoli se richiesto."""
+
+    def __init__(self, layer, field, simplify):
+        self.layer = layer
+        self.definition = layer.GetLayerDefn()
+        self.field = field
+        self.simplify = simplify
+        self.count = 0
+
+    def write(self, geometry, value):
+        """Scrive un poligono con il valore del pixel."""
+        if self.simplify:
+            geometry = geometry.SimplifyPreserveTopology(self.simplify)
+            if geometry is None or geometry.IsEmpty():
+                return
+        for part in _polygon_parts(geometry):
+            feature = ogr.Feature(self.definition)
+            feature.SetGeometry(part)
+            feature.SetField(self.field, int(value))
+            self.layer.CreateFeature(feature)
+            self.count += 1
+
+
+def polygonize_mask(mask, output, band=1, layer_name='buildings', field='value', eight_connected=False,
+                    merge_seams=True, simplify=None, block_rows=None):
+    """
+    Vettorializza i pixel in primo piano di una maschera in un GeoPackage.
+
+    :param mask: Raster della maschera (percorso o layer QGIS)
+    :param output: Percorso del file .gpkg (viene sovrascritto)
+    :param layer_name: Nome del layer scritto
+    :param field: Campo con il valore dei pixel di ogni poligono (come FIELD di gdal:polygonize)
+    :param eight_connected: Se True unisce anche i pixel adiacenti in diagonale
+    :param merge_seams: Se True unisce i frammenti divisi dai bordi delle strisce
+    :param simplify: Tolleranza di semplificazione in unità del terreno (None = poligoni a gradini)
+    :param block_rows: Righe per striscia (default: circa DEFAULT_BLOCK_BYTES per striscia)
+    :return: Numero di poligoni scritti
+    """
+    info = raster_info(mask, band)
+    reader = RasterReader(mask, band)
+    if block_rows is None:
+        block_rows = rows_per_block(reader.dataset, band)
+    if os.path.exists(output):
+        ogr.GetDriverByName('GPKG').DeleteDataSource(output)
+    datasource = ogr.GetDriverByName('GPKG').CreateDataSource(output)
+    srs = osr.SpatialReference(wkt=info.projection) if info.projection else None
+    layer = datasource.CreateLayer(layer_name, srs, ogr.wkbPolygon)
+    layer.CreateField(ogr.FieldDefn(field, ogr.OFTInteger))
+    writer = _PolygonWriter(layer, field, simplify)
+
+    origin_x, pixel_width, _, origin_y, _, pixel_height = info.geotransform
+    # Tolleranza sul confronto tra i bordi delle strisce e le coordinate dei poligoni
+    tolerance = abs(pixel_height) * 1e-6
+    seams = defaultdict(list)
+    for row_off, nrows in block_windows(info.height, block_rows):
+        top = origin_y + row_off * pixel_height
+        bottom = origin_y + (row_off + nrows) * pixel_height
+        # Bordi interni della striscia (quelli del raster non dividono nessun poligono)
+        edges = [y for y, internal in ((top, row_off > 0), (bottom, row_off + nrows < info.height)) if internal]
+        polygons = _polygonize_strip(reader.rows(row_off, nrows), (origin_x, pixel_width, 0, top, 0, pixel_height),
+                                     info.nodata, field, eight_connected)
+        layer.StartTransaction()
+        for geometry, value in polygons:
+            if merge_seams and edges:
+                _, _, min_y, max_y = geometry.GetEnvelope()
+                if any(abs(min_y - y) < tolerance or abs(max_y - y) < tolerance for y in edges):
+                    seams[value].append(geometry)
+                    continue
+            writer.write(geometry, value)
+        layer.CommitTransaction()
+
+    layer.StartTransaction()
+    for value, fragments in seams.items():
+        for polygon in _merge_fragments(fragments):
+            writer.write(polygon, value)
+    layer.CommitTransaction()
+    datasource = None
+    return writer.count
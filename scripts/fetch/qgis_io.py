@@ -0,0 +1,258 @@
+"""
+Scambio dati tra i motori NumPy e i layer di QGIS.
+
+È l'unico modulo del pacchetto che richiede QGIS: gli altri lavorano su
+percorsi di file e array.
+"""
+import math
+import os
+import tempfile
+
+import numpy as np
+from qgis.core import NULL, QgsFeatureRequest, QgsField, QgsWkbTypes
+from qgis.PyQt.QtCore import QVariant
+
+from .cells import Cell, RasterGrid, cell_fids
+from .gpkg import attribute_column
+from .incremental import FingerprintStore
+from .records import CellStore
+
+
+def _rings(geometry):
+    """Anelli di una geometria poligonale (singola o multipla) come liste di (x, y)."""
+    if geometry.isMultipart():
+        polygons = geometry.asMultiPolygon()
+    else:
+        polygons = [geometry.asPolygon()]
+    return [[(point.x(), point.y()) for point in ring] for polygon in polygons for ring in polygon]
+
+
+def implicit_grid(vector_layer):
+    """
+    Griglia implicita salvata accanto al file del layer (``grid.gpkg.grid.json``, vedi lo script 03).
+
+    :return: RasterGrid, oppure None se la definizione manca o non corrisponde
+             più al layer (numero di feature o estensione diversi)
+    """
+    path = RasterGrid.beside(vector_layer.source().split('|')[0])
+    if not os.path.isfile(path):
+        return None
+    grid = RasterGrid.load(path)
+    extent = vector_layer.extent()
+    tolerance = grid.cell_size * 1e-6
+    bounds = (extent.xMinimum(), extent.yMinimum(), extent.xMaximum(), extent.yMaximum())
+    if vector_layer.featureCount() != len(grid) \
+            or any(abs(a - b) > tolerance for a, b in zip(bounds, grid.extent)):
+        return None
+    return grid
+
+
+def cells_from_layer(vector_layer):
+    """
+    Legge le celle della griglia da un layer vettoriale poligonale.
+
+    Se accanto al file c'è la definizione di una griglia implicita ancora
+    valida, le geometrie non vengono lette.
+
+    :param vector_layer: Layer grid
+    :return: RasterGrid, oppure lista di oggetti Cell nell'ordine delle feature
+    """
+    if vector_layer.geometryType() != QgsWkbTypes.PolygonGeometry:
+        raise TypeError(f"Il layer '{vector_layer.name()}' deve essere poligonale.")
+    grid = implicit_grid(vector_layer)
+    if grid is not None:
+        return grid
+    cells = []
+    for feature in vector_layer.getFeatures():
+        geometry = feature.geometry()
+        if geometry is None or geometry.isEmpty():
+            continue
+        cells.append(Cell(feature.id(), _rings(geometry)))
+    return cells
+
+
+def fingerprint_store(vector_layer):
+    """
+    Archivio delle impronte per cella accanto al file del layer (``grid.gpkg.fingerprints``).
+
+    :return: FingerprintStore, oppure None se il layer non è salvato su file
+             (in quel caso tutte le celle vengono sempre ricalcolate)
+    """
+    path = vector_layer.source().split('|')[0]
+    if not os.path.isfile(path):
+        return None
+    return FingerprintStore.beside(path)
+
+
+def cell_store(vector_layer, cells=None):
+    """
+    Archivio per cella del layer grid, in cui gli script salvano le proprie colonne.
+
+    Sta accanto al file del layer (``grid.gpkg.cells``); per i layer non salvati
+    su file si usa una cartella temporanea legata all'ID del layer. Le colonne
+    vengono unite alla griglia solo da ``export_cell_store``.
+
+    :param cells: Celle correnti della griglia: se indicate, le righe
+                  dell'archivio vengono riallineate ai loro ID
+    :return: CellStore
+    """
+    path = vector_layer.source().split('|')[0]
+    if os.path.isfile(path):
+        store = CellStore.beside(path)
+    else:
+        store = CellStore(os.path.join(tempfile.gettempdir(), 'fetch_cells', vector_layer.id()))
+    if cells is not None:
+        store.set_fids(cell_fids(cells))
+    return store
+
+
+def export_cell_store(vector_layer, store, names=None):
+    """
+    Unisce le colonne dell'archivio per cella agli attributi del layer, con una sola chiamata al provider.
+
+    :param names: Colonne da esportare (default: tutte)
+    :return: True se il provider ha accettato le modifiche
+    """
+    present = {feature.id() for feature in vector_layer.getFeatures(
+        QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry).setNoAttributes())}
+    fids = store.fids
+    keep = np.array([fid in present for fid in fids.tolist()], dtype=bool)
+    columns = {name: np.asarray(values)[keep] for name, values in store.columns(names).items()}
+    return write_attributes(vector_layer, fids[keep], columns)
+
+
+def ensure_fields(vector_layer, field_names, field_type=QVariant.Double):
+    """
+    Aggiunge al layer i campi mancanti.
+
+    :return: Dizionario nome del campo -> indice del campo
+    """
+    missing = [name for name in field_names if vector_layer.fields().indexOf(name) == -1]
+    if missing:
+        vector_layer.dataProvider().addAttributes([QgsField(name, field_type) for name in missing])
+        vector_layer.updateFields()
+    return {name: vector_layer.fields().indexOf(name) for name in field_names}
+
+
+def _to_attribute(value):
+    """Converte un valore NumPy in un valore attributo (NaN -> NULL)."""
+    if value is None:
+        return None
+    value = value.item() if hasattr(value, 'item') else value
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+
+def _field_type(values):
+    """Tipo di campo QGIS adatto a una colonna (i valori numerici restano Double)."""
+    if np.asarray(values).dtype.kind in 'OUS':
+        return QVariant.String
+    return QVariant.Double
+
+
+def _ensure_typed_fields(vector_layer, columns):
+    """Aggiunge i campi mancanti con il tipo adatto ai valori di ogni colonna."""
+    indices = {}
+    for name, values in columns.items():
+        indices.update(ensure_fields(vector_layer, [name], _field_type(values)))
+    return indices
+
+
+def read_attributes(vector_layer, field_names, fids=None):
+    """
+    Legge colonne di attributi senza caricare le geometrie.
+
+    :param field_names: Nomi dei campi
+    :param fids: ID delle feature da leggere (default: tutte)
+    :return: Coppia (array degli ID, dizionario nome -> array allineato agli ID);
+             i NULL dei campi numerici diventano NaN
+    """
+    missing = [name for name in field_names if vector_layer.fields().indexOf(name) == -1]
+    if missing:
+        raise ValueError(f"Campi non presenti nel layer '{vector_layer.name()}': {', '.join(missing)}")
+    request = QgsFeatureRequest()
+    request.setFlags(QgsFeatureRequest.NoGeometry)
+    request.setSubsetOfAttributes(list(field_names), vector_layer.fields())
+    if fids is not None:
+        request.setFilterFids([int(fid) for fid in fids])
+    ids = []
+    values = {name: [] for name in field_names}
+    for feature in vector_layer.getFeatures(request):
+        ids.append(feature.id())
+        for name in field_names:
+            value = feature[name]
+            values[name].append(None if value is None or value == NULL else value)
+    return np.array(ids, dtype=np.int64), {name: attribute_column(column) for name, column in values.items()}
+
+
+def write_attributes(vector_layer, fids, columns):
+    """
+    Scrive più colonne di attributi con una sola chiamata al provider (una transazione).
+
+    Sostituisce le sessioni di modifica con ``changeAttributeValue`` o
+    ``updateFeature`` per feature; senza QGIS si usa ``gpkg.write_gpkg_attributes``.
+
+    :param vector_layer: Layer da aggiornare (non in modalità modifica)
+    :param fids: Sequenza di ID delle feature
+    :param columns: Dizionario nome del campo -> sequenza di valori allineata a fids
+    :return: True se il provider ha accettato le modifiche
+    """
+    indices = _ensure_typed_fields(vector_layer, columns)
+    changes = {}
+    for row, fid in enumerate(fids):
+        changes[int(fid)] = {indices[name]: _to_attribute(values[row]) for name, values in columns.items()}
+    ok = vector_layer.dataProvider().changeAttributeValues(changes)
+    vector_layer.reload()
+    return ok
+
+
+class AttributeWriter:
+    """
+    Scrive nel layer blocchi di attributi per cella man mano che vengono prodotti.
+
+    Le modifiche sono inviate al provider ogni ``chunk_rows`` feature, con una
+    sola chiamata per blocco; il layer viene ricaricato alla chiusura.
+
+    :param vector_layer: Layer da aggiornare (non in modalità modifica)
+    :param chunk_rows: Feature per chiamata al provider
+    """
+
+    def __init__(self, vector_layer, chunk_rows=10000):
+        self.vector_layer = vector_layer
+        self.chunk_rows = chunk_rows
+        self.ok = True
+        self._indices = None
+        self._changes = {}
+
+    def append(self, fids, columns):
+        """
+        Aggiunge un blocco di valori.
+
+        :param fids: ID delle feature del blocco
+        :param columns: Dizionario nome del campo -> valori allineati a fids
+        """
+        if self._indices is None:
+            self._indices = _ensure_typed_fields(self.vector_layer, columns)
+        for row, fid in enumerate(fids):
+            self._changes[int(fid)] = {self._indices[name]: _to_attribute(values[row])
+                                       for name, values in columns.items()}
+        if len(self._changes) >= self.chunk_rows:
+            self.flush()
+
+    def flush(self):
+        """Invia al provider le modifiche in attesa."""
+        if self._changes:
+            self.ok &= self.vector_layer.dataProvider().changeAttributeValues(self._changes)
+            self._changes = {}
+
+    def close(self):
+        """Invia le ultime modifiche e ricarica il layer."""
+        self.flush()
+        self.vector_layer.reload()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
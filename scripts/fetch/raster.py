@@ -0,0 +1,490 @@
+"""
+Accesso ai raster tramite GDAL, senza passare dal registro dei layer di QGIS.
+
+Le letture a finestre passano da ``RasterReader``: i GeoTIFF non compressi a
+strisce sono mappati in memoria e ogni finestra è una vista NumPy senza
+copie; gli altri raster sono letti per blocchi interi, conservati in una
+cache LRU (``BlockCache``) condivisa da tutti i lettori del processo, così le
+finestre sovrapposte o rilette da fasi diverse non decodificano di nuovo gli
+stessi blocchi. Gli array restituiti sono in sola lettura.
+"""
+import math
+import os
+import struct
+from collections import OrderedDict
+
+import numpy as np
+from osgeo import gdal, gdal_array
+
+gdal.UseExceptions()
+
+# Memoria indicativa (in byte) occupata da un blocco di righe letto in streaming
+DEFAULT_BLOCK_BYTES = 64 * 1024 * 1024
+
+# Dimensione predefinita della cache dei blocchi condivisa (MB)
+DEFAULT_CACHE_MB = 256
+
+# Lato minimo in pixel dei blocchi in cache: i blocchi interni più piccoli
+# (ad es. strisce di poche righe) vengono raggruppati
+CACHE_BLOCK_PIXELS = 256
+
+# Opzioni di creazione dei GeoTIFF scritti dal pacchetto
+GTIFF_OPTIONS = ['TILED=YES', 'COMPRESS=DEFLATE', 'BIGTIFF=IF_SAFER']
+
+
+def source_path(raster):
+    """
+    Restituisce il percorso su disco di un raster.
+
+    :param raster: Percorso del file, layer QGIS (qualsiasi oggetto con ``source()``)
+                   o dataset GDAL
+    :return: Percorso del file come stringa
+    """
+    if hasattr(raster, 'source'):
+        return raster.source()
+    if isinstance(raster, gdal.Dataset):
+        return raster.GetDescription()
+    return str(raster)
+
+
+class RasterInfo:
+    """
+    Geometria di un raster nord-orientato: dimensioni in pixel e geotrasformazione.
+    """
+
+    def __init__(self, width, height, geotransform, nodata=None, projection=''):
+        if geotransform[2] != 0 or geotransform[4] != 0:
+            raise ValueError("I raster ruotati non sono supportati.")
+        self.width = int(width)
+        self.height = int(height)
+        self.geotransform = tuple(geotransform)
+        self.origin_x = geotransform[0]
+        self.origin_y = geotransform[3]
+        self.pixel_width = geotransform[1]
+        self.pixel_height = abs(geotransform[5])
+        self.nodata = nodata
+        self.projection = projection
+
+    @property
+    def extent(self):
+        """Estensione come (xmin, ymin, xmax, ymax)."""
+        return (self.origin_x,
+                self.origin_y - self.height * self.pixel_height,
+                self.origin_x + self.width * self.pixel_width,
+                self.origin_y)
+
+    def column_centers(self):
+        """Coordinate X dei centri dei pixel, una per colonna."""
+        return self.origin_x + (np.arange(self.width) + 0.5) * self.pixel_width
+
+    def row_centers(self, row_off=0, nrows=None):
+        """Coordinate Y dei centri dei pixel per le righe richieste."""
+        if nrows is None:
+            nrows = self.height - row_off
+        return self.origin_y - (np.arange(row_off, row_off + nrows) + 0.5) * self.pixel_height
+
+
+def open_raster(raster):
+    """
+    Apre un raster in sola lettura.
+
+    :param raster: Percorso del file, layer QGIS o dataset GDAL già aperto
+    :return: Dataset GDAL
+    """
+    if isinstance(raster, gdal.Dataset):
+        return raster
+    path = source_path(raster)
+    dataset = gdal.Open(path, gdal.GA_ReadOnly)
+    if dataset is None:
+        raise RuntimeError(f"Impossibile aprire il raster '{path}'.")
+    return dataset
+
+
+def raster_info(raster, band=1):
+    """
+    Legge la geometria di un raster senza caricarne i dati.
+
+    :param raster: Percorso del file, layer QGIS o dataset GDAL già aperto
+    :param band: Banda da cui leggere il valore di nodata
+    :return: Oggetto RasterInfo
+    """
+    dataset = open_raster(raster)
+    nodata = dataset.GetRasterBand(band).GetNoDataValue()
+    return RasterInfo(dataset.RasterXSize, dataset.RasterYSize, dataset.GetGeoTransform(), nodata,
+                      dataset.GetProjection())
+
+
+def rows_per_block(dataset, band=1, block_bytes=DEFAULT_BLOCK_BYTES):
+    """
+    Numero di righe da leggere per blocco, allineato ai blocchi interni del file.
+    """
+    raster_band = dataset.GetRasterBand(band)
+    itemsize = gdal.GetDataTypeSize(raster_band.DataType) // 8 or 1
+    block_rows = raster_band.GetBlockSize()[1] or 1
+    rows = max(1, block_bytes // (dataset.RasterXSize * itemsize))
+    return max(block_rows, rows - rows % block_rows)
+
+
+def iter_row_blocks(raster, band=1, block_rows=None, row_start=0, row_stop=None):
+    """
+    Legge un raster a strisce di righe complete.
+
+    I blocchi seguono sempre la stessa suddivisione del raster intero (multipli
+    di ``block_rows``), anche quando si legge solo l'intervallo di righe
+    ``row_start:row_stop``: un intervallo viene letto come la parte
+    corrispondente di una lettura completa.
+
+    :param raster: Percorso del file o layer QGIS
+    :param band: Banda da leggere
+    :param block_rows: Righe per blocco (default: circa DEFAULT_BLOCK_BYTES per blocco)
+    :param row_start: Prima riga da leggere
+    :param row_stop: Riga (esclusa) a cui fermarsi (default: fine del raster)
+    :return: Generatore di coppie (indice della prima riga, array NumPy in sola lettura)
+    """
+    reader = RasterReader(raster, band)
+    if block_rows is None:
+        block_rows = rows_per_block(reader.dataset, band)
+    for row_off, nrows in block_windows(reader.height, block_rows, row_start, row_stop):
+        yield row_off, reader.rows(row_off, nrows)
+
+
+def block_windows(height, block_rows, row_start=0, row_stop=None):
+    """
+    Strisce (prima riga, numero di righe) che coprono ``row_start:row_stop``,
+    tagliate sulla suddivisione in blocchi di ``block_rows`` righe del raster intero.
+    """
+    row_stop = height if row_stop is None else min(row_stop, height)
+    row_off = row_start
+    while row_off < row_stop:
+        block_end = min((row_off // block_rows + 1) * block_rows, row_stop)
+        yield row_off, block_end - row_off
+        row_off = block_end
+
+
+def read_array(raster, band=1):
+    """
+    Legge un'intera banda come array NumPy.
+    """
+    return open_raster(raster).GetRasterBand(band).ReadAsArray()
+
+
+def raster_inputs(name, raster):
+    """
+    File da cui dipende un raster, per le chiavi di ``StageCache.key``: il
+    raster stesso e, per un mosaico VRT, anche i tile a cui rimanda (il VRT
+    non cambia se cambia solo un tile).
+
+    :param name: Nome dell'input
+    :param raster: Percorso del file o layer QGIS
+    :return: Dizionario nome -> percorso
+    """
+    path = source_path(raster)
+    inputs = {name: path}
+    if path.lower().endswith('.vrt'):
+        for source in open_raster(path).GetFileList()[1:]:
+            inputs[f'{name}:{os.path.basename(source)}'] = source
+    return inputs
+
+
+def same_grid(info, other):
+    """True se due raster hanno dimensioni e geotrasformazione identiche."""
+    return (info.width, info.height, info.geotransform) == (other.width, other.height, other.geotransform)
+
+
+def read_aligned(raster, info, band=1, resample='near'):
+    """
+    Legge una banda ricampionandola, se serve, sulla griglia di ``info``.
+
+    :param raster: Raster da leggere (percorso o layer QGIS)
+    :param info: RasterInfo della griglia di destinazione
+    :param resample: Metodo di ricampionamento GDAL
+    :return: Array NumPy (info.height, info.width)
+    """
+    dataset = open_raster(raster)
+    if same_grid(raster_info(dataset, band), info):
+        return dataset.GetRasterBand(band).ReadAsArray()
+    xmin, ymin, xmax, ymax = info.extent
+    warped = gdal.Warp('', dataset, format='MEM', outputBounds=(xmin, ymin, xmax, ymax),
+                       width=info.width, height=info.height, dstSRS=info.projection or None,
+                       resampleAlg=resample)
+    return warped.GetRasterBand(band).ReadAsArray()
+
+
+def create_raster(path, info, dtype, nodata=None, options=GTIFF_OPTIONS):
+    """
+    Crea un GeoTIFF a banda singola con la geometria di ``info``.
+
+    :param dtype: Tipo NumPy dei pixel
+    :return: Dataset GDAL aperto in scrittura
+    """
+    gdal_type = gdal_array.NumericTypeCodeToGDALTypeCode(np.dtype(dtype))
+    dataset = gdal.GetDriverByName('GTiff').Create(path, info.width, info.height, 1, gdal_type, options)
+    dataset.SetGeoTransform(info.geotransform)
+    if info.projection:
+        dataset.SetProjection(info.projection)
+    if nodata is not None:
+        dataset.GetRasterBand(1).SetNoDataValue(nodata)
+    return dataset
+
+
+def write_array(path, array, info, nodata=None):
+    """
+    Scrive un array come GeoTIFF tassellato e compresso.
+
+    :return: Percorso del file scritto
+    """
+    dataset = create_raster(path, info, array.dtype, nodata)
+    dataset.GetRasterBand(1).WriteArray(array)
+    dataset.FlushCache()
+    dataset = None
+    return path
+
+
+class BlockCache:
+    """
+    Cache LRU di blocchi di raster già decodificati, con limite di memoria in MB.
+
+    :param max_mb: Memoria massima occupata dai blocchi (0 disattiva la cache)
+    """
+
+    def __init__(self, max_mb=DEFAULT_CACHE_MB):
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._blocks = OrderedDict()
+
+    def get(self, key):
+        """Blocco in cache, oppure None."""
+        block = self._blocks.get(key)
+        if block is None:
+            self.misses += 1
+            return None
+        self._blocks.move_to_end(key)
+        self.hits += 1
+        return block
+
+    def put(self, key, block):
+        """Aggiunge un blocco, eliminando i meno usati di recente oltre il limite."""
+        if block.nbytes > self.max_bytes:
+            return
+        if key in self._blocks:
+            self.bytes -= self._blocks.pop(key).nbytes
+        self._blocks[key] = block
+        self.bytes += block.nbytes
+        while self.bytes > self.max_bytes:
+            self.bytes -= self._blocks.popitem(last=False)[1].nbytes
+
+    def resize(self, max_mb):
+        """Cambia il limite di memoria, eliminando i blocchi in eccesso."""
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        while self.bytes > self.max_bytes:
+            self.bytes -= self._blocks.popitem(last=False)[1].nbytes
+
+    def clear(self):
+        self._blocks.clear()
+        self.bytes = 0
+
+
+_SHARED_CACHE = BlockCache()
+
+
+def shared_cache():
+    """Cache dei blocchi condivisa da tutti i ``RasterReader`` del processo."""
+    return _SHARED_CACHE
+
+
+def set_cache_size(max_mb):
+    """Imposta la memoria (MB) della cache dei blocchi condivisa."""
+    _SHARED_CACHE.resize(max_mb)
+
+
+# Tipi dei tag TIFF interi: codice di struct e dimensione in byte
+_TIFF_TYPES = {1: ('B', 1), 3: ('H', 2), 4: ('I', 4), 16: ('Q', 8)}
+# SampleFormat TIFF -> tipo NumPy
+_TIFF_SAMPLE_KINDS = {1: 'u', 2: 'i', 3: 'f'}
+
+
+def _tiff_tags(handle):
+    """
+    Tag interi della prima immagine (IFD) di un TIFF classico o BigTIFF.
+
+    :return: Coppia (ordine dei byte per NumPy, dizionario tag -> tupla di valori), oppure None
+    """
+    header = handle.read(16)
+    order = {b'II': '<', b'MM': '>'}.get(header[:2])
+    if order is None or len(header) < 16:
+        return None
+    magic = struct.unpack(order + 'H', header[2:4])[0]
+    if magic == 42:
+        ifd = struct.unpack(order + 'I', header[4:8])[0]
+        count_code, offset_code, entry_size, inline = 'H', 'I', 12, 4
+    elif magic == 43:
+        ifd = struct.unpack(order + 'Q', header[8:16])[0]
+        count_code, offset_code, entry_size, inline = 'Q', 'Q', 20, 8
+    else:
+        return None
+    handle.seek(ifd)
+    nentries = struct.unpack(order + count_code, handle.read(struct.calcsize(count_code)))[0]
+    entries = handle.read(nentries * entry_size)
+    tags = {}
+    for index in range(nentries):
+        entry = entries[index * entry_size:(index + 1) * entry_size]
+        tag, kind = struct.unpack(order + 'HH', entry[:4])
+        if kind not in _TIFF_TYPES:
+            continue
+        code, size = _TIFF_TYPES[kind]
+        count = struct.unpack(order + offset_code, entry[4:4 + inline])[0]
+        field = entry[4 + inline:]
+        if count * size <= inline:
+            data = field[:count * size]
+        else:
+            handle.seek(struct.unpack(order + offset_code, field)[0])
+            data = handle.read(count * size)
+        tags[tag] = struct.unpack(f'{order}{count}{code}', data)
+    return order, tags
+
+
+def map_tiff(path, width, height, band=1):
+    """
+    Mappa in memoria una banda di un GeoTIFF non compresso a strisce contigue.
+
+    :return: Array NumPy (height, width) in sola lettura, oppure None se il file
+             non è mappabile (compresso, a blocchi quadrati, strisce non contigue...)
+    """
+    try:
+        with open(path, 'rb') as handle:
+            parsed = _tiff_tags(handle)
+    except OSError:
+        return None
+    if parsed is None:
+        return None
+    order, tags = parsed
+    bits = tags.get(258, (8,))
+    if tags.get(259, (1,))[0] != 1 or 322 in tags or 273 not in tags or len(set(bits)) != 1 or bits[0] % 8:
+        return None
+    if (tags.get(256, (0,))[0], tags.get(257, (0,))[0]) != (width, height):
+        return None
+    kind = _TIFF_SAMPLE_KINDS.get(tags.get(339, (1,))[0])
+    samples = tags.get(277, (1,))[0]
+    if kind is None or not 1 <= band <= samples:
+        return None
+    dtype = np.dtype(f'{order}{kind}{bits[0] // 8}')
+    planar = tags.get(284, (1,))[0] == 2
+    pixel_samples = 1 if planar else samples
+    rows_per_strip = min(tags.get(278, (height,))[0], height)
+    nstrips = math.ceil(height / rows_per_strip)
+    offsets = tags[273]
+    if planar:
+        offsets = offsets[(band - 1) * nstrips:band * nstrips]
+    strip_bytes = rows_per_strip * width * pixel_samples * dtype.itemsize
+    if len(offsets) != nstrips or any(offset != offsets[0] + index * strip_bytes
+                                      for index, offset in enumerate(offsets)):
+        return None
+    try:
+        image = np.memmap(path, dtype=dtype, mode='r', offset=offsets[0], shape=(height, width, pixel_samples))
+    except (OSError, ValueError):
+        return None
+    return np.asarray(image)[:, :, 0 if planar else band - 1]
+
+
+class RasterReader:
+    """
+    Letture a finestre di una banda, senza copie quando il file è mappabile in memoria.
+
+    :param raster: Percorso del file, layer QGIS o dataset GDAL
+    :param band: Banda da leggere
+    :param cache: BlockCache da usare (default: quella condivisa del processo)
+    """
+
+    def __init__(self, raster, band=1, cache=None):
+        self.dataset = open_raster(raster)
+        self.band = self.dataset.GetRasterBand(band)
+        self.width = self.dataset.RasterXSize
+        self.height = self.dataset.RasterYSize
+        self.cache = shared_cache() if cache is None else cache
+        path = source_path(raster)
+        self._image = None
+        self._key = None
+        if os.path.isfile(path):
+            self._image = map_tiff(path, self.width, self.height, band)
+            stat = os.stat(path)
+            # Il file riscritto (data o dimensione diverse) non riusa i blocchi in cache
+            self._key = (os.path.realpath(path), band, stat.st_mtime_ns, stat.st_size)
+        block_width, block_height = self.band.GetBlockSize()
+        self.block_width = min(self.width, block_width * math.ceil(CACHE_BLOCK_PIXELS / max(block_width, 1)))
+        self.block_height = min(self.height, block_height * math.ceil(CACHE_BLOCK_PIXELS / max(block_height, 1)))
+
+    @property
+    def is_mapped(self):
+        """True se le finestre sono viste dirette sul file mappato in memoria."""
+        return self._image is not None
+
+    def _block(self, block_col, block_row):
+        """Blocco della cache (decodificato al primo accesso)."""
+        key = self._key + (self.block_width, self.block_height, block_col, block_row)
+        block = self.cache.get(key)
+        if block is None:
+            col_off, row_off = block_col * self.block_width, block_row * self.block_height
+            block = self.band.ReadAsArray(col_off, row_off, min(self.block_width, self.width - col_off),
+                                          min(self.block_height, self.height - row_off))
+            block.flags.writeable = False
+            self.cache.put(key, block)
+        return block
+
+    def read(self, col_off, row_off, ncols, nrows):
+        """
+        Legge una finestra.
+
+        :return: Array NumPy (nrows, ncols) in sola lettura
+        """
+        if col_off < 0 or row_off < 0 or ncols < 0 or nrows < 0 \
+                or col_off + ncols > self.width or row_off + nrows > self.height:
+            raise ValueError(f"Finestra fuori dal raster: ({col_off}, {row_off}, {ncols}, {nrows})")
+        if self._image is not None:
+            return self._image[row_off:row_off + nrows, col_off:col_off + ncols]
+        if self._key is None or self.cache.max_bytes <= 0:
+            window = self.band.ReadAsArray(col_off, row_off, ncols, nrows)
+            window.flags.writeable = False
+            return window
+        col_blocks = range(col_off // self.block_width, (col_off + ncols - 1) // self.block_width + 1)
+        row_blocks = range(row_off // self.block_height, (row_off + nrows - 1) // self.block_height + 1)
+        if len(col_blocks) == 1 and len(row_blocks) == 1:
+            # Finestra dentro un solo blocco: vista sul blocco in cache
+            block = self._block(col_blocks[0], row_blocks[0])
+            x0, y0 = col_off - col_blocks[0] * self.block_width, row_off - row_blocks[0] * self.block_height
+            return block[y0:y0 + nrows, x0:x0 + ncols]
+        window = None
+        for block_row in row_blocks:
+            for block_col in col_blocks:
+                block = self._block(block_col, block_row)
+                x0, y0 = block_col * self.block_width, block_row * self.block_height
+                left, top = max(col_off, x0), max(row_off, y0)
+                right = min(col_off + ncols, x0 + block.shape[1])
+                bottom = min(row_off + nrows, y0 + block.shape[0])
+                if window is None:
+                    window = np.empty((nrows, ncols), dtype=block.dtype)
+                window[top - row_off:bottom - row_off, left - col_off:right - col_off] = \
+                    block[top - y0:bottom - y0, left - x0:right - x0]
+        window.flags.writeable = False
+        return window
+
+    def rows(self, row_off, nrows):
+        """Righe complete ``row_off:row_off + nrows``."""
+        return self.read(0, row_off, self.width, nrows)
+
+    def window_for_extent(self, xmin, ymin, xmax, ymax):
+        """
+        Finestra in pixel (col_off, row_off, ncols, nrows) che copre un'estensione,
+        ritagliata sul raster.
+        """
+        info = raster_info(self.dataset)
+        first_col = max(0, int(math.floor((xmin - info.origin_x) / info.pixel_width)))
+        last_col = min(self.width, int(math.ceil((xmax - info.origin_x) / info.pixel_width)))
+        first_row = max(0, int(math.floor((info.origin_y - ymax) / info.pixel_height)))
+        last_row = min(self.height, int(math.ceil((info.origin_y - ymin) / info.pixel_height)))
+        return first_col, first_row, max(0, last_col - first_col), max(0, last_row - first_row)
+
+    def read_extent(self, xmin, ymin, xmax, ymax):
+        """Finestra che copre un'estensione in coordinate del raster (ad es. il riquadro di una cella)."""
+        return self.read(*self.window_for_extent(xmin, ymin, xmax, ymax))
@@ -0,0 +1,336 @@
+"""
+Archivio a colonne dei risultati per cella.
+
+Ogni colonna è un file ``.npy`` in una cartella, scritto in coda a blocchi
+senza tenere in memoria l'intera tabella; la colonna ``fid`` contiene gli ID
+delle feature. Le colonne si rileggono con ``read_columns`` (anche mappate in
+memoria) o con qualsiasi programma che legga il formato NumPy.
+
+``CellStore`` usa lo stesso formato come archivio delle grandezze per cella
+scambiate tra le fasi: ogni fase legge e aggiunge colonne senza toccare le
+geometrie della griglia, e il join con la griglia avviene solo all'esportazione.
+"""
+import os
+import struct
+import tempfile
+
+import numpy as np
+
+# Lunghezza fissa dell'intestazione .npy: viene riscritta alla chiusura con il numero di righe
+_HEADER_BYTES = 128
+
+FID_COLUMN = 'fid'
+CELL_STORE_SUFFIX = '.cells'
+
+
+def _npy_header(dtype, rows):
+    """Intestazione .npy (versione 1.0) di lunghezza fissa per un array 1D."""
+    header = repr({'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': (rows,)})
+    prefix = np.lib.format.magic(1, 0)
+    padding = _HEADER_BYTES - len(prefix) - 2 - len(header) - 1
+    if padding < 0:
+        raise ValueError(f"Tipo di colonna non supportato: {dtype}")
+    header = header + ' ' * padding + '\n'
+    return prefix + struct.pack('<H', len(header)) + header.encode('latin1')
+
+
+class ColumnWriter:
+    """
+    Scrive colonne per cella in una cartella, un file ``.npy`` per colonna.
+
+    Le colonne di testo (ad es. la classe LCZ) sono salvate come stringhe di
+    lunghezza fissa ``string_width``; None diventa la stringa vuota.
+
+    :param directory: Cartella di destinazione (creata se non esiste)
+    :param string_width: Caratteri riservati alle colonne di testo
+    """
+
+    def __init__(self, directory, string_width=16):
+        self.directory = directory
+        self.string_width = string_width
+        self.rows = 0
+        self._files = {}
+        self._dtypes = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def _column_array(self, name, values):
+        values = np.asarray(values)
+        if values.dtype.kind in 'OUS':
+            values = np.array(['' if value is None else str(value) for value in values],
+                              dtype=f'<U{self.string_width}')
+        dtype = self._dtypes.setdefault(name, values.dtype)
+        return np.ascontiguousarray(values, dtype=dtype)
+
+    def _file(self, name):
+        if name not in self._files:
+            if self.rows:
+                raise ValueError(f"La colonna '{name}' non era presente nei blocchi precedenti.")
+            handle = open(os.path.join(self.directory, f'{name}.npy'), 'wb')
+            handle.write(b'\0' * _HEADER_BYTES)
+            self._files[name] = handle
+        return self._files[name]
+
+    def append(self, fids, columns):
+        """
+        Aggiunge un blocco di righe.
+
+        :param fids: ID delle feature del blocco
+        :param columns: Dizionario nome della colonna -> valori allineati a fids
+        """
+        fids = np.asarray(fids, dtype=np.int64)
+        self._dtypes['fid'] = fids.dtype
+        blocks = {'fid': fids}
+        blocks.update((name, self._column_array(name, values)) for name, values in columns.items())
+        for name, values in blocks.items():
+            if len(values) != len(fids):
+                raise ValueError(f"La colonna '{name}' ha {len(values)} valori invece di {len(fids)}.")
+        if self._files and set(blocks) != set(self._files):
+            raise ValueError("Tutti i blocchi devono avere le stesse colonne.")
+        for name, values in blocks.items():
+            self._file(name).write(values.tobytes())
+        self.rows += len(fids)
+
+    def close(self):
+        """Completa le intestazioni con il numero di righe e chiude i file."""
+        for name, handle in self._files.items():
+            handle.seek(0)
+            handle.write(_npy_header(self._dtypes[name], self.rows))
+            handle.close()
+        self._files = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_columns(directory, mmap=True):
+    """
+    Legge le colonne scritte da ``ColumnWriter``.
+
+    :param mmap: Se True le colonne sono mappate in memoria invece che caricate
+    :return: Dizionario nome della colonna -> array
+    """
+    columns = {}
+    for filename in sorted(os.listdir(directory)):
+        if filename.endswith('.npy'):
+            columns[filename[:-4]] = np.load(os.path.join(directory, filename),
+                                             mmap_mode='r' if mmap else None)
+    return columns
+
+
+def _text_column(values, string_width):
+    """Colonna di testo a lunghezza fissa, come in ``ColumnWriter`` (None -> stringa vuota)."""
+    return np.array(['' if value is None else str(value) for value in values], dtype=f'<U{string_width}')
+
+
+def _empty_column(dtype, rows, shape=()):
+    """
+    Colonna di valori mancanti: NaN per i numeri (gli interi diventano float), stringa vuota per il testo.
+
+    :param shape: Forma dei valori di ogni riga, per le colonne con più valori per cella
+    """
+    if dtype.kind in 'US':
+        return np.full((rows,) + shape, '', dtype=dtype)
+    return np.full((rows,) + shape, np.nan, dtype=np.result_type(dtype, np.float32))
+
+
+class CellStore:
+    """
+    Grandezze per cella in una cartella, un file ``.npy`` per colonna, indicizzate per ID di cella.
+
+    ``fid.npy`` fissa l'ordine delle righe; le altre colonne sono allineate a
+    esso (anche con più valori per cella, come array (celle, ...)) e vengono
+    lette mappate in memoria. Una cartella scritta da
+    ``ColumnWriter`` è anche un CellStore valido.
+
+    Esempio::
+
+        store = CellStore.beside('grid.gpkg')
+        store.write(fids, {'median_dist': medians})
+        values = store.matrix(['perc_buildings', 'median_dist'])  # (celle, 2), contigua
+
+    :param directory: Cartella dell'archivio (creata alla prima scrittura)
+    :param string_width: Caratteri riservati alle colonne di testo
+    """
+
+    def __init__(self, directory, string_width=16):
+        self.directory = directory
+        self.string_width = string_width
+
+    @classmethod
+    def beside(cls, grid_path):
+        """Archivio accanto a un file di griglia: ``<griglia>.cells``."""
+        return cls(grid_path + CELL_STORE_SUFFIX)
+
+    def _path(self, name):
+        return os.path.join(self.directory, f'{name}.npy')
+
+    def _save(self, name, values):
+        """Scrive una colonna intera in modo atomico."""
+        os.makedirs(self.directory, exist_ok=True)
+        handle, tmp = tempfile.mkstemp(dir=self.directory, suffix='.npy')
+        with os.fdopen(handle, 'wb') as output:
+            np.save(output, values)
+        os.replace(tmp, self._path(name))
+
+    @property
+    def fids(self):
+        """ID delle celle, nell'ordine delle righe (vuoto se l'archivio non esiste)."""
+        if not os.path.exists(self._path(FID_COLUMN)):
+            return np.empty(0, dtype=np.int64)
+        return np.load(self._path(FID_COLUMN))
+
+    @property
+    def names(self):
+        """Nomi delle colonne salvate (escluso ``fid``)."""
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(filename[:-4] for filename in os.listdir(self.directory)
+                      if filename.endswith('.npy') and filename != f'{FID_COLUMN}.npy')
+
+    def __contains__(self, name):
+        return name != FID_COLUMN and os.path.exists(self._path(name))
+
+    def rows(self, fids):
+        """
+        Righe dell'archivio delle celle indicate.
+
+        :return: Array di indici allineato a fids
+        """
+        stored = self.fids
+        fids = np.asarray(fids, dtype=np.int64)
+        order = np.argsort(stored, kind='stable')
+        position = order[np.clip(np.searchsorted(stored[order], fids), 0, max(len(stored) - 1, 0))] \
+            if len(stored) else np.zeros(len(fids), dtype=np.intp)
+        if len(fids) and (not len(stored) or np.any(stored[position] != fids)):
+            raise ValueError("Celle non presenti nell'archivio: aggiornare prima gli ID con set_fids.")
+        return position
+
+    def set_fids(self, fids):
+        """
+        Fissa le celle dell'archivio (ad es. dopo aver ricreato la griglia).
+
+        Le colonne esistenti sono riallineate per ID: le celle nuove ricevono
+        valori mancanti, quelle non più presenti vengono scartate.
+        """
+        fids = np.asarray(fids, dtype=np.int64)
+        stored = self.fids
+        if np.array_equal(stored, fids):
+            return
+        if len(stored):
+            order = np.argsort(stored, kind='stable')
+            position = np.clip(np.searchsorted(stored[order], fids), 0, len(stored) - 1)
+            known = stored[order][position] == fids
+            source = order[position][known]
+            for name in self.names:
+                values = np.load(self._path(name))
+                moved = _empty_column(values.dtype, len(fids), values.shape[1:])
+                moved[known] = values[source]
+                self._save(name, moved)
+        else:
+            # Colonne senza righe (archivio vuoto): non c'è niente da riallineare
+            self.clear()
+        self._save(FID_COLUMN, fids)
+
+    def _column_array(self, values):
+        values = np.asarray(values)
+        if values.dtype.kind in 'OUS':
+            return _text_column(values, self.string_width)
+        return values
+
+    def write(self, fids, columns):
+        """
+        Scrive colonne per le celle indicate; le altre righe restano invariate,
+        tranne quando cambia la forma dei valori di una cella (la colonna
+        viene riscritta e le altre righe restano senza valore).
+
+        Se l'archivio è vuoto le celle indicate ne fissano le righe.
+
+        :param fids: ID delle celle
+        :param columns: Dizionario nome della colonna -> valori allineati a fids
+        """
+        if not len(self.fids):
+            self.set_fids(fids)
+        rows = self.rows(fids)
+        total = len(self.fids)
+        for name, values in columns.items():
+            if name == FID_COLUMN:
+                raise ValueError(f"'{FID_COLUMN}' è riservato agli ID delle celle.")
+            values = self._column_array(values)
+            if len(values) != len(rows):
+                raise ValueError(f"La colonna '{name}' ha {len(values)} valori invece di {len(rows)}.")
+            if name in self:
+                existing = np.load(self._path(name), mmap_mode='r+')
+                if existing.shape[1:] != values.shape[1:]:
+                    # Forma diversa (ad es. sketch_points cambiato): la colonna viene riscritta
+                    # e le righe non indicate restano senza valore
+                    del existing
+                    column = self._new_column(values, rows, total)
+                elif existing.dtype == np.result_type(existing.dtype, values.dtype):
+                    # Aggiornamento in place delle sole righe indicate
+                    existing[rows] = values
+                    existing.flush()
+                    continue
+                else:
+                    column = np.array(existing, dtype=np.result_type(existing.dtype, values.dtype))
+                    del existing
+                    column[rows] = values
+            else:
+                column = self._new_column(values, rows, total)
+            self._save(name, column)
+
+    @staticmethod
+    def _new_column(values, rows, total):
+        """Colonna di ``total`` righe con ``values`` nelle righe indicate e valori mancanti nelle altre."""
+        column = _empty_column(values.dtype, total, values.shape[1:])
+        if column.dtype.kind in 'US':
+            column = column.astype(values.dtype)
+        column[rows] = values
+        return column
+
+    def append(self, fids, columns):
+        """Come ``write``: permette di passare l'archivio a ``lcz.stream_classification``."""
+        self.write(fids, columns)
+
+    def read(self, name, fids=None):
+        """
+        Legge una colonna.
+
+        :param fids: ID delle celle (default: tutte, nell'ordine di ``fids``)
+        :return: Array mappato in memoria, o i valori delle celle indicate
+        """
+        if name not in self:
+            raise ValueError(f"Colonna '{name}' non presente nell'archivio delle celle.")
+        values = np.load(self._path(name), mmap_mode='r')
+        return values if fids is None else np.asarray(values[self.rows(fids)])
+
+    def columns(self, names=None, fids=None):
+        """Dizionario nome -> colonna (default: tutte le colonne salvate)."""
+        return {name: self.read(name, fids) for name in (self.names if names is None else names)}
+
+    def matrix(self, names, fids=None, dtype=np.float64):
+        """
+        Matrice contigua (celle, colonne) letta in una sola chiamata.
+
+        :param names: Nomi delle colonne; None o colonne assenti diventano NaN
+        :param fids: ID delle celle (default: tutte)
+        :return: Array C-contiguo di forma (celle, len(names))
+        """
+        rows = None if fids is None else self.rows(fids)
+        ncells = len(self.fids) if rows is None else len(rows)
+        values = np.full((ncells, len(names)), np.nan, dtype=dtype)
+        for col, name in enumerate(names):
+            if name is not None and name in self:
+                column = np.load(self._path(name), mmap_mode='r')
+                values[:, col] = column if rows is None else column[rows]
+        return values
+
+    def clear(self):
+        """Elimina tutte le colonne, ID compresi."""
+        if not os.path.isdir(self.directory):
+            return
+        for filename in os.listdir(self.directory):
+            if filename.endswith('.npy'):
+                os.remove(os.path.join(self.directory, filename))
@@ -0,0 +1,123 @@
+"""
+Lunghezza di rugosità e classe di Davenport per cella, dal DSM, dal DTM e
+dalla maschera degli edifici.
+
+Il calcolo usa le formule morfometriche di Macdonald et al. (1998):
+
+    zd / H = 1 + A ** (-lp) * (lp - 1)
+    z0 / H = (1 - zd / H) * exp(-(0.5 * beta * Cd / k**2 * (1 - zd / H) * lf) ** -0.5)
+
+con H altezza media degli edifici (o degli elementi di rugosità dove non ci
+sono edifici), ``lp`` frazione di area coperta dagli edifici e ``lf`` indice
+di area frontale. L'area frontale è la somma dei salti di altezza tra pixel
+adiacenti della stessa riga (vento da est e da ovest) moltiplicata per il
+lato del pixel; supponendo gli elementi isotropi, la media sulle quattro
+direzioni cardinali è metà di questa somma:
+
+    lf = somma dei salti * dy / (2 * area della cella) = media(|salto|) / (2 * dx)
+
+Tutti i termini sono medie per cella di quantità per pixel: si registrano
+come input derivati di ``zonal.ZonalEngine`` e vengono calcolati nella stessa
+lettura di DSM, DTM e maschera delle mediane delle altezze.
+
+Esempio::
+
+    engine = ZonalEngine(cells)
+    engine.add('dsm', 'dsm_unito.tif', ['median'])
+    engine.add('dtm', 'dtm.tif', ['median'])
+    engine.add('mask', 'mask_unito.tif')
+    add_roughness_inputs(engine)
+    columns = roughness_columns(engine.run(), pixel_width=0.5)
+"""
+import numpy as np
+
+# Costanti di Macdonald et al. (1998) per schiere di ostacoli sfalsati
+MACDONALD_A = 4.43
+MACDONALD_BETA = 1.0
+DRAG_COEFFICIENT = 1.2
+VON_KARMAN = 0.4
+
+# Lunghezza di rugosità tipica (m) delle classi di Davenport 1-8 (Davenport et al., 2000)
+DAVENPORT_Z0 = (0.0002, 0.005, 0.03, 0.10, 0.25, 0.5, 1.0, 2.0)
+
+# Limiti tra le classi: media geometrica dei valori tipici di due classi adiacenti
+DAVENPORT_BOUNDS = tuple(float(np.sqrt(low * high)) for low, high in zip(DAVENPORT_Z0[:-1], DAVENPORT_Z0[1:]))
+
+# Nomi degli input derivati registrati nel motore zonale
+_FOOTPRINT = 'rough_footprint'
+_BUILDING_HEIGHT = 'rough_building_height'
+_ELEMENT_HEIGHT = 'rough_element_height'
+_HEIGHT_STEP = 'rough_height_step'
+ROUGHNESS_INPUTS = (_FOOTPRINT, _BUILDING_HEIGHT, _ELEMENT_HEIGHT, _HEIGHT_STEP)
+
+
+def _element_height(dsm, dtm):
+    """Altezza degli elementi sopra il terreno (DSM - DTM, non negativa)."""
+    return np.maximum(dsm - dtm, 0)
+
+
+def _height_step(dsm, dtm):
+    """Salto di altezza tra ogni pixel e il successivo della stessa riga (0 nell'ultima colonna)."""
+    height = _element_height(dsm, dtm)
+    return np.abs(np.diff(height, axis=1, append=height[:, -1:]))
+
+
+def add_roughness_inputs(engine, dsm='dsm', dtm='dtm', mask='mask', statistics=('mean',)):
+    """
+    Registra nel motore zonale gli input derivati della rugosità (``ROUGHNESS_INPUTS``).
+
+    :param engine: ZonalEngine in cui ``dsm``, ``dtm`` e ``mask`` sono già
+                   registrati sulla stessa griglia
+    :param statistics: Statistiche degli input derivati (almeno 'mean' per ``roughness_columns``)
+    """
+    engine.add_derived(_FOOTPRINT, lambda mask: (mask == 1).astype(np.float32), [mask], statistics)
+    engine.add_derived(_BUILDING_HEIGHT, lambda dsm, dtm, mask: np.where(mask == 1, _element_height(dsm, dtm), np.nan),
+                       [dsm, dtm, mask], statistics, nan_sources=True)
+    engine.add_derived(_ELEMENT_HEIGHT, _element_height, [dsm, dtm], statistics, nan_sources=True)
+    engine.add_derived(_HEIGHT_STEP, _height_step, [dsm, dtm], statistics, nan_sources=True)
+
+
+def macdonald_roughness(height, plan_fraction, frontal_fraction):
+    """
+    Altezza di spostamento e lunghezza di rugosità di Macdonald et al. (1998).
+
+    :param height: Altezza media degli elementi (m)
+    :param plan_fraction: Frazione di area coperta dagli elementi (0-1)
+    :param frontal_fraction: Indice di area frontale
+    :return: Coppia di array (zd, z0) in metri
+    """
+    height = np.asarray(height, dtype=np.float64)
+    plan_fraction = np.clip(np.asarray(plan_fraction, dtype=np.float64), 0, 1)
+    frontal_fraction = np.asarray(frontal_fraction, dtype=np.float64)
+    displacement = 1 + MACDONALD_A ** -plan_fraction * (plan_fraction - 1)
+    drag = 0.5 * MACDONALD_BETA * DRAG_COEFFICIENT / VON_KARMAN ** 2 * (1 - displacement) * frontal_fraction
+    with np.errstate(divide='ignore'):
+        z0 = height * (1 - displacement) * np.exp(-drag ** -0.5)
+    return height * displacement, z0
+
+
+def davenport_class(z0):
+    """
+    Classe di Davenport (1-8) di una lunghezza di rugosità.
+
+    :return: Array float64, NaN dove z0 manca
+    """
+    z0 = np.asarray(z0, dtype=np.float64)
+    classes = np.searchsorted(DAVENPORT_BOUNDS, z0, side='right') + 1.0
+    return np.where(np.isnan(z0), np.nan, classes)
+
+
+def roughness_columns(results, pixel_width):
+    """
+    Colonne per cella della rugosità dai risultati del motore zonale.
+
+    :param results: Risultati di ``ZonalEngine.run`` con gli input di ``add_roughness_inputs``
+    :param pixel_width: Lato del pixel in x (m)
+    :return: Dizionario con 'zd', 'z0' e 'terrain_roughness' (classe di Davenport)
+    """
+    plan_fraction = np.nan_to_num(results[_FOOTPRINT]['mean'], nan=0.0)
+    building_height = results[_BUILDING_HEIGHT]['mean']
+    height = np.where(np.isnan(building_height), results[_ELEMENT_HEIGHT]['mean'], building_height)
+    frontal_fraction = results[_HEIGHT_STEP]['mean'] / (2 * abs(pixel_width))
+    displacement, z0 = macdonald_roughness(height, plan_fraction, frontal_fraction)
+    return {'zd': displacement, 'z0': z0, 'terrain_roughness': davenport_class(z0)}
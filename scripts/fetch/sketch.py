@@ -0,0 +1,201 @@
+"""
+Riassunto dei quantili per cella, di dimensione fissa e unibile.
+
+Ogni cella è descritta da al più ``points`` valori ordinati (una riga di un
+array (celle, points), con NaN in coda) e dal numero di pixel da cui
+derivano: con ``n`` pixel e ``m = min(n, points)`` punti, il punto ``i`` è il
+valore di rango ``floor((i + 0.5) * n / m)``, e ogni punto pesa ``n / m``
+pixel. Le celle con al più ``points`` pixel conservano tutti i valori, quindi
+mediana e maggioranza restano esatte.
+
+I riassunti di più celle si uniscono (``merge_sketches``) mettendo insieme i
+punti pesati e riprendendo ``points`` quantili equidistanti: così si passa da
+una cella alle celle più grandi che la contengono, o si uniscono i risultati
+parziali di più processi, senza rileggere i pixel. Ogni unione sposta i
+quantili al più di mezzo punto, cioè di ``0.5 / points`` in rango. Ripetendo
+un valore in proporzione alla sua frequenza, i punti danno anche una stima
+della maggioranza (vedi ``zonal.sorted_majority``).
+
+Lo stesso riassunto permette mediane approssimate senza tenere in memoria
+tutti i pixel di una cella (``SketchAccumulator``): i pixel di ogni blocco
+letto vengono uniti al riassunto della cella, che resta di ``points`` punti.
+Con un errore di rango ammesso ``error`` e al più ``merges`` unioni per
+cella bastano ``points_for_error(error, merges)`` punti.
+
+Esempio::
+
+    values, counts = sketch_from_sorted(sorted_values, counts, starts, points=64)
+    parent_values, parent_counts = merge_sketches(values, counts, parent, nparents)
+    median = sketch_median(parent_values)
+"""
+import math
+
+import numpy as np
+
+# Punti per cella predefiniti: errore di rango di circa 0.8% per ogni unione
+DEFAULT_POINTS = 64
+
+# Tipo dei valori dei punti (metà memoria rispetto a float64, sufficiente per quote e distanze)
+SKETCH_DTYPE = np.float32
+
+
+def sketch_from_sorted(sorted_values, counts, starts, points=DEFAULT_POINTS):
+    """
+    Riassunti dai valori già ordinati per (cella, valore), come in ``zonal.group_sorted``.
+
+    :param sorted_values: Valori dei pixel ordinati per cella e valore
+    :param counts: Numero di pixel per cella
+    :param starts: Indice del primo pixel di ogni cella
+    :return: Coppia (punti (celle, points) con NaN in coda, conteggi int64)
+    """
+    counts = np.asarray(counts, dtype=np.int64)
+    values = np.full((len(counts), points), np.nan, dtype=SKETCH_DTYPE)
+    kept = np.minimum(counts, points)
+    has_values = kept > 0
+    index = np.arange(points)
+    used = index[None, :] < kept[has_values, None]
+    ranks = np.floor((index[None, :] + 0.5) * counts[has_values, None] / np.maximum(kept[has_values, None], 1))
+    positions = starts[has_values, None] + np.minimum(ranks.astype(np.int64), counts[has_values, None] - 1)
+    values[has_values] = np.where(used, sorted_values[np.where(used, positions, 0)], np.nan)
+    return values, counts
+
+
+def points_for_error(error, merges=1):
+    """
+    Punti per cella per un errore di rango massimo.
+
+    :param error: Errore di rango ammesso, come frazione dei pixel della cella (ad es. 0.01)
+    :param merges: Numero massimo di unioni subite da un riassunto
+    """
+    if not 0 < error < 0.5:
+        raise ValueError("L'errore di rango delle mediane approssimate deve essere tra 0 e 0.5.")
+    return max(1, int(math.ceil(0.5 * merges / error)))
+
+
+def sketch_points(values, counts):
+    """
+    Punti pesati dei riassunti, uno per valore non NaN.
+
+    :return: Tupla (righe, valori float64, pesi) dei punti
+    """
+    used = ~np.isnan(values)
+    kept = used.sum(axis=1)
+    rows, _ = np.nonzero(used)
+    return rows, values[used].astype(np.float64), np.asarray(counts, dtype=np.float64)[rows] / kept[rows]
+
+
+def compress(groups, values, weights, ngroups, points):
+    """
+    Riassunti di ``points`` punti da punti pesati raggruppati per cella.
+
+    :param groups: Cella di ogni punto (0..ngroups-1)
+    :param values: Valore di ogni punto
+    :param weights: Peso (numero di pixel) di ogni punto
+    :return: Coppia (punti (ngroups, points) con NaN in coda, conteggi int64)
+    """
+    group_counts = np.rint(np.bincount(groups, weights=weights, minlength=ngroups)).astype(np.int64)
+    merged = np.full((ngroups, points), np.nan, dtype=SKETCH_DTYPE)
+    if not len(values):
+        return merged, group_counts
+
+    order = np.lexsort((values, groups))
+    cumulative = np.cumsum(weights[order])
+    # Quantili equidistanti di ogni cella, nella somma cumulativa globale dei pesi
+    group_kept = np.minimum(group_counts, points)
+    base = np.concatenate(([0], np.cumsum(group_counts)[:-1]))
+    index = np.arange(points)
+    wanted = index[None, :] < group_kept[:, None]
+    targets = base[:, None] + (index[None, :] + 0.5) * group_counts[:, None] / np.maximum(group_kept[:, None], 1)
+    # Tolleranza sulle somme dei pesi non interi
+    chosen = np.searchsorted(cumulative, targets[wanted] - 1e-9 * np.maximum(targets[wanted], 1), side='right')
+    merged[wanted] = values[order][np.minimum(chosen, len(order) - 1)]
+    return merged, group_counts
+
+
+def merge_sketches(values, counts, parent, nparents, points=None):
+    """
+    Unisce i riassunti delle celle che hanno lo stesso genitore.
+
+    :param values: Punti (celle, punti) con NaN in coda
+    :param counts: Numero di pixel per cella
+    :param parent: Indice del genitore di ogni cella (-1 = cella ignorata)
+    :param nparents: Numero di genitori
+    :param points: Punti dei riassunti uniti (default: come ``values``)
+    :return: Coppia (punti (nparents, points), conteggi int64)
+    """
+    values = np.asarray(values)
+    parent = np.asarray(parent, dtype=np.int64)
+    rows, point_values, point_weights = sketch_points(values, counts)
+    keep = parent[rows] >= 0
+    return compress(parent[rows][keep], point_values[keep], point_weights[keep], nparents,
+                    points or values.shape[1])
+
+
+def sketch_median(values):
+    """
+    Mediana per cella dai punti (media dei due centrali con un numero pari di punti).
+
+    :return: Array float64, NaN per le celle senza punti
+    """
+    kept = (~np.isnan(values)).sum(axis=1)
+    median = np.full(len(values), np.nan)
+    has_values = kept > 0
+    rows = np.flatnonzero(has_values)
+    low = values[rows, (kept[has_values] - 1) // 2].astype(np.float64)
+    high = values[rows, kept[has_values] // 2].astype(np.float64)
+    median[has_values] = (low + high) / 2
+    return median
+
+
+class SketchAccumulator:
+    """
+    Riassunti dei quantili per cella costruiti blocco per blocco.
+
+    Come ``zonal._SortedAccumulator``, ma invece dei pixel delle celle ancora
+    aperte conserva al più ``points`` punti per cella: la memoria non dipende
+    dal numero di pixel delle celle. Le celle la cui ultima riga è stata letta
+    vengono chiuse e i loro riassunti copiati nei risultati.
+
+    :param ncells: Numero di celle
+    :param row_end: Riga esclusa dell'ultimo pixel di ogni cella
+    :param points: Punti per cella
+    """
+
+    def __init__(self, ncells, row_end, points):
+        self.row_end = row_end
+        self.points = points
+        self.values = np.full((ncells, points), np.nan, dtype=SKETCH_DTYPE)
+        self.counts = np.zeros(ncells, dtype=np.int64)
+        self._cells = np.empty(0, dtype=np.int64)
+        self._values = np.empty((0, points), dtype=SKETCH_DTYPE)
+        self._counts = np.empty(0, dtype=np.int64)
+
+    def add(self, cells, values, rows_done):
+        """
+        Unisce ai riassunti i pixel validi di un blocco.
+
+        :param cells: Cella di ogni pixel
+        :param values: Valore di ogni pixel
+        :param rows_done: Numero di righe del raster lette finora
+        """
+        rows, open_values, open_weights = sketch_points(self._values, self._counts)
+        point_cells = np.concatenate((self._cells[rows], cells))
+        # Anche le celle aperte senza punti (nessun pixel valido finora) restano tra quelle presenti
+        present = np.union1d(point_cells, self._cells)
+        groups = np.searchsorted(present, point_cells)
+        pooled = np.concatenate((open_values, np.asarray(values, dtype=np.float64)))
+        weights = np.concatenate((open_weights, np.ones(len(cells))))
+        merged, counts = compress(groups, pooled, weights, len(present), self.points)
+        complete = self.row_end[present] <= rows_done
+        self.values[present[complete]] = merged[complete]
+        self.counts[present[complete]] = counts[complete]
+        self._cells, self._values, self._counts = present[~complete], merged[~complete], counts[~complete]
+
+    def finish(self):
+        """Chiude le celle rimaste aperte e restituisce (punti, conteggi) di tutte le celle."""
+        self.values[self._cells] = self._values
+        self.counts[self._cells] = self._counts
+        self._cells = np.empty(0, dtype=np.int64)
+        self._values = np.empty((0, self.points), dtype=SKETCH_DTYPE)
+        self._counts = np.empty(0, dtype=np.int64)
+        return self.values, self.counts
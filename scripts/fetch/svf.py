@@ -0,0 +1,262 @@
+"""
+Sky view factor (SVF) dal DSM, aggregato per cella.
+
+Per ogni pixel si cerca, lungo ``azimuths`` direzioni, l'angolo di elevazione
+massimo dell'orizzonte entro ``radius`` metri; lo SVF è
+``1 - media(sin(angolo))`` sulle direzioni (1 = cielo libero, 0 = cielo
+completamente coperto; gli orizzonti sotto il pixel contano come piatti).
+
+La ricerca è multi-risoluzione: i primi ``NEAR_PIXELS`` passi lungo ogni
+direzione sono a piena risoluzione, poi la distanza tra i passi cresce con la
+distanza e i campioni sono presi da una piramide di massimi 2x2 del DSM, così
+il numero di passi cresce con il logaritmo del raggio invece che linearmente.
+Il massimo del blocco tende ad alzare l'orizzonte lontano: rispetto alla
+ricerca pixel per pixel, su un DSM urbano sintetico a 0.5 m con raggio di 50 m
+la media per cella di 10 m differisce al più di 0.02. Tutti i pixel di una
+striscia avanzano insieme: per ogni passo si legge un'unica griglia di
+campioni con indici di riga e colonna separabili.
+
+Il raster è elaborato a strisce di righe allineate ai confini delle celle,
+anche in parallelo; sui raster larghi ogni striscia è divisa anche in
+colonne. Ogni tassello è letto con un alone pari al raggio ed è alto e largo
+almeno ``HALO_MULTIPLE`` volte l'alone, così le righe e le colonne lette in
+più restano una frazione limitata. La piramide è allineata alle righe e alle
+colonne assolute del raster, quindi il risultato non dipende dalla
+suddivisione. Con ``stride`` > 1 lo SVF è calcolato su un
+pixel ogni ``stride`` in righe e colonne, sufficiente per la media per cella
+di un DSM a 0.5 m.
+
+Esempio::
+
+    labels = CellLabels(cells, raster_info('dsm_unito.tif'))
+    svf = sky_view_factor_by_cell('dsm_unito.tif', labels, mask='mask_unito.tif', workers=4)
+"""
+import functools
+import math
+
+import numpy as np
+
+from .parallel import effective_workers, map_chunks, split_rows
+from .raster import DEFAULT_BLOCK_BYTES, RasterReader, block_windows, raster_info, same_grid
+
+# Direzioni e raggio di ricerca (metri) predefiniti
+DEFAULT_AZIMUTHS = 16
+DEFAULT_RADIUS = 100.0
+
+# Passi a piena risoluzione lungo ogni direzione prima di usare la piramide
+NEAR_PIXELS = 16
+
+# Byte per pixel di striscia: DSM, piramide e array di lavoro
+_STRIP_BYTES = 48
+
+# Lato minimo dei tasselli, in multipli dell'alone
+HALO_MULTIPLE = 4
+
+
+def search_steps(radius_px):
+    """
+    Passi della ricerca dell'orizzonte lungo una direzione.
+
+    :param radius_px: Raggio di ricerca in pixel
+    :return: Lista di coppie (distanza in pixel, livello della piramide)
+    """
+    steps = []
+    distance = 1
+    while distance <= radius_px:
+        level = max(0, int(math.log2(distance / NEAR_PIXELS))) if distance >= NEAR_PIXELS else 0
+        steps.append((distance, level))
+        distance += 2 ** level
+    return steps
+
+
+def _pyramid(heights, levels):
+    """Piramide di massimi 2x2 (i pixel mancanti, -inf, non contano)."""
+    pyramid = [heights]
+    for _ in range(levels):
+        previous = pyramid[-1]
+        rows, cols = -(-previous.shape[0] // 2), -(-previous.shape[1] // 2)
+        padded = np.full((rows * 2, cols * 2), -np.inf)
+        padded[:previous.shape[0], :previous.shape[1]] = previous
+        pyramid.append(padded.reshape(rows, 2, cols, 2).max(axis=(1, 3)))
+    return pyramid
+
+
+def _padded(level):
+    """Livello della piramide con una riga e una colonna di -inf per gli indici fuori dal raster."""
+    padded = np.full((level.shape[0] + 1, level.shape[1] + 1), -np.inf)
+    padded[:-1, :-1] = level
+    return padded
+
+
+def _axis_samples(positions, offset, level, size):
+    """Indici lungo un asse nel livello della piramide (l'ultimo, di -inf, fuori dal raster)."""
+    shifted = positions + offset
+    return np.where((shifted >= 0) & (shifted < size), shifted >> level, -1)
+
+
+def svf_window(heights, spacing, rows, cols, azimuths=DEFAULT_AZIMUTHS, radius=DEFAULT_RADIUS):
+    """
+    SVF di una griglia di pixel di un array di quote.
+
+    La piramide è allineata all'origine di ``heights``: per risultati che non
+    dipendono dalla suddivisione la prima riga deve essere un multiplo di
+    ``2 ** livelli`` nel raster.
+
+    :param heights: Array (righe, colonne) delle quote, NaN dove mancano
+    :param spacing: Dimensioni del pixel (x, y) in metri
+    :param rows: Indici (crescenti) delle righe di ``heights`` su cui calcolare lo SVF
+    :param cols: Indici (crescenti) delle colonne
+    :return: Array float64 (len(rows), len(cols)), NaN dove manca la quota
+    """
+    spacing_x, spacing_y = float(spacing[0]), float(spacing[1])
+    steps = search_steps(radius / min(spacing_x, spacing_y))
+    levels = max((level for _, level in steps), default=0)
+    pyramid = [_padded(level) for level in _pyramid(np.where(np.isnan(heights), -np.inf, heights), levels)]
+    height, width = heights.shape
+    rows, cols = np.asarray(rows, dtype=np.intp), np.asarray(cols, dtype=np.intp)
+    center = heights[np.ix_(rows, cols)]
+
+    sines = np.zeros(center.shape)
+    for azimuth in np.arange(azimuths) * (2 * math.pi / azimuths):
+        # Nord in alto: le righe crescono verso sud
+        dx, dy = math.sin(azimuth), -math.cos(azimuth)
+        slope = np.zeros(center.shape)
+        for distance, level in steps:
+            col_offset, row_offset = int(round(distance * dx)), int(round(distance * dy))
+            ground = math.hypot(col_offset * spacing_x, row_offset * spacing_y)
+            if ground == 0:
+                continue
+            sample = pyramid[level][np.ix_(_axis_samples(rows, row_offset, level, height),
+                                           _axis_samples(cols, col_offset, level, width))]
+            np.maximum(slope, (sample - center) / ground, out=slope)
+        sines += slope / np.sqrt(1 + slope ** 2)
+    svf = 1 - sines / azimuths
+    svf[np.isnan(center)] = np.nan
+    return svf
+
+
+def sky_view_factor(heights, spacing=(1.0, 1.0), azimuths=DEFAULT_AZIMUTHS, radius=DEFAULT_RADIUS):
+    """SVF di ogni pixel di un array di quote in memoria (vedi ``svf_window``)."""
+    heights = np.asarray(heights, dtype=np.float64)
+    return svf_window(heights, spacing, np.arange(heights.shape[0]), np.arange(heights.shape[1]),
+                      azimuths, radius)
+
+
+def _tile_size(width, halo, budget_pixels):
+    """
+    Righe e colonne dei tasselli: almeno ``HALO_MULTIPLE`` volte l'alone, e
+    con l'alone entro ``budget_pixels`` se il raster lo consente.
+
+    :return: Coppia (righe, colonne); le colonne sono ``width`` se basta una striscia intera
+    """
+    side = max(1, HALO_MULTIPLE * halo)
+    block_rows = max(side, budget_pixels // (width + 2 * halo) - 2 * halo)
+    if (block_rows + 2 * halo) * (width + 2 * halo) <= budget_pixels:
+        return block_rows, width
+    return block_rows, max(side, budget_pixels // (block_rows + 2 * halo) - 2 * halo)
+
+
+def _svf_rows(dsm, mask, cell_labels, spacing, azimuths, radius, stride, block_rows, block_cols, row_start,
+              row_stop):
+    """
+    Somme e conteggi dello SVF per cella sulle righe ``row_start:row_stop``.
+
+    :return: Array (4, celle): somme e conteggi sui pixel di terreno, somme e conteggi su tutti i pixel
+    """
+    info = cell_labels.info
+    steps = search_steps(radius / min(spacing))
+    align = 2 ** max((level for _, level in steps), default=0)
+    halo = steps[-1][0] if steps else 0
+    reader = RasterReader(dsm)
+    mask_reader = RasterReader(mask) if mask is not None else None
+    nodata = info.nodata
+    totals = np.zeros((4, cell_labels.count))
+    all_cols = np.arange(0, info.width, stride)
+
+    for row_off, nrows in block_windows(info.height, block_rows, row_start, row_stop):
+        rows = np.arange(-(-row_off // stride) * stride, row_off + nrows, stride)
+        if not len(rows):
+            continue
+        # Tasselli allargati dell'alone e allineati ai blocchi della piramide
+        first = max(0, row_off - halo) // align * align
+        last = min(info.height, -(-(row_off + nrows + halo) // align) * align)
+        labels_rows = cell_labels.window(row_off, nrows)[rows - row_off]
+        mask_rows = mask_reader.rows(row_off, nrows)[rows - row_off] if mask_reader is not None else None
+        for col_off, ncols in block_windows(info.width, block_cols):
+            cols = all_cols[(all_cols >= col_off) & (all_cols < col_off + ncols)]
+            if not len(cols):
+                continue
+            col_first = max(0, col_off - halo) // align * align
+            col_last = min(info.width, -(-(col_off + ncols + halo) // align) * align)
+            heights = reader.read(col_first, first, col_last - col_first, last - first).astype(np.float64)
+            if nodata is not None:
+                heights[heights == nodata] = np.nan
+            svf = svf_window(heights, spacing, rows - first, cols - col_first, azimuths, radius)
+            labels = labels_rows[:, cols]
+            valid = (labels >= 0) & ~np.isnan(svf)
+            ground = valid
+            if mask_rows is not None:
+                ground = valid & (mask_rows[:, cols] != 1)
+            for index, selected in ((0, ground), (2, valid)):
+                totals[index] += np.bincount(labels[selected], svf[selected], cell_labels.count)
+                totals[index + 1] += np.bincount(labels[selected], minlength=cell_labels.count)
+    return totals
+
+
+def sky_view_factor_by_cell(dsm, cell_labels, mask=None, azimuths=DEFAULT_AZIMUTHS, radius=DEFAULT_RADIUS,
+                            stride=1, block_rows=None, workers=None, block_cols=None):
+    """
+    SVF medio per cella.
+
+    Con la maschera degli edifici la media è sui pixel di terreno (maschera
+    diversa da 1), come lo SVF al livello della strada delle LCZ; le celle
+    interamente coperte da edifici usano la media su tutti i pixel.
+
+    :param dsm: Raster del DSM (percorso o layer QGIS), in metri
+    :param cell_labels: CellLabels allineato al DSM
+    :param mask: Raster della maschera degli edifici sulla stessa griglia del DSM (opzionale)
+    :param azimuths: Numero di direzioni
+    :param radius: Raggio di ricerca dell'orizzonte in metri
+    :param stride: Calcola lo SVF su un pixel ogni ``stride`` in righe e colonne
+    :param block_rows: Righe per tassello (default: almeno ``HALO_MULTIPLE`` volte l'alone)
+    :param workers: Numero di processi (1 o None = sequenziale)
+    :param block_cols: Colonne per tassello (default: la striscia intera, se sta in DEFAULT_BLOCK_BYTES)
+    :return: Array float64 allineato a ``cell_labels.fids``, NaN per le celle senza pixel validi
+    """
+    return svf_from_totals(sky_view_factor_totals(dsm, cell_labels, mask, azimuths, radius, stride, block_rows,
+                                                  workers, block_cols))
+
+
+def svf_from_totals(totals):
+    """SVF medio per cella dalle somme di ``sky_view_factor_totals`` (anche sommate su più celle)."""
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ground = totals[0] / totals[1]
+        overall = totals[2] / totals[3]
+    return np.where(totals[1] > 0, ground, overall)
+
+
+def sky_view_factor_totals(dsm, cell_labels, mask=None, azimuths=DEFAULT_AZIMUTHS, radius=DEFAULT_RADIUS,
+                           stride=1, block_rows=None, workers=None, block_cols=None):
+    """
+    Somme e conteggi dello SVF per cella (parametri come ``sky_view_factor_by_cell``).
+
+    :return: Array (4, celle): somme e conteggi sui pixel di terreno, somme e conteggi su tutti i pixel
+    """
+    if azimuths < 1 or radius <= 0 or stride < 1:
+        raise ValueError("Direzioni, raggio e passo di campionamento dello SVF devono essere positivi.")
+    info = cell_labels.info
+    if not same_grid(raster_info(dsm), info):
+        raise ValueError("Le etichette di cella non sono allineate al DSM.")
+    if mask is not None and not same_grid(raster_info(mask), info):
+        raise ValueError("La maschera degli edifici deve avere la stessa griglia del DSM.")
+    spacing = (abs(info.pixel_width), abs(info.pixel_height))
+    halo = int(math.ceil(radius / min(spacing)))
+    default_rows, default_cols = _tile_size(max(info.width, 1), halo, DEFAULT_BLOCK_BYTES // _STRIP_BYTES)
+    block_rows = block_rows or default_rows
+    block_cols = block_cols or default_cols
+
+    workers = effective_workers(workers)
+    chunks = split_rows(cell_labels, workers)
+    partials = map_chunks(functools.partial(_svf_rows, dsm, mask, cell_labels, spacing, int(azimuths),
+                                            float(radius), int(stride), block_rows, block_cols), chunks, workers)
+    return sum(partials) if partials else np.zeros((4, cell_labels.count))
@@ -0,0 +1,282 @@
+"""
+Pianificazione dei centri delle richieste Solar API per un poligono qualsiasi.
+
+``subdivideRectangle`` in ``index.html`` copre tutto il rettangolo disegnato
+con quadrati di 195 m e calcola la scala della longitudine una sola volta,
+alla latitudine dell'angolo nord-ovest: nelle aree alte in latitudine le
+righe più a sud restano scoperte ai bordi. Qui i centri sono calcolati in una
+proiezione sinusoidale (equivalente, con distanze esatte lungo i paralleli)
+centrata sul meridiano medio del poligono:
+
+* le righe sono fasce di ``step`` metri centrate sull'estensione nord-sud;
+* in ogni riga si cercano gli intervalli in cui il poligono è presente e li
+  si copre con il minimo numero di quadrati (copertura greedy, ottima in 1D);
+* ogni centro è riportato in gradi con la scala della propria latitudine.
+
+Ogni richiesta con ``radiusMeters=radius`` restituisce un quadrato di lato
+``2 * radius``; il passo ``step`` (195 m come nell'interfaccia web) lascia un
+margine di sovrapposizione tra quadrati vicini. La convergenza dei meridiani
+sposta i bordi dei quadrati lontani dal meridiano centrale di circa
+``x * tan(lat) * 2 * radius / 6371 km``: meno di 2 m a 50 km dal centro alle
+nostre latitudini, entro il margine predefinito di 5 m.
+"""
+import json
+import math
+import os
+
+import numpy as np
+
+from .cells import points_in_rings
+from .download import (METERS_PER_DEGREE, MANIFEST_NAME, PIXEL_SIZE, REQUEST_RADIUS, TILE_SIZE, Manifest,
+                       subdivide_rectangle)
+
+# Byte per pixel dei prodotti scaricati (DSM float32, RGB a 3 bande, MASK a 1 banda), senza compressione
+PRODUCT_BYTES_PER_PIXEL = {'dsm': 4, 'rgb': 3, 'mask': 1}
+
+
+def rectangle_rings(north, west, south, east):
+    """Anelli (lng, lat) di un rettangolo geografico."""
+    return [[(west, north), (east, north), (east, south), (west, south), (west, north)]]
+
+
+def read_polygon(path):
+    """
+    Legge gli anelli dei poligoni di un file GeoJSON (coordinate lng, lat).
+
+    Sono accettati FeatureCollection, Feature e geometrie Polygon o MultiPolygon;
+    anelli di feature diverse si sommano con la regola pari-dispari.
+    """
+    with open(path, encoding='utf-8') as handle:
+        data = json.load(handle)
+    if data.get('type') == 'FeatureCollection':
+        geometries = [feature.get('geometry') for feature in data.get('features', [])]
+    elif data.get('type') == 'Feature':
+        geometries = [data.get('geometry')]
+    else:
+        geometries = [data]
+    rings = []
+    for geometry in geometries:
+        if not geometry:
+            continue
+        if geometry['type'] == 'Polygon':
+            rings.extend(geometry['coordinates'])
+        elif geometry['type'] == 'MultiPolygon':
+            rings.extend(ring for polygon in geometry['coordinates'] for ring in polygon)
+    if not rings:
+        raise ValueError(f"Nessun poligono nel file {path}")
+    return [[(float(x), float(y)) for x, y, *_ in ring] for ring in rings]
+
+
+def _to_plane(rings, central_lng):
+    """Anelli (lng, lat) in coordinate sinusoidali (metri) attorno a ``central_lng``."""
+    projected = []
+    for ring in rings:
+        ring = np.asarray(ring, dtype=np.float64)
+        lng, lat = ring[:, 0], ring[:, 1]
+        x = (lng - central_lng) * METERS_PER_DEGREE * np.cos(np.radians(lat))
+        projected.append(np.column_stack([x, lat * METERS_PER_DEGREE]))
+    return projected
+
+
+def _ring_area(rings):
+    """Area (pari-dispari) di anelli in coordinate piane: i buchi vengono sottratti."""
+    area = 0.0
+    for index, ring in enumerate(rings):
+        x, y = ring[:, 0], ring[:, 1]
+        ring_area = abs(np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1))) / 2
+        others = rings[:index] + rings[index + 1:]
+        inside = bool(others) and points_in_rings(ring[:1, 0], ring[:1, 1], others)[0]
+        area += -ring_area if inside else ring_area
+    return area
+
+
+def band_intervals(rings, y0, y1):
+    """
+    Intervalli di X in cui il poligono è presente nella fascia ``y0 <= y <= y1``.
+
+    Gli estremi di ogni parte del poligono nella fascia stanno sui suoi lati:
+    si uniscono gli intervalli dei lati tagliati sulla fascia e si colmano i
+    vuoti che cadono all'interno del poligono.
+
+    :return: Lista ordinata di coppie (xmin, xmax) disgiunte
+    """
+    pieces = []
+    for ring in rings:
+        closed = ring if np.array_equal(ring[0], ring[-1]) else np.vstack([ring, ring[:1]])
+        xa, ya = closed[:-1, 0], closed[:-1, 1]
+        xb, yb = closed[1:, 0], closed[1:, 1]
+        low, high = np.minimum(ya, yb), np.maximum(ya, yb)
+        keep = (high >= y0) & (low <= y1)
+        xa, ya, xb, yb, low, high = xa[keep], ya[keep], xb[keep], yb[keep], low[keep], high[keep]
+        flat = ya == yb
+        slope = np.where(flat, 0.0, (xb - xa) / np.where(flat, 1.0, yb - ya))
+        x_low = np.where(flat, xa, xa + (np.maximum(low, y0) - ya) * slope)
+        x_high = np.where(flat, xb, xa + (np.minimum(high, y1) - ya) * slope)
+        pieces.extend(zip(np.minimum(x_low, x_high), np.maximum(x_low, x_high)))
+    if not pieces:
+        return []
+    pieces.sort()
+    merged = [list(pieces[0])]
+    for start, stop in pieces[1:]:
+        if start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], stop)
+        else:
+            merged.append([start, stop])
+    # Un vuoto tra due intervalli non è attraversato da nessun lato: è tutto dentro o tutto fuori
+    middle_y = (y0 + y1) / 2
+    intervals = [merged[0]]
+    for start, stop in merged[1:]:
+        gap_x = (intervals[-1][1] + start) / 2
+        if points_in_rings(np.array([gap_x]), np.array([middle_y]), rings)[0]:
+            intervals[-1][1] = stop
+        else:
+            intervals.append([start, stop])
+    return [(float(start), float(stop)) for start, stop in intervals]
+
+
+def cover_intervals(intervals, step):
+    """
+    Centri del minimo numero di segmenti lunghi ``step`` che coprono gli intervalli.
+
+    Ogni segmento parte dal primo punto ancora scoperto (strategia greedy,
+    ottima in una dimensione).
+    """
+    centers = []
+    covered = -math.inf
+    for start, stop in intervals:
+        if stop <= covered:
+            continue
+        start = max(start, covered)
+        while True:
+            centers.append(start + step / 2)
+            covered = start + step
+            if covered >= stop:
+                break
+            start = covered
+    return centers
+
+
+def _union_area(xmin, ymin, xmax, ymax):
+    """Area dell'unione di rettangoli allineati agli assi (scansione per fasce)."""
+    edges = np.unique(np.concatenate([ymin, ymax]))
+    area = 0.0
+    for y0, y1 in zip(edges[:-1], edges[1:]):
+        active = (ymin < y1) & (ymax > y0)
+        if not active.any():
+            continue
+        order = np.argsort(xmin[active], kind='stable')
+        starts, stops = xmin[active][order], xmax[active][order]
+        reach = np.maximum.accumulate(stops)
+        previous = np.concatenate([[-np.inf], reach[:-1]])
+        area += np.clip(reach - np.maximum(starts, previous), 0, None).sum() * (y1 - y0)
+    return float(area)
+
+
+def tile_bytes(radius=REQUEST_RADIUS, pixel_size=PIXEL_SIZE):
+    """Byte non compressi dei tre GeoTIFF di un tile (stima per eccesso)."""
+    side = round(2 * radius / pixel_size)
+    return side * side * sum(PRODUCT_BYTES_PER_PIXEL.values())
+
+
+def measured_tile_bytes(directory):
+    """
+    Byte medi per tile dei download già presenti in una cartella (dal manifest).
+
+    :return: Media in byte, oppure None se non ci sono tile completati
+    """
+    manifest = Manifest(os.path.join(directory, MANIFEST_NAME))
+    sizes = [sum(os.path.getsize(os.path.join(directory, name)) for name in files)
+             for tile, files in manifest.completed.items() if manifest.is_done(tile, directory)]
+    return sum(sizes) / len(sizes) if sizes else None
+
+
+class TilePlan:
+    """
+    Centri delle richieste e stime di copertura e di volume scaricato.
+
+    :param centroids: Lista di coppie (latitudine, longitudine), per righe da nord a sud
+    :param footprint: Lato in metri dell'area restituita da una richiesta
+    :param polygon_area: Area del poligono in m²
+    :param union_area: Area in m² coperta da almeno una richiesta
+    :param baseline_tiles: Richieste di ``subdivideRectangle`` sul rettangolo che contiene il poligono
+    :param bytes_per_tile: Byte scaricati per tile
+    """
+
+    def __init__(self, centroids, footprint, polygon_area, union_area, baseline_tiles, bytes_per_tile):
+        self.centroids = centroids
+        self.footprint = footprint
+        self.polygon_area = polygon_area
+        self.union_area = union_area
+        self.baseline_tiles = baseline_tiles
+        self.bytes_per_tile = bytes_per_tile
+
+    @property
+    def count(self):
+        return len(self.centroids)
+
+    @property
+    def requested_area(self):
+        """Area totale delle richieste in m², contando più volte le sovrapposizioni."""
+        return self.count * self.footprint ** 2
+
+    @property
+    def overlap_ratio(self):
+        """Frazione dell'area scaricata che è già coperta da un'altra richiesta."""
+        return 1 - self.union_area / self.requested_area if self.count else 0.0
+
+    @property
+    def expected_bytes(self):
+        return int(self.count * self.bytes_per_tile)
+
+    def summary(self):
+        """Riepilogo testuale del piano."""
+        return "\n".join([
+            f"Richieste: {self.count} (subdivideRectangle: {self.baseline_tiles})",
+            f"Area del poligono: {self.polygon_area / 1e6:.3f} km²",
+            f"Area scaricata: {self.requested_area / 1e6:.3f} km², distinta: {self.union_area / 1e6:.3f} km²",
+            f"Sovrapposizione: {self.overlap_ratio:.1%}",
+            f"Volume atteso: {self.expected_bytes / 1e6:.1f} MB",
+        ])
+
+
+def plan_tiles(rings, radius=REQUEST_RADIUS, step=TILE_SIZE, bytes_per_tile=None):
+    """
+    Calcola i centri delle richieste che coprono un poligono.
+
+    :param rings: Anelli del poligono come sequenze di (lng, lat), regola pari-dispari
+    :param radius: ``radiusMeters`` delle richieste
+    :param step: Distanza in metri tra centri vicini (al massimo ``2 * radius``)
+    :param bytes_per_tile: Byte per tile per la stima del volume (default: ``tile_bytes(radius)``)
+    :return: TilePlan
+    """
+    footprint = 2 * radius
+    if not 0 < step <= footprint:
+        raise ValueError(f"Il passo deve essere compreso tra 0 e {footprint} m.")
+    points = np.concatenate([np.asarray(ring, dtype=np.float64) for ring in rings])
+    west, south = points.min(axis=0)
+    east, north = points.max(axis=0)
+    central_lng = (west + east) / 2
+    plane = _to_plane(rings, central_lng)
+
+    ymin, ymax = south * METERS_PER_DEGREE, north * METERS_PER_DEGREE
+    nrows = max(1, math.ceil((ymax - ymin) / step - 1e-9))
+    top = ymax + (nrows * step - (ymax - ymin)) / 2
+    centers = []
+    for row in range(nrows):
+        y1 = top - row * step
+        y_center = y1 - step / 2
+        for x_center in cover_intervals(band_intervals(plane, y1 - step, y1), step):
+            centers.append((x_center, y_center))
+
+    centroids = []
+    for x_center, y_center in centers:
+        lat = y_center / METERS_PER_DEGREE
+        centroids.append((lat, central_lng + x_center / (METERS_PER_DEGREE * math.cos(math.radians(lat)))))
+    if centers:
+        xs, ys = np.array(centers).T
+        union_area = _union_area(xs - radius, ys - radius, xs + radius, ys + radius)
+    else:
+        union_area = 0.0
+    return TilePlan(centroids, footprint, _ring_area(plane), union_area,
+                    len(subdivide_rectangle(north, west, south, east)),
+                    tile_bytes(radius) if bytes_per_tile is None else bytes_per_tile)
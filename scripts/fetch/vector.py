@@ -0,0 +1,68 @@
+"""
+Scrittura della griglia di analisi in GeoPackage tramite OGR, senza QGIS.
+"""
+import os
+
+import numpy as np
+from osgeo import ogr, osr
+
+ogr.UseExceptions()
+
+
+def _polygon(cell):
+    """Geometria OGR di una cella."""
+    polygon = ogr.Geometry(ogr.wkbPolygon)
+    for ring_points in cell.rings:
+        ring = ogr.Geometry(ogr.wkbLinearRing)
+        for x, y in ring_points:
+            ring.AddPoint_2D(float(x), float(y))
+        ring.CloseRings()
+        polygon.AddGeometry(ring)
+    return polygon
+
+
+def _field_type(values):
+    """Tipo di campo OGR adatto a una colonna NumPy."""
+    kind = np.asarray(values).dtype.kind
+    if kind in 'iub':
+        return ogr.OFTInteger64
+    if kind == 'f':
+        return ogr.OFTReal
+    return ogr.OFTString
+
+
+def write_grid(path, cells, columns, projection='', layer_name='grid'):
+    """
+    Scrive le celle e i loro attributi in un GeoPackage, in un'unica transazione.
+
+    :param path: Percorso del file .gpkg (viene sovrascritto)
+    :param cells: Lista di oggetti Cell o RasterGrid (i poligoni vengono creati uno alla volta)
+    :param columns: Dizionario nome del campo -> sequenza di valori allineata a cells
+    :param projection: Sistema di riferimento in WKT
+    :return: Percorso del file scritto
+    """
+    if os.path.exists(path):
+        ogr.GetDriverByName('GPKG').DeleteDataSource(path)
+    datasource = ogr.GetDriverByName('GPKG').CreateDataSource(path)
+    srs = osr.SpatialReference(wkt=projection) if projection else None
+    layer = datasource.CreateLayer(layer_name, srs, ogr.wkbPolygon)
+    for name, values in columns.items():
+        layer.CreateField(ogr.FieldDefn(name, _field_type(values)))
+
+    definition = layer.GetLayerDefn()
+    layer.StartTransaction()
+    for row, cell in enumerate(cells):
+        feature = ogr.Feature(definition)
+        feature.SetFID(int(cell.fid))
+        feature.SetGeometry(_polygon(cell))
+        for name, values in columns.items():
+            value = values[row]
+            value = value.item() if hasattr(value, 'item') else value
+            if value is None or (isinstance(value, float) and np.isnan(value)):
+                feature.SetFieldNull(name)
+            else:
+                feature.SetField(name, value)
+        layer.CreateFeature(feature)
+    layer.CommitTransaction()
+    datasource = None
+    return path
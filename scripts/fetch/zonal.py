@@ -0,0 +1,541 @@
+"""
+Motore di statistiche zonali a passaggio singolo.
+
+Sostituisce le esecuzioni ripetute di ``qgis:zonalstatistics`` e
+``native:zonalstatisticsfb`` degli script 10, 11 e 13: la griglia viene
+convertita in etichette di cella una sola volta per ogni geometria di raster
+e ogni raster di input viene letto una sola volta, calcolando insieme tutte le
+statistiche richieste.
+
+Esempio::
+
+    engine = ZonalEngine(cells)
+    engine.add('dsm', 'dsm_unito.tif', ['median', 'mean'])
+    engine.add('mask', 'mask_unito.tif')
+    engine.add_derived('med', lambda dsm, mask: dsm * mask, ['dsm', 'mask'], ['median'])
+    results = engine.run()
+    results['dsm']['median']  # array allineato a engine.fids
+
+La statistica ``sketch`` è il riassunto dei quantili di ogni cella (vedi
+``sketch``), un array (celle, punti) da cui si ricavano mediana e maggioranza
+di celle più grandi senza rileggere il raster.
+
+Con ``median_error`` le mediane sono approssimate: invece di tutti i pixel
+delle celle aperte si conserva un riassunto dei quantili di dimensione fissa,
+con un errore di rango al più ``median_error`` (frazione dei pixel della
+cella). La memoria per cella non dipende più dalla dimensione delle celle.
+"""
+import functools
+
+import numpy as np
+
+from .cells import CellLabels, cell_fids
+from .parallel import effective_workers, map_chunks, owned_cells, split_rows
+from .raster import RasterReader, block_windows, iter_row_blocks, open_raster, raster_info, rows_per_block
+from .sketch import (DEFAULT_POINTS, SKETCH_DTYPE, SketchAccumulator, merge_sketches, points_for_error,
+                     sketch_from_sorted, sketch_median)
+
+STATISTICS = ('count', 'sum', 'mean', 'median', 'majority', 'sketch')
+
+# Statistiche che richiedono di conservare i valori dei pixel fino alla fine
+_SORTED_STATISTICS = ('median', 'majority', 'sketch')
+
+# Statistiche ricavate dai riassunti dei quantili quando le mediane sono approssimate
+_SKETCH_STATISTICS = ('median', 'sketch')
+
+
+def group_sorted(labels, values, ncells):
+    """
+    Ordina i pixel per (cella, valore).
+
+    :return: Tupla (valori ordinati, conteggio per cella, indice del primo pixel di ogni cella)
+    """
+    order = np.lexsort((values, labels))
+    counts = np.bincount(labels, minlength=ncells)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    return values[order], counts, starts
+
+
+def sorted_median(sorted_values, counts, starts):
+    """
+    Mediana per cella da valori già ordinati per (cella, valore).
+
+    Con un numero pari di pixel restituisce la media dei due valori centrali,
+    come ``statistics.median`` e le statistiche zonali di QGIS.
+    """
+    median = np.full(len(counts), np.nan)
+    has_values = counts > 0
+    lo = starts[has_values] + (counts[has_values] - 1) // 2
+    hi = starts[has_values] + counts[has_values] // 2
+    median[has_values] = (sorted_values[lo].astype(np.float64) + sorted_values[hi]) / 2
+    return median
+
+
+def sorted_majority(sorted_labels, sorted_values, ncells):
+    """
+    Valore più frequente per cella (a parità di frequenza vince il valore minore).
+    """
+    majority = np.full(ncells, np.nan)
+    if len(sorted_values) == 0:
+        return majority
+    # Inizio di ogni sequenza di coppie (cella, valore) uguali
+    new_run = np.ones(len(sorted_values), dtype=bool)
+    new_run[1:] = (sorted_labels[1:] != sorted_labels[:-1]) | (sorted_values[1:] != sorted_values[:-1])
+    run_starts = np.flatnonzero(new_run)
+    run_lengths = np.diff(np.append(run_starts, len(sorted_values)))
+    run_labels = sorted_labels[run_starts]
+    # Ordina le sequenze per cella e frequenza decrescente; a parità resta l'ordine per valore
+    order = np.lexsort((-run_lengths, run_labels))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = run_labels[order][1:] != run_labels[order][:-1]
+    best = order[first]
+    majority[run_labels[best]] = sorted_values[run_starts[best]]
+    return majority
+
+
+def bulk_median(labels, values, ncells, exclude_zero=False, empty_value=None):
+    """
+    Mediana per cella con un solo ordinamento per (cella, valore).
+
+    Versione in memoria: etichette e valori di tutto il raster devono stare in RAM.
+    Per raster più grandi usare ``median_by_cell``.
+
+    :param labels: Etichette di cella dei pixel (-1 fuori griglia)
+    :param values: Valori dei pixel, stessa forma di labels
+    :param ncells: Numero di celle
+    :param exclude_zero: Se True ignora i pixel con valore 0, come ``val != 0``
+                         negli script 08 e 09
+    :param empty_value: Valore per le celle senza pixel validi (default NaN)
+    :return: Array delle mediane per cella
+    """
+    labels = np.ravel(labels)
+    values = np.ravel(values)
+    valid = (labels >= 0) & ~_invalid_mask(values, 0 if exclude_zero else None)
+    sorted_values, counts, starts = group_sorted(labels[valid].astype(np.int64), values[valid], ncells)
+    median = sorted_median(sorted_values, counts, starts)
+    if empty_value is not None:
+        median[counts == 0] = empty_value
+    return median
+
+
+class _SortedAccumulator:
+    """
+    Raccoglie le coppie (cella, valore) per mediana e maggioranza.
+
+    Le celle la cui ultima riga di pixel è già stata letta vengono chiuse
+    subito: in memoria restano solo i pixel delle celle ancora aperte, cioè
+    circa una fila di celle, qualunque sia la dimensione del raster.
+    """
+
+    def __init__(self, ncells, row_end, statistics, points=DEFAULT_POINTS):
+        self.row_end = row_end
+        self.points = points
+        self.statistics = [stat for stat in statistics if stat in _SORTED_STATISTICS]
+        self.results = _sorted_results(ncells, self.statistics, points)
+        self._cells = np.empty(0, dtype=np.int64)
+        self._values = None
+
+    def add(self, cells, values, rows_done):
+        """
+        Aggiunge i pixel validi di un blocco.
+
+        :param rows_done: Numero di righe del raster lette finora
+        """
+        if self._values is None:
+            self._values = np.empty(0, dtype=values.dtype)
+        self._cells = np.concatenate((self._cells, cells))
+        self._values = np.concatenate((self._values, values))
+        complete = self.row_end[self._cells] <= rows_done
+        if complete.any():
+            self._close(self._cells[complete], self._values[complete])
+            self._cells = self._cells[~complete]
+            self._values = self._values[~complete]
+
+    def finish(self):
+        """Chiude le celle rimaste aperte e restituisce i risultati."""
+        if self._values is not None and len(self._cells):
+            self._close(self._cells, self._values)
+        self._cells = np.empty(0, dtype=np.int64)
+        self._values = None
+        return self.results
+
+    def _close(self, cells, values):
+        """Calcola le statistiche di un insieme di celle complete."""
+        present, compact = np.unique(cells, return_inverse=True)
+        sorted_values, counts, starts = group_sorted(compact, values, len(present))
+        if 'median' in self.results:
+            self.results['median'][present] = sorted_median(sorted_values, counts, starts)
+        if 'majority' in self.results:
+            sorted_labels = np.repeat(np.arange(len(present)), counts)
+            self.results['majority'][present] = sorted_majority(sorted_labels, sorted_values, len(present))
+        if 'sketch' in self.results:
+            self.results['sketch'][present] = sketch_from_sorted(sorted_values, counts, starts, self.points)[0]
+
+
+def _sorted_results(ncells, statistics, points):
+    """Array dei risultati delle statistiche ordinate, NaN per le celle non ancora chiuse."""
+    results = {}
+    for stat in statistics:
+        if stat == 'sketch':
+            results[stat] = np.full((ncells, points), np.nan, dtype=SKETCH_DTYPE)
+        elif stat in _SORTED_STATISTICS:
+            results[stat] = np.full(ncells, np.nan)
+    return results
+
+
+def approximate_points(median_error, cell_labels, block_rows):
+    """
+    Punti dei riassunti per mediane con errore di rango al più ``median_error``.
+
+    Ogni blocco di righe che tocca una cella è un'unione del suo riassunto:
+    una cella alta ``h`` righe ne subisce al più ``ceil(h / block_rows) + 1``.
+
+    :return: Numero di punti, None se ``median_error`` è None (mediane esatte)
+    """
+    if median_error is None:
+        return None
+    heights = cell_labels.row_end - cell_labels.row_start
+    tallest = int(heights.max()) if len(heights) else 0
+    return points_for_error(median_error, -(-tallest // block_rows) + 1)
+
+
+def median_by_cell(raster, cell_labels, band=1, exclude_zero=False, empty_value=None, block_rows=None,
+                   workers=None, median_error=None):
+    """
+    Mediana per cella letta a blocchi, per raster più grandi della RAM.
+
+    Dà lo stesso risultato di ``bulk_median`` ma tiene in memoria solo i
+    pixel delle celle non ancora complete.
+
+    :param raster: Raster dei valori (percorso o layer QGIS)
+    :param cell_labels: CellLabels allineato al raster
+    :param exclude_zero: Se True ignora i pixel con valore 0
+    :param empty_value: Valore per le celle senza pixel validi (default NaN)
+    :param workers: Numero di processi (default: sequenziale)
+    :param median_error: Errore di rango ammesso (ad es. 0.01); None = mediane esatte
+    :return: Array delle mediane allineato a ``cell_labels.fids``
+    """
+    dataset = open_raster(raster)
+    if block_rows is None:
+        block_rows = rows_per_block(dataset, band)
+    points = approximate_points(median_error, cell_labels, block_rows)
+    workers = effective_workers(workers)
+    chunks = split_rows(cell_labels, workers)
+    partials = map_chunks(functools.partial(_median_rows, raster, cell_labels, band, exclude_zero, block_rows,
+                                            points),
+                          chunks, workers)
+
+    median = np.full(cell_labels.count, np.nan)
+    counts = np.zeros(cell_labels.count, dtype=np.int64)
+    for (row_start, row_stop), (chunk_median, chunk_counts) in zip(chunks, partials):
+        owned = owned_cells(cell_labels, row_start, row_stop)
+        median[owned] = chunk_median[owned]
+        counts += chunk_counts
+    if empty_value is not None:
+        median[counts == 0] = empty_value
+    return median
+
+
+def _median_rows(raster, cell_labels, band, exclude_zero, block_rows, points, row_start, row_stop):
+    """
+    Mediane e conteggi dei pixel validi delle celle nelle righe ``row_start:row_stop``.
+
+    :param points: Punti dei riassunti delle mediane approssimate (None = mediane esatte)
+    """
+    statistics = _CellStatistics(cell_labels.count, cell_labels.row_end, ['median'], median_points=points)
+    dataset = open_raster(raster)
+    nodata = dataset.GetRasterBand(band).GetNoDataValue()
+    for row_off, block in iter_row_blocks(dataset, band, block_rows, row_start, row_stop):
+        labels = cell_labels.window(row_off, block.shape[0])
+        invalid = _invalid_mask(block, nodata)
+        if exclude_zero:
+            invalid |= block == 0
+        statistics.add(labels, block, invalid, row_off + block.shape[0])
+    partial = statistics.partial()
+    return partial['median'], partial['count']
+
+
+def _invalid_mask(block, nodata):
+    """Pixel nulli di un blocco: NaN o uguali al valore di nodata."""
+    invalid = np.zeros(block.shape, dtype=bool)
+    if np.issubdtype(block.dtype, np.floating):
+        invalid |= np.isnan(block)
+    if nodata is not None:
+        invalid |= block == nodata
+    return invalid
+
+
+class _Input:
+    """Input registrato nel motore: raster su disco o espressione su altri input."""
+
+    def __init__(self, name, statistics, raster=None, band=1, func=None, sources=(), nan_sources=False):
+        unknown = set(statistics) - set(STATISTICS)
+        if unknown:
+            raise ValueError(f"Statistiche non supportate: {', '.join(sorted(unknown))}")
+        self.name = name
+        self.statistics = list(statistics)
+        self.raster = raster
+        self.band = band
+        self.func = func
+        self.sources = list(sources)
+        self.nan_sources = nan_sources
+
+
+class _CellStatistics:
+    """
+    Accumulatori per cella di un input: conteggio, somma e valori ordinati.
+
+    Ogni processo accumula le proprie strisce; i risultati parziali vengono
+    poi uniti con ``merge`` prendendo mediana e maggioranza solo dalle celle
+    complete nella striscia.
+
+    :param points: Punti per cella della statistica ``sketch``
+    :param median_points: Punti dei riassunti per mediana e ``sketch``
+                          approssimate (None = dai valori ordinati)
+    """
+
+    def __init__(self, ncells, row_end, statistics, points=DEFAULT_POINTS, median_points=None):
+        self.statistics = statistics
+        self.points = points
+        self.count = np.zeros(ncells, dtype=np.int64)
+        self.sum = np.zeros(ncells, dtype=np.float64)
+        self.sorted = None
+        self.sketch = None
+        sorted_statistics = [stat for stat in statistics if stat in _SORTED_STATISTICS]
+        if median_points and any(stat in _SKETCH_STATISTICS for stat in statistics):
+            sorted_statistics = [stat for stat in sorted_statistics if stat not in _SKETCH_STATISTICS]
+            # Un solo riassunto per mediana e sketch, ridotto a ``points`` punti alla fine
+            sketch_points = max(median_points, points if 'sketch' in statistics else 0)
+            self.sketch = SketchAccumulator(ncells, row_end, sketch_points)
+        if sorted_statistics:
+            self.sorted = _SortedAccumulator(ncells, row_end, sorted_statistics, points)
+        self.sorted_results = _sorted_results(ncells, statistics, points)
+
+    def add(self, labels, block, invalid, rows_done):
+        """Aggiorna gli accumulatori con un blocco di righe."""
+        ncells = len(self.count)
+        valid = (labels >= 0) & ~invalid
+        cell = labels[valid].astype(np.int64)
+        values = block[valid]
+        self.count += np.bincount(cell, minlength=ncells)
+        self.sum += np.bincount(cell, weights=values, minlength=ncells)
+        if self.sorted is not None:
+            self.sorted.add(cell, values, rows_done)
+        if self.sketch is not None:
+            self.sketch.add(cell, values, rows_done)
+
+    def partial(self):
+        """Risultati parziali di una striscia, da unire con ``merge``."""
+        partial = {'count': self.count, 'sum': self.sum}
+        if self.sorted is not None:
+            partial.update(self.sorted.finish())
+        if self.sketch is not None:
+            values, counts = self.sketch.finish()
+            if 'median' in self.statistics:
+                partial['median'] = sketch_median(values)
+            if 'sketch' in self.statistics:
+                if values.shape[1] != self.points:
+                    values = merge_sketches(values, counts, np.arange(len(counts)), len(counts), self.points)[0]
+                partial['sketch'] = values
+        return partial
+
+    def merge(self, partial, owned):
+        """
+        Unisce i risultati parziali di una striscia.
+
+        :param owned: Maschera delle celle interamente contenute nella striscia
+        """
+        self.count += partial['count']
+        self.sum += partial['sum']
+        for stat, values in self.sorted_results.items():
+            values[owned] = partial[stat][owned]
+
+    def finish(self):
+        """Statistiche finali richieste."""
+        result = {}
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(self.count > 0, self.sum / self.count, np.nan)
+        if 'count' in self.statistics:
+            result['count'] = self.count
+        if 'sum' in self.statistics:
+            result['sum'] = self.sum
+        if 'mean' in self.statistics:
+            result['mean'] = mean
+        result.update(self.sorted_results)
+        return result
+
+
+class ZonalEngine:
+    """
+    Calcola statistiche per cella su più raster con una sola lettura per raster.
+
+    Con ``workers`` > 1 il raster viene diviso in strisce allineate alle celle
+    ed elaborato da più processi (vedi ``parallel``); i risultati sono
+    identici a quelli dell'esecuzione sequenziale.
+
+    :param cells: Lista di oggetti Cell o RasterGrid (ad es. da ``qgis_io.cells_from_layer``)
+    :param block_rows: Righe lette per blocco (default automatico)
+    :param workers: Numero di processi (default: sequenziale)
+    :param sketch_points: Punti per cella della statistica ``sketch``
+    :param median_error: Errore di rango ammesso per le mediane (ad es. 0.01);
+                         None = mediane esatte
+    """
+
+    def __init__(self, cells, block_rows=None, workers=None, sketch_points=DEFAULT_POINTS, median_error=None):
+        if median_error is not None:
+            points_for_error(median_error)
+        self.cells = cells
+        self.fids = cell_fids(cells)
+        self.block_rows = block_rows
+        self.workers = workers
+        self.sketch_points = sketch_points
+        self.median_error = median_error
+        self._inputs = {}
+        self._labels = {}
+
+    def add(self, name, raster, statistics=(), band=1):
+        """
+        Registra un raster di input.
+
+        :param name: Nome dell'input, usato come chiave dei risultati
+        :param raster: Percorso del file o layer QGIS
+        :param statistics: Statistiche da calcolare (anche nessuna, se l'input
+                           serve solo a un input derivato)
+        :param band: Banda da leggere
+        """
+        self._inputs[name] = _Input(name, statistics, raster=raster, band=band)
+
+    def add_derived(self, name, func, sources, statistics, nan_sources=False):
+        """
+        Registra un input calcolato blocco per blocco da altri input.
+
+        :param func: Funzione che riceve gli array degli input ``sources`` e
+                     restituisce l'array dei valori
+        :param sources: Nomi di input già registrati, con la stessa geometria
+                        (dimensioni e geotrasformazione; run() solleva
+                        ValueError altrimenti)
+        :param nan_sources: Se True ``func`` riceve gli input come float64 con
+                            NaN nei pixel nulli, e sono nulli solo i pixel in cui
+                            restituisce NaN (per i valori che dipendono dai pixel
+                            vicini della stessa riga)
+        """
+        missing = [source for source in sources if source not in self._inputs]
+        if missing:
+            raise ValueError(f"Input non registrati: {', '.join(missing)}")
+        self._inputs[name] = _Input(name, statistics, func=func, sources=sources, nan_sources=nan_sources)
+
+    def labels_for(self, info):
+        """
+        Etichette di cella per una geometria di raster, create una sola volta.
+        """
+        key = (info.width, info.height, info.geotransform)
+        if key not in self._labels:
+            self._labels[key] = CellLabels(self.cells, info)
+        return self._labels[key]
+
+    def _groups(self):
+        """Raggruppa gli input su disco per geometria del raster."""
+        groups = {}
+        for item in self._inputs.values():
+            if item.raster is None:
+                continue
+            info = raster_info(item.raster, item.band)
+            key = (info.width, info.height, info.geotransform)
+            groups.setdefault(key, (info, []))[1].append(item)
+        return list(groups.values())
+
+    def _derived_for(self, names):
+        """Input derivati calcolabili dagli input ``names``, in ordine di dipendenza."""
+        derived = []
+        available = set(names)
+        pending = [item for item in self._inputs.values() if item.func is not None]
+        progress = True
+        while pending and progress:
+            progress = False
+            for item in list(pending):
+                if set(item.sources) <= available:
+                    derived.append(item)
+                    available.add(item.name)
+                    pending.remove(item)
+                    progress = True
+        return derived
+
+    def run(self):
+        """
+        Esegue il calcolo.
+
+        :return: Dizionario nome dell'input -> {statistica: array allineato a ``fids``}
+        """
+        ncells = len(self.fids)
+        workers = effective_workers(self.workers)
+        groups = [(info, members, self._derived_for([item.name for item in members]))
+                  for info, members in self._groups()]
+        # Un input derivato si calcola solo se tutte le sue sorgenti hanno la stessa geometria
+        computed = {item.name for _, _, derived in groups for item in derived}
+        uncomputed = [item.name for item in self._inputs.values()
+                      if item.func is not None and item.name not in computed]
+        if uncomputed:
+            raise ValueError(f"Input derivati con sorgenti su raster di geometria diversa: {', '.join(uncomputed)}")
+        totals = {}
+        for info, members, derived in groups:
+            labels_image = self.labels_for(info)
+            block_rows = self.block_rows or min(rows_per_block(open_raster(item.raster), item.band)
+                                                for item in members)
+            median_points = approximate_points(self.median_error, labels_image, block_rows)
+            for item in members + derived:
+                if item.statistics:
+                    totals[item.name] = _CellStatistics(ncells, labels_image.row_end, item.statistics,
+                                                        self.sketch_points)
+            chunks = split_rows(labels_image, workers)
+            partials = map_chunks(functools.partial(self._run_rows, info, members, derived, block_rows,
+                                                    median_points),
+                                  chunks, workers)
+            for (row_start, row_stop), partial in zip(chunks, partials):
+                owned = owned_cells(labels_image, row_start, row_stop)
+                for name, values in partial.items():
+                    totals[name].merge(values, owned)
+
+        results = {}
+        for name, item in self._inputs.items():
+            if item.statistics:
+                statistics = totals.get(name) or _CellStatistics(ncells, np.zeros(ncells, dtype=np.int64),
+                                                                 item.statistics, self.sketch_points)
+                results[name] = statistics.finish()
+        return results
+
+    def _run_rows(self, info, members, derived, block_rows, median_points, row_start, row_stop):
+        """
+        Accumula le statistiche di un gruppo di input sulle righe ``row_start:row_stop``.
+
+        :param median_points: Punti dei riassunti delle mediane approssimate (None = mediane esatte)
+        :return: Dizionario nome dell'input -> risultati parziali
+        """
+        ncells = len(self.fids)
+        labels_image = self.labels_for(info)
+        readers = {item.name: RasterReader(item.raster, item.band) for item in members}
+        statistics = {item.name: _CellStatistics(ncells, labels_image.row_end, item.statistics, self.sketch_points,
+                                                 median_points)
+                      for item in members + derived if item.statistics}
+        for row_off, nrows in block_windows(info.height, block_rows, row_start, row_stop):
+            labels = labels_image.window(row_off, nrows)
+            arrays = {}
+            invalid = {}
+            for item in members:
+                reader = readers[item.name]
+                arrays[item.name] = reader.rows(row_off, nrows)
+                invalid[item.name] = _invalid_mask(arrays[item.name], reader.band.GetNoDataValue())
+            for item in derived:
+                if item.nan_sources:
+                    block = item.func(*[np.where(invalid[source], np.nan, arrays[source].astype(np.float64))
+                                        for source in item.sources])
+                    mask = _invalid_mask(block, None)
+                else:
+                    # Un pixel derivato è nullo se è nullo uno qualsiasi dei pixel di origine
+                    block = item.func(*[arrays[source] for source in item.sources])
+                    mask = np.logical_or.reduce([invalid[source] for source in item.sources])
+                    mask |= _invalid_mask(block, None)
+                arrays[item.name] = block
+                invalid[item.name] = mask
+            for name, accumulator in statistics.items():
+                accumulator.add(labels, arrays[name], invalid[name], row_off + nrows)
+        return {name: accumulator.partial() for name, accumulator in statistics.items()}
@@ -0,0 +1,84 @@
+"""
+Cache delle fasi: blocchi delle voci usate e impronte dei file condivise tra processi.
+"""
+import json
+import os
+import time
+
+from fetch.cache import PIN_SECONDS, StageCache
+
+
+def _put(cache, tmp_path, key, size):
+    path = tmp_path / f'{key}.bin'
+    path.write_bytes(b'x' * size)
+    return cache.put(key, files={'artifact': str(path)})
+
+
+def _cached(root, key):
+    """True se la voce è in cache (senza bloccarla come farebbe ``get``)."""
+    return os.path.exists(os.path.join(root, 'objects', key, 'manifest.json'))
+
+
+def test_entries_used_in_run_are_pinned(tmp_path):
+    cache = StageCache(str(tmp_path / 'cache'), max_bytes=1000)
+    entries = [_put(cache, tmp_path, key, 800) for key in ('first', 'second', 'third')]
+    for entry in entries:
+        with open(entry['files']['artifact'], 'rb') as handle:
+            assert len(handle.read()) == 800
+
+    cache.release()
+    assert [key for key in ('first', 'second', 'third') if _cached(str(tmp_path / 'cache'), key)] == ['third']
+
+
+def test_unpinned_entries_are_evicted(tmp_path):
+    previous = StageCache(str(tmp_path / 'cache'))
+    _put(previous, tmp_path, 'old', 800)
+    previous.release()
+    cache = StageCache(str(tmp_path / 'cache'), max_bytes=1000)
+    _put(cache, tmp_path, 'new', 800)
+    assert not _cached(str(tmp_path / 'cache'), 'old')
+    assert _cached(str(tmp_path / 'cache'), 'new')
+
+
+def test_pins_hold_across_instances(tmp_path):
+    root = str(tmp_path / 'cache')
+    loaded = StageCache(root, max_bytes=1000)
+    _put(loaded, tmp_path, 'loaded', 800)
+    # Un altro script (altro oggetto, ad es. altro processo) riempie la cache
+    other = StageCache(root, max_bytes=1000)
+    _put(other, tmp_path, 'other', 800)
+    other.release()
+    assert _cached(root, 'loaded') and not _cached(root, 'other')
+
+    loaded.release()
+    later = StageCache(root, max_bytes=1000)
+    _put(later, tmp_path, 'later', 800)
+    assert not _cached(root, 'loaded')
+
+
+def test_expired_pins_are_ignored(tmp_path):
+    root = str(tmp_path / 'cache')
+    crashed = StageCache(root, max_bytes=1000)
+    entry = _put(crashed, tmp_path, 'crashed', 800)
+    entry_dir = os.path.dirname(entry['files']['artifact'])
+    expired = time.time() - PIN_SECONDS - 60
+    for name in os.listdir(entry_dir):
+        if name.startswith('.pin-'):
+            os.utime(os.path.join(entry_dir, name), (expired, expired))
+    cache = StageCache(root, max_bytes=1000)
+    _put(cache, tmp_path, 'new', 800)
+    assert not _cached(root, 'crashed')
+
+
+def test_file_digests_are_merged(tmp_path):
+    root = str(tmp_path / 'cache')
+    first, second = StageCache(root), StageCache(root)
+    paths = []
+    for name in ('a.tif', 'b.tif'):
+        path = tmp_path / name
+        path.write_bytes(name.encode('utf-8'))
+        paths.append(str(path))
+    first.file_digest(paths[0])
+    second.key('stage', 1, {'b': paths[1]})
+    with open(os.path.join(root, 'hashes.json'), encoding='utf-8') as handle:
+        assert sorted(json.load(handle)) == sorted(paths)
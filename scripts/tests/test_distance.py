@@ -0,0 +1,89 @@
+"""
+Distanze dagli edifici: esattezza e tolleranza rispetto a ``gdal.ComputeProximity``.
+"""
+import numpy as np
+import pytest
+
+gdal = pytest.importorskip('osgeo.gdal')
+
+from fetch.distance import PROXIMITY_TOLERANCE_PX, distance_raster, distance_transform  # noqa: E402
+
+
+def _brute_force(targets, spacing_x, spacing_y):
+    """Distanza da ogni bersaglio, pixel per pixel."""
+    rows, cols = np.nonzero(targets)
+    grid_rows, grid_cols = np.mgrid[0:targets.shape[0], 0:targets.shape[1]]
+    distance = np.full(targets.shape, np.inf)
+    for row, col in zip(rows, cols):
+        distance = np.minimum(distance, np.hypot((grid_cols - col) * spacing_x, (grid_rows - row) * spacing_y))
+    return distance
+
+
+def _write_mask(path, mask, pixel_size):
+    dataset = gdal.GetDriverByName('GTiff').Create(str(path), mask.shape[1], mask.shape[0], 1, gdal.GDT_Byte)
+    dataset.SetGeoTransform((500000, pixel_size, 0, 4500000, 0, -pixel_size))
+    dataset.GetRasterBand(1).WriteArray(mask)
+    dataset = None
+    return str(path)
+
+
+def _read(path):
+    return gdal.Open(path).GetRasterBand(1).ReadAsArray()
+
+
+def _gdal_proximity(path, pixel_size):
+    """Distanze in pixel di ``gdal.ComputeProximity`` dai pixel a 1."""
+    source = gdal.Open(path)
+    target = gdal.GetDriverByName('MEM').Create('', source.RasterXSize, source.RasterYSize, 1, gdal.GDT_Float32)
+    target.SetGeoTransform(source.GetGeoTransform())
+    gdal.ComputeProximity(source.GetRasterBand(1), target.GetRasterBand(1), ['VALUES=1', 'DISTUNITS=GEO'])
+    return target.GetRasterBand(1).ReadAsArray() / pixel_size
+
+
+def _buildings(rng, shape, count):
+    mask = np.zeros(shape, dtype=np.uint8)
+    for _ in range(count):
+        row, col = rng.integers(0, shape[0]), rng.integers(0, shape[1])
+        height, width = rng.integers(2, 15, 2)
+        mask[row:row + height, col:col + width] = 1
+    return mask
+
+
+def test_exact_distances():
+    rng = np.random.default_rng(1)
+    for density in (0.002, 0.02, 0.2):
+        targets = rng.random((37, 29)) < density
+        targets[0, 0] = True
+        for spacing in ((1.0, 1.0), (0.5, 0.7)):
+            assert np.allclose(distance_transform(targets, spacing), _brute_force(targets, *spacing), atol=1e-9)
+
+
+def test_strips_match_single_pass(tmp_path):
+    rng = np.random.default_rng(2)
+    mask = np.zeros((300, 120), dtype=np.uint8)
+    mask[rng.integers(0, 300, 4), rng.integers(0, 120, 4)] = 1
+    path = _write_mask(tmp_path / 'mask.tif', mask, 0.5)
+    expected = distance_transform(mask == 1, (0.5, 0.5)).astype(np.float32)
+    for options in ({}, {'block_rows': 5}, {'block_rows': 17, 'workers': 2}):
+        output = str(tmp_path / 'distance.tif')
+        distance_raster(path, output, **options)
+        assert np.array_equal(_read(output), expected)
+
+
+@pytest.mark.parametrize('kind', ['buildings', 'scattered'])
+def test_gdal_proximity_tolerance(tmp_path, kind):
+    rng = np.random.default_rng(3)
+    if kind == 'buildings':
+        mask = _buildings(rng, (160, 140), 30)
+    else:
+        mask = (rng.random((160, 140)) < 0.01).astype(np.uint8)
+    path = _write_mask(tmp_path / 'mask.tif', mask, 0.5)
+    output = str(tmp_path / 'distance.tif')
+    distance_raster(path, output)
+    ours = _read(output) / 0.5
+    difference = _gdal_proximity(path, 0.5) - ours
+    # GDAL può solo sovrastimare, di al più PROXIMITY_TOLERANCE_PX pixel
+    assert difference.min() > -1e-3
+    assert difference.max() <= PROXIMITY_TOLERANCE_PX
+    if kind == 'buildings':
+        assert np.abs(difference).max() < 1e-3
@@ -0,0 +1,158 @@
+"""
+Scaricamento dei tile contro un server locale che imita la Google Solar API.
+"""
+import json
+import os
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+
+from fetch.download import ConnectionPool, DownloadError, _get, download_tiles, tile_id
+
+API_KEY = 'chiave-segreta'
+CENTROIDS = [(45.1, 9.2), (45.2, 9.3)]
+
+
+def _tiff(name):
+    """Contenuto fittizio di un GeoTIFF, diverso per ogni file e più grande di un pacchetto."""
+    return b'II*\x00' + name.encode('utf-8') * 5000
+
+
+class _SolarStub(BaseHTTPRequestHandler):
+    """
+    dataLayers:get con un 503 alla prima richiesta di ogni tile; il primo mask arriva troncato
+    e i file in ``server.broken`` si interrompono sempre a metà di un blocco chunked.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body, length=None, headers=()):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body) if length is None else length))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        query = parse_qs(parts.query)
+        server = self.server
+        with server.lock:
+            server.hits[parts.path] += 1
+            hits = server.hits[parts.path]
+        if parts.path == '/loop':
+            self._send(302, b'', headers=[('Location', f'/loop?key={API_KEY}')])
+            return
+        if query.get('key') != [API_KEY]:
+            self._send(403, b'chiave mancante')
+            return
+        if parts.path == '/v1/dataLayers:get':
+            tile = tile_id(query['location.latitude'][0], query['location.longitude'][0])
+            with server.lock:
+                server.layer_requests[tile] += 1
+                first = server.layer_requests[tile] == 1
+            if first:
+                self._send(503, b'riprovare')
+                return
+            base = f'http://{self.headers["Host"]}/files'
+            body = json.dumps({field: f'{base}/{prefix}_{tile}.tif?id=1'
+                               for prefix, field in (('dsm', 'dsmUrl'), ('rgb', 'rgbUrl'), ('mask', 'maskUrl'))})
+            self._send(200, body.encode('utf-8'))
+            return
+        name = os.path.basename(parts.path)
+        body = _tiff(name)
+        if name in server.broken:
+            # IncompleteRead: il blocco chunked annunciato non arriva completo
+            self.close_connection = True
+            self.send_response(200)
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            self.wfile.write(b'%x\r\n' % len(body) + body[:len(body) // 2])
+            return
+        if name.startswith('mask_') and hits == 1:
+            # Corpo troncato: la connessione si chiude prima di Content-Length
+            self.close_connection = True
+            self._send(200, body[:len(body) // 2], length=len(body))
+            return
+        self._send(200, body)
+
+
+@pytest.fixture
+def stub_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _SolarStub)
+    server.lock = threading.Lock()
+    server.hits = Counter()
+    server.layer_requests = Counter()
+    server.broken = set()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _download(server, output_dir):
+    endpoint = f'http://127.0.0.1:{server.server_address[1]}/v1/dataLayers:get'
+    return download_tiles(CENTROIDS, API_KEY, str(output_dir), concurrency=4, retries=3, backoff=0.01,
+                          endpoint=endpoint, log=lambda message: None)
+
+
+def test_download_retry_and_resume(stub_server, tmp_path):
+    summary = _download(stub_server, tmp_path)
+    tiles = [tile_id(lat, lng) for lat, lng in CENTROIDS]
+    assert summary == {'downloaded': tiles, 'skipped': [], 'failed': {}}
+    # Un 503 e poi la risposta per ogni tile; il mask troncato viene scaricato di nuovo
+    assert stub_server.hits['/v1/dataLayers:get'] == 2 * len(tiles)
+    for tile in tiles:
+        for prefix in ('dsm', 'rgb', 'mask'):
+            name = f'{prefix}_{tile}.tif'
+            with open(tmp_path / name, 'rb') as handle:
+                assert handle.read() == _tiff(name)
+            assert stub_server.hits[f'/files/{name}'] == (2 if prefix == 'mask' else 1)
+    assert not [name for name in os.listdir(tmp_path) if name.endswith('.part')]
+
+    # Stesso comando dopo il completamento: nessuna richiesta
+    requests_before = sum(stub_server.hits.values())
+    summary = _download(stub_server, tmp_path)
+    assert summary['skipped'] == tiles and not summary['downloaded']
+    assert sum(stub_server.hits.values()) == requests_before
+
+    # Un file perso: viene scaricato di nuovo solo il suo tile
+    os.remove(tmp_path / f'rgb_{tiles[1]}.tif')
+    summary = _download(stub_server, tmp_path)
+    assert summary['skipped'] == tiles[:1] and summary['downloaded'] == tiles[1:]
+    assert (tmp_path / f'rgb_{tiles[1]}.tif').read_bytes() == _tiff(f'rgb_{tiles[1]}.tif')
+
+
+def test_interrupted_download_leaves_no_partial_file(stub_server, tmp_path):
+    tiles = [tile_id(lat, lng) for lat, lng in CENTROIDS]
+    broken = f'rgb_{tiles[1]}.tif'
+    stub_server.broken.add(broken)
+    summary = _download(stub_server, tmp_path)
+    assert summary['downloaded'] == tiles[:1] and list(summary['failed']) == tiles[1:]
+    # Primo tentativo e tre nuovi tentativi, tutti interrotti
+    assert stub_server.hits[f'/files/{broken}'] == 4
+    assert not [name for name in os.listdir(tmp_path) if name.endswith('.part')]
+    assert not (tmp_path / broken).exists()
+
+    # Rilanciando con il server di nuovo funzionante il file viene scaricato da zero
+    stub_server.broken.clear()
+    summary = _download(stub_server, tmp_path)
+    assert summary['skipped'] == tiles[:1] and summary['downloaded'] == tiles[1:]
+    assert (tmp_path / broken).read_bytes() == _tiff(broken)
+
+
+def test_redirect_error_hides_api_key(stub_server):
+    pool = ConnectionPool(timeout=5)
+    with pytest.raises(DownloadError) as error:
+        _get(pool, f'http://127.0.0.1:{stub_server.server_address[1]}/loop?key={API_KEY}')
+    pool.close()
+    assert 'Troppi redirect' in str(error.value)
+    assert API_KEY not in str(error.value)
@@ -0,0 +1,98 @@
+"""
+Raster di copertura del suolo: ``build_landcover_raster`` contro la vecchia catena dello script 05
+(riclassificazione -> polygonize della maschera -> rasterize degli edifici -> merge -> translate).
+"""
+import numpy as np
+import pytest
+
+gdal = pytest.importorskip('osgeo.gdal')
+ogr = pytest.importorskip('osgeo.ogr')
+
+from fetch.landcover import build_landcover_raster  # noqa: E402
+
+CLASS_NODATA = 255
+MASK_NODATA = 255
+# NO_DATA di qgis:reclassifybytable nello script 05
+RECLASS_NODATA = -9999
+
+
+def _write(path, array, geotransform, nodata):
+    dataset = gdal.GetDriverByName('GTiff').Create(str(path), array.shape[1], array.shape[0], 1, gdal.GDT_Byte)
+    dataset.SetGeoTransform(geotransform)
+    dataset.GetRasterBand(1).SetNoDataValue(nodata)
+    dataset.GetRasterBand(1).WriteArray(array)
+    dataset = None
+    return str(path)
+
+
+def _read(path):
+    return gdal.Open(path).GetRasterBand(1).ReadAsArray()
+
+
+def _old_chain(class_path, mask_path):
+    """Raster ``pervius_impervius_buildings`` come lo producevano gli script 04 e 05."""
+    classes = gdal.Open(class_path)
+    values = classes.GetRasterBand(1).ReadAsArray()
+
+    # qgis:reclassifybytable, TABLE [0, 5, 1, 5, 9, 0], min < x <= max, Float32
+    remapped = values.astype(np.float32)
+    remapped[(values > 0) & (values <= 5)] = 1
+    remapped[(values > 5) & (values <= 9)] = 0
+    remapped[values == CLASS_NODATA] = RECLASS_NODATA
+
+    # Script 04: gdal:polygonize della maschera e cancellazione dei poligoni con value = 0
+    mask = gdal.Open(mask_path)
+    mask_band = mask.GetRasterBand(1)
+    datasource = ogr.GetDriverByName('Memory').CreateDataSource('')
+    layer = datasource.CreateLayer('buildings', None, ogr.wkbPolygon)
+    layer.CreateField(ogr.FieldDefn('value', ogr.OFTInteger))
+    gdal.Polygonize(mask_band, mask_band.GetMaskBand(), layer, 0, [])
+    for feature in list(layer):
+        if feature.GetField('value') == 0:
+            layer.DeleteFeature(feature.GetFID())
+
+    # gdal:rasterize con BURN 2 e NODATA 0 sulla griglia di ``class``
+    burned = gdal.GetDriverByName('MEM').Create('', classes.RasterXSize, classes.RasterYSize, 1, gdal.GDT_Float32)
+    burned.SetGeoTransform(classes.GetGeoTransform())
+    burned.GetRasterBand(1).SetNoDataValue(0)
+    burned.GetRasterBand(1).Fill(0)
+    gdal.RasterizeLayer(burned, [1], layer, burn_values=[2])
+    buildings = burned.GetRasterBand(1).ReadAsArray()
+
+    # gdal:merge senza NODATA_INPUT: ogni input copre solo i suoi pixel validi, il resto vale 0
+    merged = np.zeros(values.shape, dtype=np.float32)
+    valid = remapped != RECLASS_NODATA
+    merged[valid] = remapped[valid]
+    merged[buildings != 0] = 2
+    # gdal:translate con DATA_TYPE 0 mantiene il tipo Float32
+    return merged
+
+
+def _fixture(tmp_path, mask_geotransform, mask_shape):
+    rng = np.random.default_rng(7)
+    classes = rng.integers(0, 11, (45, 60)).astype(np.uint8)
+    classes[rng.random(classes.shape) < 0.05] = CLASS_NODATA
+    mask = np.zeros(mask_shape, dtype=np.uint8)
+    for _ in range(25):
+        row, col = rng.integers(0, mask_shape[0]), rng.integers(0, mask_shape[1])
+        height, width = rng.integers(1, 9, 2)
+        mask[row:row + height, col:col + width] = rng.integers(1, 3)
+    mask[rng.random(mask_shape) < 0.02] = MASK_NODATA
+    class_path = _write(tmp_path / 'class.tif', classes, (1000.0, 1.0, 0, 2000.0, 0, -1.0), CLASS_NODATA)
+    mask_path = _write(tmp_path / 'mask.tif', mask, mask_geotransform, MASK_NODATA)
+    return class_path, mask_path
+
+
+@pytest.mark.parametrize('mask_geotransform, mask_shape', [
+    ((1000.0, 1.0, 0, 2000.0, 0, -1.0), (45, 60)),
+    ((999.75, 0.5, 0, 2000.25, 0, -0.5), (92, 122)),
+    ((998.0, 3.0, 0, 2001.0, 0, -3.0), (17, 22)),
+], ids=['aligned', 'finer', 'coarser'])
+def test_matches_old_chain(tmp_path, mask_geotransform, mask_shape):
+    class_path, mask_path = _fixture(tmp_path, mask_geotransform, mask_shape)
+    expected = _old_chain(class_path, mask_path).astype(np.uint8)
+    for block_rows in (None, 7):
+        output = build_landcover_raster(class_path, mask_path, str(tmp_path / 'landcover.tif'), block_rows)
+        labels = _read(output)
+        assert labels.dtype == np.uint8
+        assert labels.tobytes() == expected.tobytes()
@@ -0,0 +1,87 @@
+"""
+Classificazione LCZ: ``classify_batch`` deve dare, cella per cella, lo stesso
+risultato di ``LCZClassifier.classify``.
+"""
+import contextlib
+import io
+import warnings
+
+import numpy as np
+import pytest
+
+from fetch.lcz import PARAMETER_NAMES, LCZClassifier, classify_batch, pack_ranges, parameter_matrix
+
+FRACTIONS = ('building_surface_fraction', 'impervious_surface_fraction', 'pervious_surface_fraction')
+
+
+def _random_record(rng, ranges):
+    """Parametri intorno ai range di una classe a caso, con valori mancanti e frazioni a volte errate."""
+    low, high = ranges[rng.integers(0, len(ranges))].T
+    high = np.where(np.isinf(high), low * 2 + 1, high)
+    values = low + (high - low) * rng.uniform(-0.6, 1.6, len(PARAMETER_NAMES))
+    values[rng.random(len(values)) < 0.15] = 0
+    record = {name: float(value) for name, value in zip(PARAMETER_NAMES, values)}
+    building = (0.0, rng.uniform(0, 100), float(rng.integers(0, 60)))[rng.integers(0, 3)]
+    impervious = rng.uniform(0, 100 - building)
+    record.update(zip(FRACTIONS, (building, impervious, 100 - building - impervious)))
+    for name in PARAMETER_NAMES:
+        if name != 'building_surface_fraction' and rng.random() < 0.2:
+            record[name] = None
+    if rng.random() < 0.02:
+        record['pervious_surface_fraction'] = (record['pervious_surface_fraction'] or 0) + 3
+    if rng.random() < 0.01:
+        record['building_surface_fraction'] = None
+    return record
+
+
+def _tie_records(classes, ranges):
+    """Celle in cui più classi hanno gli stessi match perfetti e lo stesso RMSEP."""
+    records = []
+    for building in (0.0, 30.0):
+        # Solo le frazioni: tutte le classi valide a pari merito
+        record = dict.fromkeys(PARAMETER_NAMES)
+        record.update(zip(FRACTIONS, (building, 50.0, 50.0 - building)))
+        records.append(record)
+    for index in range(len(classes)):
+        # Valori sugli estremi dei range, condivisi da classi vicine
+        for bound in (0, 1):
+            values = np.where(np.isinf(ranges[index, :, bound]), ranges[index, :, 0], ranges[index, :, bound])
+            record = {name: float(value) for name, value in zip(PARAMETER_NAMES, values)}
+            building = record['building_surface_fraction']
+            record.update(zip(FRACTIONS, (building, (100 - building) / 2, (100 - building) / 2)))
+            records.append(record)
+    return records
+
+
+def _scalar(record):
+    """Risultato di ``classify`` o None se la cella non è classificabile."""
+    try:
+        with warnings.catch_warnings(), contextlib.redirect_stdout(io.StringIO()):
+            warnings.simplefilter('ignore')
+            return LCZClassifier(record).classify(report=False, details=True)
+    except (ValueError, TypeError):
+        return None
+
+
+@pytest.mark.parametrize('batch_rows', [65536, 777])
+def test_batch_matches_scalar(batch_rows):
+    rng = np.random.default_rng(5)
+    classes, ranges = pack_ranges()
+    records = [_random_record(rng, ranges) for _ in range(3000)] + _tie_records(classes, ranges)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        result = classify_batch(parameter_matrix(records), batch_rows=batch_rows, details=True)
+
+    for index, record in enumerate(records):
+        expected = _scalar(record)
+        if expected is None:
+            assert not result['valid'][index], index
+            assert result['lcz_class'][index] is None
+            continue
+        assert result['valid'][index], index
+        assert result['lcz_class'][index] == expected['lcz_class'], index
+        assert np.float64(result['rmsep'][index]).tobytes() == np.float64(expected['rmsep']).tobytes(), index
+        assert result['perfect_matches'][index] == expected['perfect_matches'], index
+        assert result['available_params'][index] == expected['available_params'], index
+        contributions = [expected['error_contributions'].get(name, np.nan) for name in PARAMETER_NAMES]
+        assert np.array_equal(result['error_contributions'][index], contributions, equal_nan=True), index
@@ -0,0 +1,94 @@
+"""
+Analisi a più risoluzioni: le statistiche sufficienti delle celle fini, aggregate
+a blocchi 2×2 e 4×4, devono dare gli stessi valori del calcolo diretto sulla
+griglia grossa.
+"""
+import numpy as np
+import pytest
+
+gdal = pytest.importorskip('osgeo.gdal')
+
+from fetch.cells import RasterGrid  # noqa: E402
+from fetch.multires import (aggregate_summaries, coarser_grid, parent_positions, sketch_majority,  # noqa: E402
+                            summary_name)
+from fetch.sketch import sketch_median  # noqa: E402
+from fetch.zonal import ZonalEngine  # noqa: E402
+
+NODATA = -9999
+ORIGIN = (500000.0, 4500046.0)
+# Celle fini di 2×2 pixel: le celle grosse 4×4 hanno 64 pixel, quanti i punti dei
+# riassunti, quindi mediane e maggioranze aggregate sono esatte
+FINE_SIZE = 2.0
+POINTS = 64
+
+
+def _write_raster(path, values):
+    """GeoTIFF float32 con pixel di 1 m e nodata ``NODATA``."""
+    dataset = gdal.GetDriverByName('GTiff').Create(str(path), values.shape[1], values.shape[0], 1,
+                                                   gdal.GDT_Float32)
+    dataset.SetGeoTransform((ORIGIN[0], 1.0, 0, ORIGIN[1], 0, -1.0))
+    band = dataset.GetRasterBand(1)
+    band.SetNoDataValue(NODATA)
+    band.WriteArray(values)
+    dataset = None
+    return str(path)
+
+
+def _values(rng, shape):
+    """Valori interi ripetuti (per la maggioranza) con nodata sparso, NaN e un blocco tutto nullo."""
+    values = rng.integers(0, 12, shape).astype(np.float32)
+    values[rng.random(shape) < 0.1] = NODATA
+    values[rng.random(shape) < 0.05] = np.nan
+    values[:8, :8] = NODATA
+    return values
+
+
+@pytest.mark.parametrize('factor', [2, 4])
+def test_aggregation_matches_coarse_grid(tmp_path, factor):
+    rng = np.random.default_rng(23)
+    # 46×38 pixel: 23×19 celle fini, non multipli di 2 né di 4 (celle grosse tagliate sul bordo)
+    raster = _write_raster(tmp_path / 'values.tif', _values(rng, (46, 38)))
+    fine = RasterGrid(ORIGIN[0], ORIGIN[1], FINE_SIZE, 19, 23)
+    coarse = coarser_grid(fine, FINE_SIZE * factor)
+    assert (coarse.ncols, coarse.nrows) == (-(-19 // factor), -(-23 // factor))
+
+    engine = ZonalEngine(fine, sketch_points=POINTS)
+    engine.add('values', raster, ['count', 'sum', 'sketch'])
+    results = engine.run()['values']
+    summaries = {summary_name('values', statistic): results[statistic] for statistic in ('count', 'sum', 'sketch')}
+    aggregated = aggregate_summaries(summaries, parent_positions(fine, coarse), len(coarse))
+
+    engine = ZonalEngine(coarse)
+    engine.add('values', raster, ['count', 'sum', 'median', 'majority'])
+    expected = engine.run()['values']
+
+    assert np.array_equal(aggregated[summary_name('values', 'count')], expected['count'])
+    assert (expected['count'] == 0).any() and (expected['count'] < (2 * factor) ** 2).any()
+    assert np.allclose(aggregated[summary_name('values', 'sum')], expected['sum'])
+    sketch = aggregated[summary_name('values', 'sketch')]
+    assert np.array_equal(sketch_median(sketch), expected['median'], equal_nan=True)
+    assert np.array_equal(sketch_majority(sketch), expected['majority'], equal_nan=True)
+
+
+def test_coarse_grid_subset(tmp_path):
+    """Celle grosse escluse: le celle fini che contengono vengono ignorate."""
+    rng = np.random.default_rng(24)
+    raster = _write_raster(tmp_path / 'values.tif', _values(rng, (46, 38)))
+    fine = RasterGrid(ORIGIN[0], ORIGIN[1], FINE_SIZE, 19, 23)
+    full = coarser_grid(fine, FINE_SIZE * 4)
+    coarse = full.subset(np.arange(len(full)) % 3 != 0)
+    parent = parent_positions(fine, coarse)
+    assert (parent == -1).any()
+
+    engine = ZonalEngine(fine, sketch_points=POINTS)
+    engine.add('values', raster, ['count', 'sketch'])
+    results = engine.run()['values']
+    aggregated = aggregate_summaries({summary_name('values', 'count'): results['count'],
+                                      summary_name('values', 'sketch'): results['sketch']}, parent, len(coarse))
+
+    engine = ZonalEngine(coarse)
+    engine.add('values', raster, ['count', 'median'])
+    expected = engine.run()['values']
+    assert np.array_equal(aggregated[summary_name('values', 'count')], expected['count'])
+    assert np.array_equal(sketch_median(aggregated[summary_name('values', 'sketch')]), expected['median'],
+                          equal_nan=True)
@@ -0,0 +1,22 @@
+"""
+Archivio delle colonne per cella.
+"""
+import numpy as np
+
+from fetch.records import CellStore
+
+
+def test_write_reshaped_column(tmp_path):
+    store = CellStore(str(tmp_path))
+    store.write([1, 2, 3], {'sketch': np.ones((3, 4)), 'mean': np.arange(3.0)})
+
+    # Riassunti con un altro numero di punti (sketch_points cambiato tra due esecuzioni)
+    store.write([2], {'sketch': np.full((1, 6), 2.0)})
+    sketch = store.read('sketch')
+    assert sketch.shape == (3, 6)
+    assert np.array_equal(sketch[1], np.full(6, 2.0))
+    assert np.isnan(sketch[[0, 2]]).all()
+
+    store.write([1, 3], {'sketch': np.zeros((2, 6)), 'mean': [7.0, 9.0]})
+    assert np.array_equal(store.read('sketch', [1, 2, 3]), [[0.0] * 6, [2.0] * 6, [0.0] * 6])
+    assert np.array_equal(store.read('mean'), [7.0, 1.0, 9.0])
@@ -0,0 +1,86 @@
+"""
+Riassunti dei quantili: errore di rango rispetto a ``np.median`` / ``np.percentile``.
+
+Con ``points`` punti e ``merges`` unioni l'errore di rango documentato è al
+più ``0.5 * merges / points`` (``points_for_error``).
+"""
+import numpy as np
+import pytest
+
+from fetch.sketch import SketchAccumulator, merge_sketches, points_for_error, sketch_from_sorted, sketch_median
+
+QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+
+
+def _random_cells(rng, ncells, size):
+    """Valori float32 di più celle, con distribuzioni diverse e molti valori ripetuti."""
+    return [
+        rng.normal(10, 3, size).astype(np.float32),
+        rng.exponential(5, size).astype(np.float32),
+        rng.integers(0, 40, size).astype(np.float32),
+        np.concatenate([rng.uniform(0, 1, size // 2), rng.uniform(100, 101, size - size // 2)]).astype(np.float32),
+    ][:ncells]
+
+
+def _sketch_quantile(points, quantile):
+    """Punto del riassunto il cui rango nominale ``(i + 0.5) / m`` è il più vicino a ``quantile``."""
+    points = points[~np.isnan(points)]
+    return points[min(int(quantile * len(points)), len(points) - 1)]
+
+
+def _assert_rank(values, estimate, quantile, error):
+    """Il rango di ``estimate`` nei valori è entro ``error`` da ``quantile``."""
+    low = np.percentile(values, 100 * max(quantile - error, 0), method='inverted_cdf')
+    high = np.percentile(values, 100 * min(quantile + error, 1), method='inverted_cdf')
+    assert low <= estimate <= high, (quantile, estimate, low, high)
+
+
+def _check(values, points, error):
+    # Il punto scelto dista al più mezzo punto dal quantile richiesto
+    tolerance = error + 0.5 / points.shape[0]
+    for quantile in QUANTILES:
+        _assert_rank(values, _sketch_quantile(points, quantile), quantile, tolerance)
+    # La media dei due punti centrali sta tra i loro valori, e con loro np.median
+    median = sketch_median(points[None, :])[0]
+    _assert_rank(values, median, 0.5, tolerance)
+    _assert_rank(values, np.median(values), 0.5, tolerance)
+
+
+@pytest.mark.parametrize('error, blocks', [(0.01, 8), (0.002, 3)])
+def test_accumulator_rank_error(error, blocks):
+    rng = np.random.default_rng(11)
+    cells = _random_cells(rng, 4, 100_000)
+    # Ogni cella arriva in ``blocks`` blocchi: ``blocks`` unioni per cella
+    points = points_for_error(error, blocks)
+    accumulator = SketchAccumulator(len(cells), np.full(len(cells), blocks), points)
+    chunks = [np.array_split(rng.permutation(values), blocks) for values in cells]
+    for block in range(blocks):
+        labels = np.concatenate([np.full(len(chunks[cell][block]), cell) for cell in range(len(cells))])
+        accumulator.add(labels, np.concatenate([chunks[cell][block] for cell in range(len(cells))]), block + 1)
+    sketches, counts = accumulator.finish()
+
+    for cell, values in enumerate(cells):
+        assert counts[cell] == len(values)
+        _check(values, sketches[cell], error)
+
+
+def test_merged_chunk_sketches_rank_error():
+    rng = np.random.default_rng(12)
+    cells = _random_cells(rng, 4, 75_000)
+    nchunks = 6
+    points = points_for_error(0.01)
+    # Un riassunto per ogni pezzo di ogni cella (ad es. da processi diversi), poi un'unione per cella
+    chunk_values, chunk_parent = [], []
+    for cell, values in enumerate(cells):
+        for chunk in np.array_split(rng.permutation(values), nchunks):
+            chunk_values.append(np.sort(chunk))
+            chunk_parent.append(cell)
+    counts = np.array([len(chunk) for chunk in chunk_values])
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    sketches, sketch_counts = sketch_from_sorted(np.concatenate(chunk_values), counts, starts, points)
+    merged, merged_counts = merge_sketches(sketches, sketch_counts, chunk_parent, len(cells))
+
+    for cell, values in enumerate(cells):
+        assert merged_counts[cell] == len(values)
+        # Errore dei riassunti dei pezzi più quello dell'unione
+        _check(values, merged[cell], 2 * 0.5 / points)